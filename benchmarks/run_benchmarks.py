@@ -0,0 +1,247 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Benchmarks of the WerHiResSmoM1Italy5y model core and adaptor hot paths.
+
+The forecast is a synthetic CSEP xml file covering the standard Italy grid,
+so that no external data is needed. Results are written as a JSON document
+to track regressions across releases::
+
+    python benchmarks/run_benchmarks.py --output benchmarks.json
+
+Cases depending on the worker base package are reported as skipped if it
+is not installed.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from ramsis.sfm.werhiressmom1italy5y import __version__
+from ramsis.sfm.werhiressmom1italy5y.core import (
+    forecast_grid, parallel, werner_model)
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+# Standard Italy grid, see settings.
+ITALY_LON_MIN = 5.55
+ITALY_LAT_MIN = 35.85
+ITALY_N_LON = 140
+ITALY_N_LAT = 121
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup if the case cannot run."""
+
+
+def _time(func, repeat, number=None):
+    """ Time func, returning statistics of the seconds per call.
+    """
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"number": number,
+            "repeat": repeat,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times),
+            "stdev": statistics.stdev(times) if len(times) > 1 else 0.0}
+
+
+def _off_grid_reservoir(step):
+    return {"x": np.round(np.arange(6.02, 18.9, step), 2).tolist(),
+            "y": np.round(np.arange(36.13, 47.3, step), 2).tolist(),
+            "z": [-30000.0, 0.0]}
+
+
+def _default_reservoir():
+    try:
+        from ramsis.sfm.werhiressmom1italy5y import settings
+    except ImportError as err:
+        raise Skip(str(err))
+    return settings.RAMSIS_WORKER_SFM_DEFAULTS["reservoir"]["geom"]
+
+
+class Benchmarks:
+    """ Benchmark cases sharing a synthetic forecast.
+
+    Every method named bench_<case> returns a callable to time, it may
+    raise :py:class:`Skip`.
+
+    :param str tmp_dir: Directory holding the synthetic forecast.
+    :param int seed: Seed of the synthetic forecast.
+    """
+
+    def __init__(self, tmp_dir, seed=0):
+        self.tmp_dir = tmp_dir
+        self.xml_path = os.path.join(tmp_dir, "forecast.xml")
+        write_csep_xml(self.xml_path, lon_min=ITALY_LON_MIN,
+                       lat_min=ITALY_LAT_MIN, n_lon=ITALY_N_LON,
+                       n_lat=ITALY_N_LAT, seed=seed)
+        forecast_grid.compile_forecast(self.xml_path)
+        self.locator = werner_model.get_result_locator(
+            xml_filename=self.xml_path)
+
+    @classmethod
+    def cases(cls):
+        return [name[len("bench_"):] for name in sorted(dir(cls))
+                if name.startswith("bench_")]
+
+    def bench_locator_from_xml(self):
+        cache_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+
+        def run():
+            werner_model.ResultLocator(xml_filename=self.xml_path,
+                                       cache_dir=cache_dir)
+            os.remove(forecast_grid.compiled_path(self.xml_path, cache_dir))
+        return run
+
+    def bench_locator_from_compiled(self):
+        return lambda: werner_model.ResultLocator(xml_filename=self.xml_path)
+
+    def bench_cell_search_grid_match(self):
+        return lambda: self.locator.cell_search(
+            12.0, 12.1, 42.0, 42.1, grid_match=True)
+
+    def bench_cell_search_off_grid(self):
+        return lambda: self.locator.cell_search(
+            12.02, 12.49, 42.03, 42.41, grid_match=False)
+
+    def bench_exec_model_default_grid(self):
+        reservoir_geom = _default_reservoir()
+        return lambda: werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+
+    def bench_exec_model_off_grid(self):
+        reservoir_geom = _off_grid_reservoir(0.13)
+        return lambda: werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+
+    def bench_exec_model_off_grid_coarse(self):
+        reservoir_geom = _off_grid_reservoir(0.57)
+        return lambda: werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+
+    def bench_exec_model_off_grid_uncached(self):
+        reservoir_geom = _off_grid_reservoir(0.13)
+
+        def run():
+            self.locator.operators.clear()
+            werner_model.exec_model(reservoir_geom,
+                                    xml_filename=self.xml_path)
+        return run
+
+    def bench_exec_model_off_grid_parallel(self):
+        reservoir_geom = _off_grid_reservoir(0.13)
+        return lambda: werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path, n_workers=-1)
+
+    def bench_forecast_scaling(self):
+        forecast_df = pd.DataFrame(
+            np.asarray(self.locator.grid.rates)[self.locator.grid.present],
+            columns=self.locator.mag_list)
+        return lambda: werner_model.forecast_scaling(
+            forecast_df.copy(), self.locator.mag_list)
+
+    def bench_adaptor_run(self):
+        try:
+            from ramsis.sfm.werhiressmom1italy5y.server.model_adaptor import \
+                ModelAdaptor
+        except ImportError as err:
+            raise Skip(str(err))
+        from ramsis.sfm.werhiressmom1italy5y import settings
+        defaults = settings.RAMSIS_WORKER_SFM_DEFAULTS
+        adaptor = ModelAdaptor(xml_filename=self.xml_path, **defaults)
+        start = datetime.datetime(2019, 1, 1)
+        kwargs = {"reservoir": defaults["reservoir"],
+                  "model_parameters": {
+                      "datetime_start": start,
+                      "datetime_end": start + datetime.timedelta(days=365),
+                      "epoch_duration": 86400 * 365 / 4}}
+        return lambda: adaptor._run(**kwargs)
+
+
+def run(cases=None, repeat=5, number=None, seed=0):
+    """ Run the benchmark cases.
+
+    :param cases: Names of the cases to run, all if not given.
+    :param int repeat: Number of timings per case.
+    :param int number: Calls per timing. Determined per case, so that a
+        timing takes at least 0.2 s, if not given.
+    :param int seed: Seed of the synthetic forecast.
+    :returns: JSON serializable benchmark report.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        benchmarks = Benchmarks(tmp_dir, seed=seed)
+        for case in cases or Benchmarks.cases():
+            try:
+                func = getattr(benchmarks, "bench_" + case)()
+            except Skip as err:
+                results[case] = {"skipped": str(err)}
+                continue
+            results[case] = _time(func, repeat, number)
+    finally:
+        werner_model.invalidate_result_locators()
+        parallel.close_pools()
+        shutil.rmtree(tmp_dir)
+
+    return {
+        "version": __version__,
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "packages": {"numpy": np.__version__, "pandas": pd.__version__,
+                     "scipy": scipy.__version__},
+        "forecast": {"n_lon": ITALY_N_LON, "n_lat": ITALY_N_LAT,
+                     "seed": seed},
+        # Kilobytes on Linux.
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "unit": "seconds per call",
+        "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the WerHiResSmoM1Italy5y model.")
+    parser.add_argument("cases", nargs="*", metavar="CASE",
+                        help="Cases to run, all if none are given: "
+                             f"{', '.join(Benchmarks.cases())}.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timings per case.")
+    parser.add_argument("--number", type=int,
+                        help="Calls per timing, determined per case if "
+                             "not given.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic forecast.")
+    parser.add_argument("--output", "-o",
+                        help="JSON output file, stdout if not given.")
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(Benchmarks.cases())
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+
+    report = run(args.cases, repeat=args.repeat, number=args.number,
+                 seed=args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Consistency tests of the forecast with an observed catalog.
+
+The catalog is binned into the (lon, lat, mag) cells of the forecast grid,
+the forecast is then evaluated by the CSEP consistency tests (Zechar et al.,
+2010): the joint Poisson log-likelihood, the number test (N-test), and the
+likelihood (L-test), spatial (S-test) and magnitude (M-test) tests.
+
+The quantiles of the L, S and M tests are estimated from catalogs
+simulated from the forecast. Simulations are drawn in batches of a fixed
+size, each seeded by a seed derived from the seed of the test, so that the
+results only depend on the seed and the batch size, not on whether the
+batches are simulated in the calling process or across a process pool.
+"""
+import logging
+
+import numpy as np
+from scipy.special import gammaln
+from scipy.stats import poisson
+
+from ramsis.sfm.werhiressmom1italy5y.core import parallel
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+# Number of catalogs simulated per batch.
+SIMULATION_BATCH_SIZE = 1000
+
+
+class EvaluationResult:
+    """ Outcome of a consistency test.
+
+    :param str name: Name of the test.
+    :param quantile: Quantile score of the observation, a tuple of the
+        probabilities of at least and at most the observed number of events
+        for the N-test.
+    :param float observed_statistic: Statistic of the observed catalog.
+    :param test_distribution: Statistics of the simulated catalogs, or the
+        expected number of events for the N-test.
+    """
+
+    def __init__(self, name, quantile, observed_statistic,
+                 test_distribution):
+        self.name = name
+        self.quantile = quantile
+        self.observed_statistic = observed_statistic
+        self.test_distribution = test_distribution
+
+    def __repr__(self):
+        return (f"{type(self).__name__}({self.name!r}, "
+                f"quantile={self.quantile})")
+
+    def as_dict(self):
+        test_distribution = self.test_distribution
+        if isinstance(test_distribution, np.ndarray):
+            test_distribution = test_distribution.tolist()
+        return {'name': self.name,
+                'quantile': self.quantile,
+                'observed_statistic': self.observed_statistic,
+                'test_distribution': test_distribution}
+
+
+def forecast_counts(grid, scale=1.0):
+    """ Expected number of events of the forecast cells.
+
+    :param grid: :py:class:`ForecastGrid` of the forecast.
+    :param float scale: Factor applied to the rates of the grid, e.g. the
+        duration of the catalog in years times 0.2 for the rates of a five
+        year forecast file.
+    :returns: Array of shape (cells, mag) of the cells defined by the
+        forecast.
+    """
+    return np.asarray(grid.rates)[np.asarray(grid.present)] * scale
+
+
+def bin_catalog(grid, catalog, last_bin_open=True):
+    """ Number of observed events in every forecast cell.
+
+    Events outside of the cells defined by the forecast, below its first
+    magnitude bin or outside of its depth range are not counted. The
+    magnitude bin labels of the forecast are taken as the lower bin edges.
+
+    :param grid: :py:class:`ForecastGrid` of the forecast.
+    :param catalog: DataFrame with columns 'lon', 'lat', 'mag' and 'depth'
+        in m, see :py:func:`utils.obspy_catalog_parser`.
+    :param bool last_bin_open: Count events beyond the last magnitude bin
+        in the last bin.
+    :returns: Array of shape (cells, mag) of the cells defined by the
+        forecast, in the order of :py:func:`forecast_counts`.
+    """
+    lons = np.asarray(catalog['lon'], dtype=float)
+    lats = np.asarray(catalog['lat'], dtype=float)
+    mags = np.asarray(catalog['mag'], dtype=float)
+    depths = np.asarray(catalog['depth'], dtype=float)
+
+    lon_edges = np.append(grid.lons - grid.lon_increment / 2.0,
+                          grid.lons[-1] + grid.lon_increment / 2.0)
+    lat_edges = np.append(grid.lats - grid.lat_increment / 2.0,
+                          grid.lats[-1] + grid.lat_increment / 2.0)
+    mag_edges = np.array([float(mag) for mag in grid.mag_list])
+    lon_index = np.digitize(lons, lon_edges) - 1
+    lat_index = np.digitize(lats, lat_edges) - 1
+    mag_index = np.digitize(mags, mag_edges) - 1
+
+    valid = ((lon_index >= 0) & (lon_index < len(grid.lons)) &
+             (lat_index >= 0) & (lat_index < len(grid.lats)) &
+             (mag_index >= 0))
+    if last_bin_open:
+        mag_index = np.minimum(mag_index, len(mag_edges) - 1)
+    else:
+        width = mag_edges[1] - mag_edges[0] if len(mag_edges) > 1 else 0.0
+        valid &= mags < mag_edges[-1] + width
+    # Depths are positive downwards, the depth range of the grid is given
+    # as altitudes.
+    altitudes = -depths / 1000.0
+    valid &= ~((altitudes < grid.min_depth_km) |
+               (altitudes > grid.max_depth_km))
+
+    n_lon, n_lat = len(grid.lons), len(grid.lats)
+    flat_index = np.ravel_multi_index(
+        (lon_index[valid], lat_index[valid], mag_index[valid]),
+        (n_lon, n_lat, len(mag_edges)))
+    observed = np.bincount(flat_index, minlength=n_lon * n_lat *
+                           len(mag_edges)).reshape(n_lon, n_lat, -1)
+    present = np.asarray(grid.present)
+    n_outside = len(catalog) - int(observed[present].sum())
+    if n_outside:
+        logger.info(f"{n_outside} events of the catalog are not within "
+                    "the forecast cells.")
+    return observed[present]
+
+
+def log_likelihood(forecast, observed):
+    """ Joint Poisson log-likelihood of observed event counts.
+
+    :param forecast: Array of expected numbers of events.
+    :param observed: Array of observed numbers of events, of the same
+        shape.
+    :returns: Log-likelihood, -inf if events are observed in a bin without
+        expected events.
+    """
+    forecast = np.asarray(forecast, dtype=float).ravel()
+    observed = np.asarray(observed).ravel()
+    occupied = observed > 0
+    with np.errstate(divide='ignore'):
+        return float(-forecast.sum() +
+                     np.dot(observed[occupied],
+                            np.log(forecast[occupied])) -
+                     gammaln(observed[occupied] + 1.0).sum())
+
+
+def simulate_log_likelihoods(rates, n_sims, seed, n_events=None):
+    """ Joint Poisson log-likelihoods of catalogs simulated from a
+    forecast.
+
+    Rather than drawing the count of every bin of every catalog, the
+    events of each catalog are drawn and placed into the bins by inverse
+    transform sampling, so that memory use is proportional to the number of
+    simulated events.
+
+    :param rates: 1-D array of the expected numbers of events of the bins.
+    :param int n_sims: Number of catalogs to simulate.
+    :param int seed: Seed of the simulation.
+    :param n_events: Number of events of every simulated catalog. Drawn
+        from the Poisson distribution of the total expected number of
+        events if not given.
+    :returns: Array of the log-likelihoods of the catalogs, with respect to
+        rates.
+    """
+    random_state = np.random.RandomState(seed)
+    rates = np.asarray(rates, dtype=float).ravel()
+    total = rates.sum()
+    if n_events is None:
+        counts = random_state.poisson(total, size=n_sims)
+    else:
+        counts = np.full(n_sims, n_events, dtype=np.intp)
+    catalog_index = np.repeat(np.arange(n_sims), counts)
+    if not len(catalog_index):
+        return np.full(n_sims, -total)
+
+    cdf = np.cumsum(rates)
+    bins = np.searchsorted(
+        cdf, random_state.random_sample(len(catalog_index)) * cdf[-1],
+        side='right')
+    bins = np.minimum(bins, len(rates) - 1)
+    # Count the events of every occupied bin of every catalog.
+    occupied, multiplicity = np.unique(
+        catalog_index * len(rates) + bins, return_counts=True)
+    return (-total +
+            np.bincount(catalog_index, weights=np.log(rates[bins]),
+                        minlength=n_sims) -
+            np.bincount(occupied // len(rates),
+                        weights=gammaln(multiplicity + 1.0),
+                        minlength=n_sims))
+
+
+def _simulate_batch(args):
+    rates, n_sims, seed, n_events = args
+    return simulate_log_likelihoods(rates, n_sims, seed, n_events)
+
+
+def simulated_log_likelihoods(rates, n_sims, seed=None, n_events=None,
+                              batch_size=SIMULATION_BATCH_SIZE,
+                              n_workers=None):
+    """ Log-likelihoods of catalogs simulated from a forecast in seeded
+    batches, see :py:func:`simulate_log_likelihoods`.
+
+    :param int n_sims: Number of catalogs to simulate.
+    :param seed: Seed the seeds of the batches are drawn from.
+    :param int batch_size: Number of catalogs per batch.
+    :param int n_workers: Number of worker processes the batches are
+        spread over, see :py:func:`parallel.worker_count`.
+    """
+    n_batches = -(-n_sims // batch_size)
+    seeds = np.random.RandomState(seed).randint(
+        np.iinfo(np.int32).max, size=n_batches)
+    tasks = [(rates, min(batch_size, n_sims - i * batch_size),
+              int(batch_seed), n_events)
+             for i, batch_seed in enumerate(seeds)]
+    n_workers = parallel.worker_count(n_workers)
+    if n_workers > 1 and n_batches > 1:
+        batches = parallel.get_pool(n_workers).map(_simulate_batch, tasks)
+    else:
+        batches = map(_simulate_batch, tasks)
+    return np.concatenate(list(batches))
+
+
+def _quantile_test(name, forecast, observed, n_sims, seed, n_events,
+                   **kwargs):
+    observed_statistic = log_likelihood(forecast, observed)
+    test_distribution = simulated_log_likelihoods(
+        forecast, n_sims, seed, n_events, **kwargs)
+    quantile = float(np.mean(test_distribution <= observed_statistic))
+    return EvaluationResult(name, quantile, observed_statistic,
+                            test_distribution)
+
+
+def number_test(forecast, observed):
+    """ N-test of the total number of observed events.
+
+    :param forecast: Array of expected numbers of events.
+    :param observed: Array of observed numbers of events.
+    :returns: :py:class:`EvaluationResult` with the probabilities of at
+        least and at most the observed number of events.
+    """
+    n_forecast = float(np.sum(forecast))
+    n_observed = int(np.sum(observed))
+    quantile = (float(poisson.sf(n_observed - 1, n_forecast)),
+                float(poisson.cdf(n_observed, n_forecast)))
+    return EvaluationResult('N-Test', quantile, n_observed, n_forecast)
+
+
+def likelihood_test(forecast, observed, n_sims=1000, seed=None,
+                    **kwargs):
+    """ L-test of the joint log-likelihood of the observed events.
+
+    :param forecast: Array of shape (cells, mag) of expected numbers of
+        events.
+    :param observed: Array of observed numbers of events.
+    :param int n_sims: Number of simulated catalogs.
+    :param seed: Seed of the simulation.
+    :param kwargs: See :py:func:`simulated_log_likelihoods`.
+    :rtype: :py:class:`EvaluationResult`
+    """
+    return _quantile_test('L-Test', forecast, observed, n_sims, seed, None,
+                          **kwargs)
+
+
+def _normalized(forecast, n_observed):
+    n_forecast = np.sum(forecast)
+    return forecast * (n_observed / n_forecast if n_forecast else 0.0)
+
+
+def spatial_test(forecast, observed, n_sims=1000, seed=None, **kwargs):
+    """ S-test of the spatial distribution of the observed events.
+
+    The forecast is summed over the magnitude bins and normalized to the
+    observed number of events, see :py:func:`likelihood_test`.
+    """
+    observed = np.asarray(observed).sum(axis=-1)
+    n_observed = int(observed.sum())
+    forecast = _normalized(np.asarray(forecast).sum(axis=-1), n_observed)
+    return _quantile_test('S-Test', forecast, observed, n_sims, seed,
+                          n_observed, **kwargs)
+
+
+def magnitude_test(forecast, observed, n_sims=1000, seed=None, **kwargs):
+    """ M-test of the magnitude distribution of the observed events.
+
+    The forecast is summed over the cells and normalized to the observed
+    number of events, see :py:func:`likelihood_test`.
+    """
+    observed = np.asarray(observed).reshape(-1, np.shape(observed)[-1])
+    observed = observed.sum(axis=0)
+    n_observed = int(observed.sum())
+    forecast = np.asarray(forecast).reshape(-1, np.shape(forecast)[-1])
+    forecast = _normalized(forecast.sum(axis=0), n_observed)
+    return _quantile_test('M-Test', forecast, observed, n_sims, seed,
+                          n_observed, **kwargs)
+
+
+def evaluate_forecast(grid, catalog, scale=1.0, n_sims=1000, seed=None,
+                      **kwargs):
+    """ Run all consistency tests of a forecast grid with a catalog.
+
+    :param grid: :py:class:`ForecastGrid` of the forecast.
+    :param catalog: Observed catalog, see :py:func:`bin_catalog`.
+    :param float scale: Factor applied to the rates of the grid, see
+        :py:func:`forecast_counts`.
+    :param int n_sims: Number of simulated catalogs per test.
+    :param seed: Seed the seeds of the tests are drawn from.
+    :param kwargs: See :py:func:`simulated_log_likelihoods`.
+    :returns: Dict of the :py:class:`EvaluationResult` of every test, keyed
+        by its name.
+    """
+    forecast = forecast_counts(grid, scale)
+    observed = bin_catalog(grid, catalog)
+    seeds = np.random.RandomState(seed).randint(
+        np.iinfo(np.int32).max, size=3)
+    results = [
+        number_test(forecast, observed),
+        likelihood_test(forecast, observed, n_sims, seeds[0], **kwargs),
+        spatial_test(forecast, observed, n_sims, seeds[1], **kwargs),
+        magnitude_test(forecast, observed, n_sims, seeds[2], **kwargs)]
+    return {result.name: result for result in results}
@@ -0,0 +1,516 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Dense forecast grid facilities.
+
+A CSEP forecast XML file is translated into a dense (lon, lat, depth, mag)
+rate array. The array is compiled once into a compact binary artifact next
+to the XML file (or into a configurable cache directory), which is memory
+mapped on subsequent loads instead of parsing the XML again.
+
+The compiled artifact layout is::
+
+    MAGIC | header length (uint64, LE) | JSON header | cell mask | rates
+
+where the cell mask and the rate array are aligned to
+:py:data:`COMPILED_ALIGNMENT` bytes.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import os.path as path
+import struct
+import tempfile
+import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+CSEP_TAG_URL = "{http://www.scec.org/xml-ns/csep/forecast/0.1}"
+
+COMPILED_MAGIC = b'WERGRID\x00'
+COMPILED_VERSION = 2
+COMPILED_SUFFIX = '.grid'
+COMPILED_ALIGNMENT = 64
+# Number of decimals used when reconstructing regular cell centre axes.
+COORD_DECIMALS = 6
+# Coordinates closer than this fraction of a cell to a cell centre or edge
+# are considered to coincide with it.
+INDEX_TOLERANCE = 1e-6
+
+
+class ForecastGrid:
+    """ Dense representation of the depth layers of a CSEP forecast.
+
+    :param lons: Ascending cell centre longitudes, degrees.
+    :param lats: Ascending cell centre latitudes, degrees.
+    :param rates: Array of shape (lon, lat, depth, mag) containing the
+        expected number of events per cell, depth layer and magnitude bin,
+        or of shape (lon, lat, mag) for a single depth layer. Cells not
+        defined in the forecast have a value of zero.
+    :param present: Boolean array of shape (lon, lat), True where the
+        forecast defines a cell in any depth layer.
+    :param mag_list: Magnitude bin labels as given in the xml file.
+    :param float lon_increment: Cell width in longitude, degrees.
+    :param float lat_increment: Cell width in latitude, degrees.
+    :param float min_depth_km: Minimum altitude of all depth layers, km.
+    :param float max_depth_km: Maximum altitude of all depth layers, km.
+    :param depth_layers: Array of shape (depth, 2) of the minimum and
+        maximum altitude of every depth layer, km. Defaults to a single
+        layer between min_depth_km and max_depth_km.
+    """
+
+    def __init__(self, lons, lats, rates, present, mag_list,
+                 lon_increment, lat_increment, min_depth_km, max_depth_km,
+                 depth_layers=None):
+        self.lons = lons
+        self.lats = lats
+        if depth_layers is None:
+            depth_layers = [[min_depth_km, max_depth_km]]
+        self.depth_layers = np.asarray(depth_layers,
+                                       dtype=float).reshape(-1, 2)
+        if np.ndim(rates) == 3:
+            rates = rates[:, :, np.newaxis, :]
+        self.layer_rates = rates
+        self._rates = rates[:, :, 0, :] if rates.shape[2] == 1 else None
+        self.present = present
+        self.mag_list = list(mag_list)
+        self.lon_increment = lon_increment
+        self.lat_increment = lat_increment
+        self.min_depth_km = min_depth_km
+        self.max_depth_km = max_depth_km
+        self._layer_grid = None
+
+    @property
+    def rates(self):
+        """ Rates of shape (lon, lat, mag) summed over all depth layers. A
+        view of the layer rates if there is a single layer, otherwise
+        summed on first access, so that processes mapping a shared
+        artifact only hold a copy if they need it.
+        """
+        if self._rates is None:
+            self._rates = np.asarray(self.layer_rates).sum(axis=2)
+        return self._rates
+
+    @property
+    def shape(self):
+        n_lon, n_lat, _, n_mag = self.layer_rates.shape
+        return n_lon, n_lat, n_mag
+
+    @property
+    def nbytes(self):
+        nbytes = self.layer_rates.nbytes + self.present.nbytes
+        if len(self.depth_layers) > 1 and self._rates is not None:
+            nbytes += self._rates.nbytes
+        return nbytes
+
+    def layer_grid(self):
+        """ Grid holding the magnitude bins of all depth layers side by
+        side, i.e. with rates of shape (lon, lat, depth * mag), so that
+        all depth layers are evaluated laterally at once. The rates are a
+        view of the layer rates.
+
+        :rtype: :py:class:`ForecastGrid`
+        """
+        if len(self.depth_layers) == 1:
+            return self
+        if self._layer_grid is None:
+            n_lon, n_lat, n_depth, n_mag = self.layer_rates.shape
+            self._layer_grid = ForecastGrid(
+                self.lons, self.lats,
+                self.layer_rates.reshape(n_lon, n_lat, n_depth * n_mag),
+                self.present, self.mag_list * n_depth, self.lon_increment,
+                self.lat_increment, self.min_depth_km, self.max_depth_km)
+        return self._layer_grid
+
+    def lon_index(self, lons):
+        """ Index of the cells centred on the given longitudes, see
+        :py:func:`centre_index`.
+        """
+        return centre_index(lons, self.lons[0], self.lon_increment,
+                            len(self.lons))
+
+    def lat_index(self, lats):
+        """ Index of the cells centred on the given latitudes, see
+        :py:func:`centre_index`.
+        """
+        return centre_index(lats, self.lats[0], self.lat_increment,
+                            len(self.lats))
+
+    def lon_slice(self, min_lon, max_lon):
+        """ Slice of the cell columns overlapping a longitude interval, see
+        :py:func:`covering_slice`.
+        """
+        return covering_slice(min_lon, max_lon, self.lons[0],
+                              self.lon_increment, len(self.lons))
+
+    def lat_slice(self, min_lat, max_lat):
+        """ Slice of the cell rows overlapping a latitude interval, see
+        :py:func:`covering_slice`.
+        """
+        return covering_slice(min_lat, max_lat, self.lats[0],
+                              self.lat_increment, len(self.lats))
+
+    def header(self):
+        """ Metadata describing the grid, without the array data.
+
+        :rtype: dict
+        """
+        return {'lons': self.lons.tolist(),
+                'lats': self.lats.tolist(),
+                'mag_list': self.mag_list,
+                'lon_increment': self.lon_increment,
+                'lat_increment': self.lat_increment,
+                'min_depth_km': self.min_depth_km,
+                'max_depth_km': self.max_depth_km,
+                'depth_layers': self.depth_layers.tolist()}
+
+
+def centre_index(values, origin, increment, size):
+    """ Index of the cells of a regular axis centred on values.
+
+    :param values: Scalar or array of coordinates.
+    :param float origin: Centre of the first cell of the axis.
+    :param float increment: Cell size.
+    :param int size: Number of cells of the axis.
+    :returns: Index or array of indices, -1 where a value is not within
+        :py:data:`INDEX_TOLERANCE` of a cell centre of the axis.
+    """
+    position = (np.asarray(values) - origin) / increment
+    index = np.rint(position).astype(np.intp)
+    valid = ((np.abs(position - index) <= INDEX_TOLERANCE) &
+             (index >= 0) & (index < size))
+    return np.where(valid, index, -1)
+
+
+def covering_slice(lower, upper, origin, increment, size):
+    """ Slice of the cells of a regular axis overlapping an interval.
+
+    Cells merely touching the interval, within :py:data:`INDEX_TOLERANCE`,
+    are not included.
+
+    :param float lower: Lower bound of the interval.
+    :param float upper: Upper bound of the interval.
+    :param float origin: Centre of the first cell of the axis.
+    :param float increment: Cell size.
+    :param int size: Number of cells of the axis.
+    :rtype: slice
+    """
+    start = math.floor((lower - origin) / increment - 0.5 +
+                       INDEX_TOLERANCE) + 1
+    stop = math.ceil((upper - origin) / increment + 0.5 - INDEX_TOLERANCE)
+    start = min(max(start, 0), size)
+    return slice(start, max(min(stop, size), start))
+
+
+def _regular_axis(values, increment):
+    """ Build a regular cell centre axis covering all values.
+
+    Positions of the axis that coincide with a value keep the exact
+    value, so that equality with coordinates read from the xml file is
+    preserved.
+
+    :returns: Tuple of the axis and the axis index of every value.
+    """
+    origin = values.min()
+    index = np.rint((values - origin) / increment).astype(np.intp)
+    axis = np.round(origin + np.arange(index.max() + 1) * increment,
+                    COORD_DECIMALS)
+    axis[index] = values
+    return axis, index
+
+
+def _iter_layer_cells(xml_path, tag_url, header):
+    """ Stream the cells of all depth layers of a forecast xml file.
+
+    Elements are cleared once they are consumed, so that memory use does
+    not grow with the size of the document. The attributes of the default
+    cell dimension element and the list of the attributes of the depth
+    layer elements are collected into `header`.
+
+    :returns: Generator of tuples of the index of the depth layer, in
+        document order, and a complete cell element.
+    """
+    layer_tag = f"{tag_url}depthLayer"
+    dimension_tag = f"{tag_url}defaultCellDimension"
+    cell_tag = f"{tag_url}cell"
+    layers = header.setdefault('depthLayers', [])
+    layer = None
+    for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == layer_tag:
+                layer = elem
+                layers.append(dict(elem.attrib))
+            continue
+        if elem.tag == dimension_tag:
+            header['defaultCellDimension'] = dict(elem.attrib)
+        elif elem.tag == cell_tag and layer is not None:
+            yield len(layers) - 1, elem
+            layer.clear()
+        elif elem is layer:
+            layer.clear()
+            layer = None
+
+
+def parse_forecast_xml(xml_path, tag_url=CSEP_TAG_URL):
+    """ Parse all depth layers of a CSEP forecast xml file into a
+    :py:class:`ForecastGrid`.
+
+    The file is streamed twice: the first pass collects the cell
+    coordinates only, so that the dense rate array can be preallocated and
+    filled directly by the second pass. Peak memory use is therefore close
+    to the size of the resulting rate array.
+
+    :param str xml_path: Path to the xml file.
+    :param str tag_url: Namespace of the xml tags.
+    :rtype: :py:class:`ForecastGrid`
+    """
+    logger.info(f"Parsing xml file: {xml_path}")
+    header = {}
+    cell_lons = array('d')
+    cell_lats = array('d')
+    mag_list = None
+    for _, cell in _iter_layer_cells(xml_path, tag_url, header):
+        if mag_list is None:
+            # List of available magnitudes in model.
+            mag_list = [element.get('m') for element in cell]
+        cell_lons.append(float(cell.get('lon')))
+        cell_lats.append(float(cell.get('lat')))
+
+    lon_increment = float(header['defaultCellDimension']['lonRange'])
+    lat_increment = float(header['defaultCellDimension']['latRange'])
+    lons, lon_index = _regular_axis(
+        np.frombuffer(cell_lons, dtype=np.float64), lon_increment)
+    lats, lat_index = _regular_axis(
+        np.frombuffer(cell_lats, dtype=np.float64), lat_increment)
+    del cell_lons, cell_lats
+
+    mag_index = {mag: i for i, mag in enumerate(mag_list)}
+    # Reverse the direction of depth to altitude
+    depth_layers = np.array([[-float(layer['max']), -float(layer['min'])]
+                             for layer in header['depthLayers']])
+    rates = np.zeros((len(lons), len(lats), len(depth_layers),
+                      len(mag_list)))
+    present = np.zeros((len(lons), len(lats)), dtype=bool)
+    present[lon_index, lat_index] = True
+    cells = _iter_layer_cells(xml_path, tag_url, {})
+    for i, j, (k, cell) in zip(lon_index, lat_index, cells):
+        row = rates[i, j, k]
+        for element in cell:
+            row[mag_index[element.get('m')]] = float(element.text)
+
+    return ForecastGrid(
+        lons, lats, rates, present, mag_list,
+        lon_increment, lat_increment,
+        min_depth_km=float(depth_layers[:, 0].min()),
+        max_depth_km=float(depth_layers[:, 1].max()),
+        depth_layers=depth_layers)
+
+
+def source_identity(xml_path):
+    """ Identity of a forecast source file used to detect stale compiled
+    artifacts.
+
+    :rtype: dict
+    """
+    stat = os.stat(xml_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def compiled_path(xml_path, cache_dir=None):
+    """ Location of the compiled artifact belonging to a xml file.
+
+    :param str xml_path: Path to the xml file.
+    :param cache_dir: Directory for compiled artifacts. Defaults to the
+        directory containing the xml file.
+    """
+    return path.join(cache_dir or path.dirname(xml_path),
+                     path.basename(xml_path) + COMPILED_SUFFIX)
+
+
+def _aligned(offset):
+    return -(-offset // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
+
+
+def write_compiled_forecast(grid, out_path, source=None, tag_url=None,
+                            dtype='<f8'):
+    """ Write a :py:class:`ForecastGrid` to a compiled artifact.
+
+    The file is written to a temporary file first and moved into place,
+    so that concurrent readers never see a partially written artifact.
+
+    :param grid: :py:class:`ForecastGrid` to write.
+    :param str out_path: Path of the compiled artifact.
+    :param dict source: Identity of the source xml file, see
+        :py:func:`source_identity`.
+    :param str tag_url: Namespace of the source xml tags.
+    :param dtype: Data type the rates are stored with.
+    """
+    dtype = np.dtype(dtype)
+    header = grid.header()
+    header.update({'version': COMPILED_VERSION,
+                   'source': source,
+                   'tag_url': tag_url,
+                   'dtype': dtype.str,
+                   'shape': list(grid.layer_rates.shape)})
+    # Offsets depend on the header length, which in turn contains the
+    # offsets. Reserve enough room by encoding them at their final width.
+    header['mask_offset'] = header['rates_offset'] = 0
+    prefix_len = len(COMPILED_MAGIC) + 8
+    header_len = len(json.dumps(header).encode('utf-8')) + 64
+    header['mask_offset'] = _aligned(prefix_len + header_len)
+    header['rates_offset'] = _aligned(
+        header['mask_offset'] + grid.present.size)
+    encoded = json.dumps(header).encode('utf-8').ljust(header_len)
+
+    out_dir = path.dirname(out_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(COMPILED_MAGIC)
+            f.write(struct.pack('<Q', header_len))
+            f.write(encoded)
+            f.seek(header['mask_offset'])
+            f.write(np.ascontiguousarray(grid.present, dtype=np.uint8)
+                    .tobytes())
+            f.seek(header['rates_offset'])
+            np.ascontiguousarray(grid.layer_rates, dtype=dtype).tofile(f)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info(f"Compiled forecast grid written to: {out_path}")
+
+
+def read_compiled_header(compiled):
+    """ Read the header of a compiled artifact.
+
+    :raises ValueError: If the file is not a compiled forecast grid of
+        the supported version.
+    :rtype: dict
+    """
+    with open(compiled, 'rb') as f:
+        if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+            raise ValueError(f"Not a compiled forecast grid: {compiled}")
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header.get('version') != COMPILED_VERSION:
+        raise ValueError(
+            f"Unsupported compiled forecast version: {header.get('version')}")
+    return header
+
+
+def load_compiled_forecast(compiled, source=None, tag_url=None):
+    """ Memory map a compiled artifact.
+
+    :param str compiled: Path to the compiled artifact.
+    :param dict source: If given, the identity the artifact must have been
+        compiled from.
+    :param str tag_url: If given, the namespace the artifact must have been
+        compiled with.
+
+    :returns: The memory mapped grid, or None if the artifact is stale.
+    :rtype: :py:class:`ForecastGrid`
+    """
+    header = read_compiled_header(compiled)
+    if source is not None and header['source'] != source:
+        return None
+    if tag_url is not None and header['tag_url'] != tag_url:
+        return None
+    shape = tuple(header['shape'])
+    present = np.memmap(compiled, dtype=np.bool_, mode='r',
+                        offset=header['mask_offset'], shape=shape[:2])
+    rates = np.memmap(compiled, dtype=np.dtype(header['dtype']), mode='r',
+                      offset=header['rates_offset'], shape=shape)
+    return ForecastGrid(
+        np.array(header['lons']), np.array(header['lats']), rates, present,
+        header['mag_list'], header['lon_increment'],
+        header['lat_increment'], header['min_depth_km'],
+        header['max_depth_km'], header['depth_layers'])
+
+
+def compile_forecast(xml_path, tag_url=CSEP_TAG_URL, cache_dir=None,
+                     dtype='<f8'):
+    """ Parse a forecast xml file and write its compiled artifact.
+
+    :returns: Path of the compiled artifact.
+    """
+    source = source_identity(xml_path)
+    grid = parse_forecast_xml(xml_path, tag_url)
+    out_path = compiled_path(xml_path, cache_dir)
+    write_compiled_forecast(grid, out_path, source=source,
+                            tag_url=tag_url, dtype=dtype)
+    return out_path
+
+
+def load_forecast(xml_path, tag_url=CSEP_TAG_URL, cache_dir=None,
+                  compile=True):
+    """ Load a forecast grid, preferring the compiled artifact.
+
+    The xml file is only parsed if the compiled artifact is missing,
+    unreadable or stale, i.e. the size or modification time of the xml file
+    differ from those recorded at compile time. If `compile` is set, a
+    fresh artifact is written after parsing.
+
+    :param str xml_path: Path to the forecast xml file.
+    :param str tag_url: Namespace of the xml tags.
+    :param cache_dir: Directory for compiled artifacts. Defaults to the
+        directory containing the xml file.
+    :param bool compile: Write a compiled artifact if none is usable.
+    :rtype: :py:class:`ForecastGrid`
+    """
+    source = source_identity(xml_path)
+    compiled = compiled_path(xml_path, cache_dir)
+    try:
+        grid = load_compiled_forecast(compiled, source, tag_url)
+    except FileNotFoundError:
+        grid = None
+    except (OSError, ValueError, KeyError) as err:
+        logger.warning(f"Ignoring unreadable compiled forecast: {err}")
+        grid = None
+    else:
+        if grid is None:
+            logger.info(f"Compiled forecast is stale: {compiled}")
+    if grid is not None:
+        logger.info(f"Memory mapped compiled forecast: {compiled}")
+        return grid
+
+    grid = parse_forecast_xml(xml_path, tag_url)
+    if compile:
+        try:
+            write_compiled_forecast(grid, compiled, source=source,
+                                    tag_url=tag_url)
+        except OSError as err:
+            logger.warning(f"Unable to write compiled forecast: {err}")
+    return grid
+
+
+# ----------------------------------------------------------------------------
+def main():
+    """
+    Compile CSEP forecast xml files into memory mappable grid artifacts.
+    """
+    parser = argparse.ArgumentParser(
+        description='Compile CSEP forecast xml files.')
+    parser.add_argument('xml_files', metavar='XML', nargs='+',
+                        help='CSEP forecast xml file')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help=('Directory the artifacts are written to. '
+                              '(default: next to the xml file)'))
+    parser.add_argument('--tag-url', default=CSEP_TAG_URL,
+                        help='Namespace of the xml tags.')
+    parser.add_argument('--float32', action='store_const', dest='dtype',
+                        const='<f4', default='<f8',
+                        help='Store rates in single precision.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for xml_path in args.xml_files:
+        compile_forecast(xml_path, args.tag_url, args.cache_dir, args.dtype)
+
+
+if __name__ == '__main__':
+    main()
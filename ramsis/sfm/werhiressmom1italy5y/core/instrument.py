@@ -0,0 +1,157 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Timing of the stages of a model run.
+
+A trace is activated for the thread running a model run, stages within it
+are timed by entering spans. Spans entered while no trace is active are
+not measured. Entering a span of the same name repeatedly, e.g. once per
+result tile, accumulates its measurements.
+
+When a trace is closed, one structured log line is emitted per stage and
+the trace is kept in :py:data:`TRACES` for retrieval by its request id.
+"""
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model.timing'
+logger = logging.getLogger(LOGGER)
+
+# ru_maxrss is reported in bytes on macOS, in kilobytes elsewhere.
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+_local = threading.local()
+
+
+def thread_time():
+    """ CPU time of the calling thread in seconds.
+    """
+    return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+
+def max_rss():
+    """ Peak resident set size of this process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+class Trace:
+    """ Measurements of the stages of a model run.
+
+    :param str request_id: Identifier of the request the run belongs to.
+    """
+
+    def __init__(self, request_id=None):
+        self.request_id = str(request_id or uuid.uuid4())
+        self.stages = OrderedDict()
+        self._start = time.perf_counter()
+        self.wall_seconds = None
+
+    def record(self, name, wall_seconds, cpu_seconds, peak_rss_growth):
+        """ Add a measurement of a stage.
+        """
+        stage = self.stages.setdefault(name, {
+            'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+            'peak_rss_growth_bytes': 0})
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['peak_rss_growth_bytes'] += peak_rss_growth
+        stage['peak_rss_bytes'] = max_rss()
+
+    def close(self):
+        self.wall_seconds = time.perf_counter() - self._start
+
+    def as_dict(self):
+        return {'request_id': self.request_id,
+                'wall_seconds': self.wall_seconds,
+                'stages': [dict(stage, name=name)
+                           for name, stage in self.stages.items()]}
+
+
+class TraceStore:
+    """ Traces of the most recent model runs of this process.
+
+    :param int maxsize: Maximum number of traces kept.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._traces)
+
+    def add(self, trace):
+        with self._lock:
+            self._traces[trace.request_id] = trace
+            self._traces.move_to_end(trace.request_id)
+            while len(self._traces) > self.maxsize:
+                self._traces.popitem(last=False)
+
+    def get(self, request_id):
+        """ Return the trace of a request, or None if it is not kept.
+        """
+        with self._lock:
+            return self._traces.get(str(request_id))
+
+
+# Traces of the model runs of this process.
+TRACES = TraceStore()
+
+
+def current_trace():
+    """ Return the trace active in this thread, or None.
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def trace(request_id=None, store=TRACES):
+    """ Activate a trace for the calling thread.
+
+    :param str request_id: Identifier of the request, a new one is
+        generated if not given.
+    :param store: :py:class:`TraceStore` the closed trace is added to.
+    """
+    outer = current_trace()
+    active = Trace(request_id)
+    _local.trace = active
+    try:
+        yield active
+    finally:
+        _local.trace = outer
+        active.close()
+        for name, stage in active.stages.items():
+            logger.info(json.dumps(dict(stage, request_id=active.request_id,
+                                        stage=name)))
+        store.add(active)
+
+
+@contextmanager
+def span(name):
+    """ Time a stage of the active trace, measuring wall time, CPU time of
+    the calling thread and the growth of the peak resident set size of the
+    process.
+
+    :param str name: Name of the stage.
+    """
+    active = current_trace()
+    if active is None:
+        yield
+        return
+    rss = max_rss()
+    cpu = thread_time()
+    wall = time.perf_counter()
+    try:
+        yield
+    finally:
+        active.record(name, time.perf_counter() - wall,
+                      thread_time() - cpu, max_rss() - rss)
@@ -0,0 +1,127 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Selection and merging of the magnitude bins of a forecast.
+
+Requested magnitude bins are built from whole forecast bins: bins below the
+minimum magnitude are dropped, consecutive bins are merged into coarser
+ones and bins beyond the last requested bin are truncated. Every requested
+bin spans the same number of forecast bins, a requested range that would
+end in a partial bin is rejected. All result cells of a tile are rebinned
+at once along the magnitude axis.
+"""
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import \
+    INDEX_TOLERANCE
+from ramsis.sfm.werhiressmom1italy5y.core.regrid import RESULT_COLUMNS
+
+
+class MagnitudeBins:
+    """ Mapping of the magnitude bins of a forecast onto requested bins.
+
+    The bins of the forecast are labelled by their reference magnitudes
+    and are assumed to be equally spaced. The reference magnitude of a
+    requested bin is that of the first forecast bin it contains.
+
+    :param mag_list: Magnitude bin labels of the forecast.
+    :param min_mag: Reference magnitude of the first requested bin. Bins
+        of the forecast below it are dropped. Defaults to the first bin of
+        the forecast.
+    :param max_mag: Largest reference magnitude of the requested bins.
+        Merged bins must end on it, a whole number of increments above the
+        first one. Bins of the forecast beyond the last requested bin are
+        dropped. Defaults to the last bin of the forecast.
+    :param increment: Width of the requested bins, a multiple of the
+        width of the forecast bins. Defaults to the width of the forecast
+        bins.
+    :raises ValueError: If the requested bins can not be built from whole
+        forecast bins.
+    """
+
+    def __init__(self, mag_list, min_mag=None, max_mag=None, increment=None):
+        self.source_mag_list = list(mag_list)
+        mags = np.array([float(mag) for mag in self.source_mag_list])
+        width = mags[1] - mags[0] if len(mags) > 1 else (increment or 1.0)
+        tolerance = INDEX_TOLERANCE * width
+        if increment is None:
+            increment = width
+        factor = int(round(increment / width))
+        if factor < 1 or abs(factor * width - increment) > tolerance:
+            raise ValueError(
+                f"Magnitude increment {increment} is not a multiple of the "
+                f"forecast bin width {width:g}.")
+        first = 0 if min_mag is None else int(
+            np.searchsorted(mags, min_mag - tolerance))
+        last = len(mags) if max_mag is None else int(
+            np.searchsorted(mags, max_mag + tolerance, side='right'))
+        if first >= last:
+            raise ValueError(
+                f"No forecast magnitude bins between {min_mag} and "
+                f"{max_mag}.")
+        if max_mag is not None and factor > 1:
+            n_bins = (max_mag - mags[first]) / increment
+            if abs(n_bins - round(n_bins)) * increment > tolerance:
+                raise ValueError(
+                    f"Magnitude range {mags[first]:g} to {max_mag} is not "
+                    f"a whole multiple of the increment {increment:g}.")
+        # First forecast bin of every requested bin, and the end of the
+        # last one.
+        self.starts = np.arange(first, last, factor)
+        self.stop = self.starts[-1] + factor
+        if self.stop > len(mags):
+            raise ValueError(
+                f"Magnitude bin {self.source_mag_list[self.starts[-1]]} "
+                f"is not fully covered by the forecast bins.")
+        self.factor = factor
+        self.mag_list = [self.source_mag_list[i] for i in self.starts]
+
+    def __repr__(self):
+        return (f"{type(self).__name__}({self.mag_list[0]}, "
+                f"{self.mag_list[-1]}, {len(self.mag_list)} bins)")
+
+    @property
+    def identity(self):
+        """ Whether the requested bins are the bins of the forecast.
+        """
+        return len(self.mag_list) == len(self.source_mag_list)
+
+    @property
+    def edges(self):
+        """ Indices of the forecast bins starting the requested bins,
+        followed by the end of the last requested bin.
+        """
+        return [int(start) for start in self.starts] + [int(self.stop)]
+
+    def __call__(self, rates):
+        """ Rebin rates along their last axis.
+
+        :param rates: Array of shape (..., mag) of the forecast bins.
+        :returns: Array of shape (..., requested mag). A view of rates if
+            bins are only selected.
+        """
+        if self.identity:
+            return rates
+        if self.factor == 1:
+            return rates[..., self.starts[0]:self.stop]
+        # Sums of consecutive runs of bins rather than differences of
+        # cumulative sums, which would lose the precision of the small
+        # rates of the large magnitudes against the running total.
+        return np.add.reduceat(rates[..., :self.stop],
+                               self.starts, axis=-1)
+
+    def rebin_result(self, result, n_layers=1):
+        """ Rebin the magnitude bins of an evaluated result array.
+
+        :param result: Result array with columns
+            :py:data:`regrid.RESULT_COLUMNS` followed by the magnitude bins
+            of every depth layer.
+        :param int n_layers: Number of depth layers.
+        :returns: Result array with the requested magnitude bins of every
+            depth layer.
+        """
+        if self.identity:
+            return result
+        n_fixed = len(RESULT_COLUMNS)
+        rates = self(result[:, n_fixed:].reshape(len(result), n_layers, -1))
+        return np.concatenate(
+            [result[:, :n_fixed], rates.reshape(len(result), -1)], axis=1)
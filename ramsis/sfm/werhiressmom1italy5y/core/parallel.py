@@ -0,0 +1,195 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Evaluation of result grids in spatial tiles spread across a process pool.
+
+Worker processes do not receive the forecast grid by pickling. They memory
+map its compiled artifact, so that all processes share the pages of a
+single copy of the rates.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import (
+    COMPILED_SUFFIX, load_compiled_forecast, write_compiled_forecast)
+from ramsis.sfm.werhiressmom1italy5y.core.regrid import (
+    RegridOperatorCache, evaluate_grid)
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+# Grids published by this process are written to memory backed storage if
+# available.
+SHM_DIR = '/dev/shm'
+# Number of tiles per worker process if the tile size is not given, more
+# tiles than processes balance the load of unevenly covered tiles.
+TILES_PER_WORKER = 4
+# Number of grids a worker process keeps attached.
+MAX_ATTACHED = 4
+
+
+class SharedGrid:
+    """ Picklable handle of a forecast grid that worker processes memory
+    map rather than copy.
+
+    A grid which is already memory mapped from its compiled artifact is
+    shared as is. Any other grid is published once to a temporary artifact,
+    which is removed when the handle is garbage collected or the process
+    exits.
+
+    :param grid: :py:class:`ForecastGrid` to share.
+    """
+
+    def __init__(self, grid):
+        if isinstance(grid.layer_rates, np.memmap):
+            self.path = grid.layer_rates.filename
+            return
+        fd, self.path = tempfile.mkstemp(
+            suffix=COMPILED_SUFFIX,
+            dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+        os.close(fd)
+        weakref.finalize(self, _remove, self.path)
+        write_compiled_forecast(grid, self.path)
+        logger.debug(f"Forecast grid published to: {self.path}")
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# Grids and overlap operators attached by a worker process, keyed by the
+# artifact path, least recently used first.
+_attached = OrderedDict()
+
+
+def _attach(path):
+    """ Attach the grid of an artifact, reattaching it if the artifact was
+    replaced, e.g. recompiled from a changed xml file.
+    """
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_mtime_ns)
+    try:
+        attached_identity, grid, operators = _attached[path]
+    except KeyError:
+        pass
+    else:
+        if attached_identity == identity:
+            _attached.move_to_end(path)
+            return grid, operators
+        del _attached[path]
+    grid = load_compiled_forecast(path)
+    _attached[path] = identity, grid, RegridOperatorCache()
+    # Grids of artifacts no longer in use, e.g. temporary artifacts of
+    # released handles, are dropped eventually.
+    while len(_attached) > MAX_ATTACHED:
+        _attached.popitem(last=False)
+    return grid, _attached[path][2]
+
+
+def _evaluate_tile(args):
+    """ Evaluate a tile in a worker process, on all depth layers of the
+    forecast.
+    """
+    path, lon_edges, lat_edges, alignment = args
+    grid, operators = _attach(path)
+    return evaluate_grid(grid.layer_grid(), lon_edges, lat_edges,
+                         alignment=alignment, operators=operators)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(n_workers):
+    """ Process pool of n_workers processes, shared by all requests of
+    this process.
+
+    Worker processes are spawned rather than forked, see the server
+    application.
+    """
+    with _pools_lock:
+        try:
+            return _pools[n_workers]
+        except KeyError:
+            pass
+        logger.info(f"Starting a pool of {n_workers} model processes.")
+        pool = multiprocessing.get_context('spawn').Pool(n_workers)
+        _pools[n_workers] = pool
+        return pool
+
+
+@atexit.register
+def close_pools():
+    """ Terminate the worker processes of all pools.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.terminate()
+            pool.join()
+        _pools.clear()
+
+
+def worker_count(n_workers):
+    """ Number of worker processes to use.
+
+    :param n_workers: Configured number of processes. None, 0 or 1 for
+        serial evaluation, -1 for one process per CPU.
+    """
+    if n_workers == -1:
+        return os.cpu_count() or 1
+    return max(1, int(n_workers or 1))
+
+
+def tile_columns(n_columns, tile_size=None, n_workers=1):
+    """ Split the result cell columns into tiles.
+
+    :param int n_columns: Number of result cell columns.
+    :param tile_size: Number of columns per tile. Defaults to all columns
+        for serial evaluation, otherwise to
+        :py:data:`TILES_PER_WORKER` tiles per worker process.
+    :param int n_workers: Number of worker processes.
+    :returns: List of column slices.
+    """
+    if not tile_size:
+        tile_size = -(-n_columns // (n_workers * TILES_PER_WORKER)) \
+            if n_workers > 1 else n_columns
+    tile_size = max(tile_size, 1)
+    return [slice(start, start + tile_size)
+            for start in range(0, max(n_columns, 1), tile_size)]
+
+
+def imap_tiles(shared_grid, lon_edges, lat_edges, tiles, alignment,
+               n_workers):
+    """ Evaluate tiles of a result grid across a process pool.
+
+    :param shared_grid: :py:class:`SharedGrid` of the forecast grid.
+    :param lon_edges: Result cell longitude edges.
+    :param lat_edges: Result cell latitude edges.
+    :param tiles: Column slices, see :py:func:`tile_columns`.
+    :param alignment: :py:class:`regrid.GridAlignment` of the result grid.
+    :param int n_workers: Number of worker processes.
+    :returns: Iterator of the result arrays of the tiles, in the order of
+        the tiles.
+    """
+    tasks = []
+    for columns in tiles:
+        start, stop, _ = columns.indices(len(lon_edges) - 1)
+        tasks.append((shared_grid.path, lon_edges[start:stop + 1],
+                      lat_edges, alignment.tile(slice(start, stop))))
+    return get_pool(n_workers).imap(_evaluate_tile, tasks)
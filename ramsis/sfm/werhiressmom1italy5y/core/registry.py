@@ -0,0 +1,107 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Process wide registry of loaded forecast grids.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+
+class LocatorRegistry:
+    """ LRU registry of loaded forecast locators.
+
+    Locators are keyed by the forecast file path, the xml namespace and the
+    modification time of the file, so that a changed forecast file is
+    reloaded on the next request. The registry is bounded by the number of
+    locators held as well as optionally by their total size in bytes. Only
+    the most recently used locator is kept if it exceeds the byte bound by
+    itself.
+
+    :param factory: Callable creating a locator, called with the
+        `xml_filename` and `tag_url` keyword arguments.
+    :param int maxsize: Maximum number of locators held.
+    :param max_bytes: Maximum total size of the locators held, as reported
+        by their `nbytes` attribute. None for no bound.
+    """
+
+    def __init__(self, factory, maxsize=4, max_bytes=None):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._locators = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        # Total time spent loading locators.
+        self.load_seconds = 0.0
+
+    def __len__(self):
+        return len(self._locators)
+
+    def get(self, xml_path, tag_url):
+        """ Return the locator for a forecast file, loading it if it is
+        not registered yet.
+
+        :param str xml_path: Path to the forecast xml file.
+        :param str tag_url: Namespace of the xml tags.
+        """
+        key = (xml_path, tag_url, os.stat(xml_path).st_mtime_ns)
+        with self._lock:
+            try:
+                self._locators.move_to_end(key)
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                return self._locators[key]
+
+            self.misses += 1
+            # Drop any locator of an outdated version of the same file.
+            self._discard(xml_path, tag_url)
+            start = time.perf_counter()
+            locator = self.factory(xml_filename=xml_path, tag_url=tag_url)
+            self.load_seconds += time.perf_counter() - start
+            self._locators[key] = locator
+            self._evict()
+            return locator
+
+    def invalidate(self, xml_path=None, tag_url=None):
+        """ Remove locators from the registry.
+
+        :param xml_path: Only remove locators of this forecast file. If
+            None, all locators are removed.
+        :param tag_url: Only remove locators loaded with this namespace.
+        """
+        with self._lock:
+            if xml_path is None and tag_url is None:
+                self._locators.clear()
+            else:
+                self._discard(xml_path, tag_url)
+
+    def nbytes(self):
+        """ Total size of the registered locators in bytes.
+        """
+        with self._lock:
+            return sum(getattr(locator, 'nbytes', 0)
+                       for locator in self._locators.values())
+
+    def _discard(self, xml_path, tag_url):
+        for key in list(self._locators):
+            if ((xml_path is None or key[0] == xml_path) and
+                    (tag_url is None or key[1] == tag_url)):
+                del self._locators[key]
+
+    def _evict(self):
+        while len(self._locators) > max(self.maxsize, 1):
+            key, _ = self._locators.popitem(last=False)
+            logger.debug(f"Evicted forecast locator: {key[0]}")
+        if self.max_bytes is None:
+            return
+        while len(self._locators) > 1 and self.nbytes() > self.max_bytes:
+            key, _ = self._locators.popitem(last=False)
+            logger.debug(f"Evicted forecast locator: {key[0]}")
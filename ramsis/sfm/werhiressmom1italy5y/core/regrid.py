@@ -0,0 +1,510 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Vectorized evaluation of a forecast grid on a requested result grid.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import \
+    INDEX_TOLERANCE
+
+# Leading columns of an evaluated result array, followed by one column per
+# magnitude bin.
+RESULT_COLUMNS = ["min_lon", "max_lon", "min_lat", "max_lat", "overlap"]
+# Result cells overlapping less than this fraction of a forecast cell are
+# only 'touching' the forecast and are not returned.
+MIN_OVERLAP = 1e-3
+
+# Kinds of alignment of a result grid with a forecast grid, see
+# :py:func:`analyse_alignment`.
+IDENTICAL = 'identical'
+SUBWINDOW = 'subwindow'
+COARSENED = 'coarsened'
+ARBITRARY = 'arbitrary'
+
+
+def cell_edges(coords, half_width):
+    """ Edges of the result cells requested by a list of reservoir
+    coordinates.
+
+    The first result cell is centred on the first coordinate, every
+    further result cell extends from the end of the previous one to half a
+    forecast cell beyond the next coordinate. The last coordinate closes
+    the grid and does not start a cell of its own. Edges are rounded to
+    avoid precision errors.
+
+    :param coords: Reservoir coordinates, degrees.
+    :param float half_width: Half the forecast cell size, degrees.
+    :returns: Array of len(coords) edges describing len(coords) - 1 cells.
+    """
+    return np.array([round(coords[0] - half_width, 2)] +
+                    [round(c + half_width, 2) for c in coords[:-1]])
+
+
+def overlap_lengths(edges, centres, half_width):
+    """ Length of the overlap between every result cell and every
+    forecast cell along one axis.
+
+    :param edges: Ascending result cell edges.
+    :param centres: Ascending forecast cell centres.
+    :param float half_width: Half the forecast cell size.
+    :returns: Array of shape (len(edges) - 1, len(centres)).
+    """
+    lower = np.maximum(edges[:-1, np.newaxis],
+                       centres[np.newaxis, :] - half_width)
+    upper = np.minimum(edges[1:, np.newaxis],
+                       centres[np.newaxis, :] + half_width)
+    return np.clip(upper - lower, 0.0, None)
+
+
+def depth_weights(z_edges, depth_layers):
+    """ Fraction of every forecast depth layer covered by every requested
+    depth slice, the counterpart of :py:func:`overlap_lengths` along the
+    depth axis.
+
+    :param z_edges: Ascending altitudes of the depth slice edges, m.
+    :param depth_layers: Array of shape (depth, 2) of the minimum and
+        maximum altitude of every forecast depth layer, km.
+    :returns: Array of shape (len(z_edges) - 1, depth).
+    """
+    z_edges = np.asarray(z_edges, dtype=float) / 1000.0
+    depth_layers = np.asarray(depth_layers, dtype=float)
+    lower = np.maximum(z_edges[:-1, np.newaxis],
+                       depth_layers[np.newaxis, :, 0])
+    upper = np.minimum(z_edges[1:, np.newaxis],
+                       depth_layers[np.newaxis, :, 1])
+    return np.clip(upper - lower, 0.0, None) / \
+        (depth_layers[:, 1] - depth_layers[:, 0])
+
+
+def contract_depth(result, weights):
+    """ Distribute the rates of the depth layers of evaluated result cells
+    over the requested depth slices.
+
+    :param result: Result array with columns :py:data:`RESULT_COLUMNS`
+        followed by the magnitude bins of every depth layer, as evaluated
+        on :py:meth:`ForecastGrid.layer_grid`.
+    :param weights: Depth weight matrix, see :py:func:`depth_weights`.
+    :returns: Result array with columns :py:data:`RESULT_COLUMNS` followed
+        by the magnitude bins, with a row per result cell and depth slice,
+        ordered by cell, then by depth slice.
+    """
+    n_slices, n_layers = weights.shape
+    if n_slices == 1 and n_layers == 1 and weights[0, 0] == 1.0:
+        return result
+    n_cells = len(result)
+    layer_rates = result[:, len(RESULT_COLUMNS):].reshape(
+        n_cells, n_layers, -1)
+    contracted = np.empty((n_cells * n_slices, len(RESULT_COLUMNS) +
+                           layer_rates.shape[-1]))
+    contracted[:, :len(RESULT_COLUMNS)] = np.repeat(
+        result[:, :len(RESULT_COLUMNS)], n_slices, axis=0)
+    contracted[:, len(RESULT_COLUMNS):] = np.einsum(
+        'sl,clm->csm', weights, layer_rates).reshape(n_cells * n_slices, -1)
+    return contracted
+
+
+def _result_array(lon_edges, lat_edges, keep, overlap, rates):
+    """ Assemble the result array of the result cells selected by keep,
+    ordered by longitude first, then latitude.
+
+    :param keep: Boolean array of shape (lon, lat) of the result cells
+        returned.
+    :param overlap: Overlap of each returned result cell.
+    :param rates: Array of shape (cells, mag) of the returned result cells.
+    """
+    lon_index, lat_index = np.nonzero(keep)
+    result = np.empty((len(lon_index), len(RESULT_COLUMNS) +
+                       rates.shape[-1]))
+    result[:, 0] = lon_edges[lon_index]
+    result[:, 1] = lon_edges[lon_index + 1]
+    result[:, 2] = lat_edges[lat_index]
+    result[:, 3] = lat_edges[lat_index + 1]
+    result[:, 4] = overlap
+    result[:, len(RESULT_COLUMNS):] = rates
+    return result
+
+
+class GridAlignment:
+    """ Alignment of a result grid with the cells of a forecast grid.
+
+    Along an aligned axis every result cell edge coincides with a forecast
+    cell edge, so that every result cell spans a whole number of forecast
+    cells. Edges are given by the index of the forecast cell edge they
+    coincide with, which may lie outside of the forecast.
+
+    :param str kind: One of :py:data:`IDENTICAL`, result cell (i, j) is
+        forecast cell (i, j), :py:data:`SUBWINDOW`, result cells are the
+        forecast cells of an offset window, :py:data:`COARSENED`, result
+        cells are blocks of forecast cells, or :py:data:`ARBITRARY`.
+    :param lon_index: Forecast edge indices of the result longitude edges.
+    :param lat_index: Forecast edge indices of the result latitude edges.
+    """
+
+    def __init__(self, kind, lon_index=None, lat_index=None):
+        self.kind = kind
+        self.lon_index = lon_index
+        self.lat_index = lat_index
+
+    @property
+    def aligned(self):
+        return self.kind != ARBITRARY
+
+    def tile(self, columns):
+        """ Alignment of a tile of the result grid.
+
+        :param columns: Slice of the result cell columns of the tile.
+        """
+        if not self.aligned:
+            return self
+        start, stop, _ = columns.indices(len(self.lon_index) - 1)
+        lon_index = self.lon_index[start:stop + 1]
+        kind = self.kind
+        if kind == IDENTICAL and start:
+            kind = SUBWINDOW
+        return GridAlignment(kind, lon_index, self.lat_index)
+
+    def __repr__(self):
+        if not self.aligned:
+            return f"<GridAlignment {self.kind}>"
+        return (f"<GridAlignment {self.kind} "
+                f"lon={self.lon_index[0]}:{self.lon_index[-1]} "
+                f"lat={self.lat_index[0]}:{self.lat_index[-1]}>")
+
+
+def _edge_index(edges, centres, increment, tolerance):
+    """ Forecast cell edge indices of result cell edges along an axis, or
+    None if the axis is not aligned.
+    """
+    if len(edges) < 2:
+        return None
+    position = (np.asarray(edges, dtype=float) -
+                (centres[0] - increment / 2.0)) / increment
+    index = np.round(position)
+    if np.any(np.abs(position - index) > tolerance) or \
+            np.any(np.diff(index) < 1):
+        return None
+    return index.astype(int)
+
+
+def analyse_alignment(grid, lon_edges, lat_edges,
+                      tolerance=INDEX_TOLERANCE):
+    """ Classify how a result grid lines up with a forecast grid.
+
+    Aligned result grids are evaluated by slicing or summing blocks of the
+    forecast rates, see :py:func:`evaluate_aligned`, rather than through
+    overlap weights.
+
+    :param grid: :py:class:`ForecastGrid` evaluated.
+    :param lon_edges: Result cell longitude edges, see :py:func:`cell_edges`.
+    :param lat_edges: Result cell latitude edges.
+    :param float tolerance: Distance, as a fraction of a forecast cell,
+        within which edges are considered to coincide.
+    :rtype: :py:class:`GridAlignment`
+    """
+    lon_index = _edge_index(lon_edges, grid.lons, grid.lon_increment,
+                            tolerance)
+    lat_index = _edge_index(lat_edges, grid.lats, grid.lat_increment,
+                            tolerance)
+    if lon_index is None or lat_index is None:
+        return GridAlignment(ARBITRARY)
+    if np.any(np.diff(lon_index) != 1) or np.any(np.diff(lat_index) != 1):
+        kind = COARSENED
+    elif lon_index[0] == 0 and lat_index[0] == 0:
+        kind = IDENTICAL
+    else:
+        kind = SUBWINDOW
+    return GridAlignment(kind, lon_index, lat_index)
+
+
+def _covered_cells(index, size):
+    """ Result cells along an aligned axis covering forecast cells.
+
+    :returns: Tuple of the slice of the covering result cells and the
+        forecast cell index each of them starts at, followed by the index
+        the last one ends at.
+    """
+    bounds = np.clip(index, 0, size)
+    covering = np.flatnonzero(bounds[1:] > bounds[:-1])
+    if not len(covering):
+        return slice(0, 0), bounds[:1]
+    first, last = covering[0], covering[-1] + 1
+    return slice(first, last), bounds[first:last + 1]
+
+
+def evaluate_aligned(grid, lon_edges, lat_edges, alignment, columns=None):
+    """ Evaluate a grid aligned with the forecast grid.
+
+    Result cells of a window of forecast cells are read from a view of the
+    forecast rates, result cells of coarsened grids are the sums of blocks
+    of forecast cells, with an overlap of the number of forecast cells
+    defined in the block.
+
+    :param grid: :py:class:`ForecastGrid` to evaluate.
+    :param lon_edges: Result cell longitude edges, see :py:func:`cell_edges`.
+    :param lat_edges: Result cell latitude edges.
+    :param alignment: Aligned :py:class:`GridAlignment` of the result grid,
+        see :py:func:`analyse_alignment`.
+    :param columns: Optional slice of the result cell columns to evaluate.
+    :returns: Result array with columns :py:data:`RESULT_COLUMNS` followed
+        by the magnitude bins.
+    """
+    start, stop, _ = (columns or slice(None)).indices(len(lon_edges) - 1)
+    lon_edges = lon_edges[start:stop + 1]
+    lon_cells, lon_bounds = _covered_cells(
+        alignment.lon_index[start:stop + 1], len(grid.lons))
+    lat_cells, lat_bounds = _covered_cells(alignment.lat_index,
+                                           len(grid.lats))
+    window = (slice(lon_bounds[0], lon_bounds[-1]),
+              slice(lat_bounds[0], lat_bounds[-1]))
+
+    keep = np.zeros((len(lon_edges) - 1, len(lat_edges) - 1), dtype=bool)
+    if alignment.kind != COARSENED:
+        present = grid.present[window]
+        keep[lon_cells, lat_cells] = present
+        return _result_array(lon_edges, lat_edges, keep,
+                             np.ones(np.count_nonzero(keep)),
+                             grid.rates[window][present])
+
+    def block_sums(values):
+        values = np.add.reduceat(values, lon_bounds[:-1] - lon_bounds[0],
+                                 axis=0)
+        return np.add.reduceat(values, lat_bounds[:-1] - lat_bounds[0],
+                               axis=1)
+    if len(lon_bounds) > 1 and len(lat_bounds) > 1:
+        counts = block_sums(np.asarray(grid.present[window], dtype=float))
+        covered = counts >= MIN_OVERLAP
+        keep[lon_cells, lat_cells] = covered
+        rates = block_sums(grid.rates[window])[covered]
+        overlap = counts[covered]
+    else:
+        rates = np.zeros((0, len(grid.mag_list)))
+        overlap = np.zeros(0)
+    return _result_array(lon_edges, lat_edges, keep, overlap, rates)
+
+
+class SummedAreaTable:
+    """ Summed-area tables of the rates of every magnitude bin and of the
+    defined cells of a forecast grid, integrating the forecast over any
+    axis aligned box in constant time.
+
+    The tables are accumulated in extended precision, where available, so
+    that the differences of large sums taken for small boxes keep the
+    precision of summing their cells directly.
+
+    :param grid: :py:class:`ForecastGrid` to integrate.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        n_lon, n_lat = grid.present.shape
+        self.rates = np.zeros((n_lon + 1, n_lat + 1, len(grid.mag_list)),
+                              dtype=np.longdouble)
+        np.cumsum(grid.rates, axis=0, dtype=np.longdouble,
+                  out=self.rates[1:, 1:])
+        np.cumsum(self.rates[1:, 1:], axis=1, out=self.rates[1:, 1:])
+        self.present = np.zeros((n_lon + 1, n_lat + 1), dtype=np.int64)
+        self.present[1:, 1:] = np.cumsum(np.cumsum(grid.present, axis=0),
+                                         axis=1)
+
+    @property
+    def nbytes(self):
+        return self.rates.nbytes + self.present.nbytes
+
+    def _block(self, table, lon_start, lon_stop, lat_start, lat_stop):
+        return (table[lon_stop, lat_stop] - table[lon_start, lat_stop] -
+                table[lon_stop, lat_start] + table[lon_start, lat_start])
+
+    @staticmethod
+    def _terms(cells, lower, upper, centres, half_width):
+        """ Weighted index ranges along an axis adding up to the covered
+        fraction of every cell: all cells fully, corrected by the fractions
+        of the first and last cell.
+        """
+        start, stop = cells.start, cells.stop
+        if stop <= start:
+            return []
+        fractions = overlap_lengths(
+            np.array([lower, upper]), centres[[start, stop - 1]],
+            half_width)[0] / (2.0 * half_width)
+        if stop - start == 1:
+            return [(start, stop, fractions[0])]
+        return [(start, stop, 1.0),
+                (start, start + 1, fractions[0] - 1.0),
+                (stop - 1, stop, fractions[1] - 1.0)]
+
+    def integrate(self, min_lon, max_lon, min_lat, max_lat):
+        """ Integrate the forecast over a box, weighting every forecast
+        cell by the fraction of it covered by the box.
+
+        :returns: Tuple of the covered fraction of defined cells, summed,
+            and the array of the integrated rates per magnitude bin.
+        """
+        grid = self.grid
+        lon_terms = self._terms(grid.lon_slice(min_lon, max_lon), min_lon,
+                                max_lon, grid.lons, grid.lon_increment / 2.0)
+        lat_terms = self._terms(grid.lat_slice(min_lat, max_lat), min_lat,
+                                max_lat, grid.lats, grid.lat_increment / 2.0)
+        overlap = 0.0
+        rates = np.zeros(len(grid.mag_list), dtype=np.longdouble)
+        for lon_start, lon_stop, lon_weight in lon_terms:
+            for lat_start, lat_stop, lat_weight in lat_terms:
+                weight = lon_weight * lat_weight
+                if not weight:
+                    continue
+                overlap += weight * self._block(
+                    self.present, lon_start, lon_stop, lat_start, lat_stop)
+                rates += weight * self._block(
+                    self.rates, lon_start, lon_stop, lat_start, lat_stop)
+        return float(overlap), rates.astype(float)
+
+
+class RegridOperator:
+    """ Sparse overlap weight matrix mapping the cells of a forecast grid
+    onto the cells of a result grid.
+
+    Row `a * n_lat + b` of the matrix holds the fraction of every forecast
+    cell covered by result cell (a, b). As the cells are axis aligned, the
+    matrix is the Kronecker product of the overlaps along each axis. Only
+    rows of result cells overlapping the forecast are kept.
+
+    :param grid: :py:class:`ForecastGrid` to map from.
+    :param lon_edges: Result cell longitude edges, see :py:func:`cell_edges`.
+    :param lat_edges: Result cell latitude edges.
+    """
+
+    def __init__(self, grid, lon_edges, lat_edges):
+        self.lon_edges = lon_edges
+        self.lat_edges = lat_edges
+        dx = overlap_lengths(lon_edges, grid.lons, grid.lon_increment / 2.0)
+        dy = overlap_lengths(lat_edges, grid.lats, grid.lat_increment / 2.0)
+        cell_area = grid.lon_increment * grid.lat_increment
+
+        weights = sparse.kron(sparse.csr_matrix(dx), sparse.csr_matrix(dy),
+                              format='csr') / cell_area
+        overlap = weights.dot(
+            np.asarray(grid.present, dtype=float).ravel())
+        self.keep = (overlap >= MIN_OVERLAP).reshape(len(dx), len(dy))
+        rows = np.flatnonzero(self.keep)
+        self.overlap = overlap[rows]
+        self.weights = weights[rows]
+        # First row of the kept result cells of every result cell column.
+        self.column_offsets = np.concatenate(
+            [[0], np.cumsum(self.keep.sum(axis=1))])
+
+    @property
+    def nbytes(self):
+        return (self.weights.data.nbytes + self.weights.indices.nbytes +
+                self.weights.indptr.nbytes + self.overlap.nbytes +
+                self.keep.nbytes + self.column_offsets.nbytes)
+
+    def __call__(self, grid, columns=None):
+        """ Evaluate the forecast grid on the result grid.
+
+        :param columns: Optional slice of the result cell columns, i.e.
+            longitude intervals, to evaluate.
+        :returns: Result array with columns :py:data:`RESULT_COLUMNS`
+            followed by the magnitude bins.
+        """
+        start, stop, _ = (columns or slice(None)).indices(len(self.keep))
+        rows = slice(self.column_offsets[start], self.column_offsets[stop])
+        rates = np.asarray(grid.rates).reshape(-1, len(grid.mag_list))
+        return _result_array(self.lon_edges[start:stop + 1], self.lat_edges,
+                             self.keep[start:stop], self.overlap[rows],
+                             self.weights[rows].dot(rates))
+
+
+class RegridOperatorCache:
+    """ LRU cache of :py:class:`RegridOperator` instances of a single
+    forecast grid, keyed by the result grid edges. Repeated requests on the
+    same result grid only cost the sparse matrix product.
+
+    :param int maxsize: Maximum number of operators held.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._operators = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._operators)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(operator.nbytes
+                       for operator in self._operators.values())
+
+    def get(self, grid, lon_edges, lat_edges):
+        key = (tuple(lon_edges), tuple(lat_edges))
+        with self._lock:
+            try:
+                self._operators.move_to_end(key)
+                return self._operators[key]
+            except KeyError:
+                pass
+        operator = RegridOperator(grid, lon_edges, lat_edges)
+        with self._lock:
+            self._operators[key] = operator
+            while len(self._operators) > self.maxsize:
+                self._operators.popitem(last=False)
+        return operator
+
+    def clear(self):
+        with self._lock:
+            self._operators.clear()
+
+
+def evaluate_overlap(grid, lon_edges, lat_edges, operators=None,
+                     columns=None):
+    """ Evaluate a grid whose result cells do not coincide with forecast
+    cells.
+
+    The contribution of every forecast cell to a result cell is weighted
+    by the fraction of the forecast cell covered by the result cell, see
+    :py:class:`RegridOperator`.
+
+    :param grid: :py:class:`ForecastGrid` to evaluate.
+    :param lon_edges: Result cell longitude edges, see :py:func:`cell_edges`.
+    :param lat_edges: Result cell latitude edges.
+    :param operators: Optional :py:class:`RegridOperatorCache` of the grid,
+        used to reuse the weight matrix of a previously requested result
+        grid.
+    :param columns: Optional slice of the result cell columns to evaluate.
+    :returns: Result array with columns :py:data:`RESULT_COLUMNS` followed
+        by the magnitude bins.
+    """
+    if operators is None:
+        operator = RegridOperator(grid, lon_edges, lat_edges)
+    else:
+        operator = operators.get(grid, lon_edges, lat_edges)
+    return operator(grid, columns)
+
+
+def evaluate_grid(grid, lon_edges, lat_edges, operators=None,
+                  columns=None, alignment=None):
+    """ Evaluate a forecast grid on a requested result grid.
+
+    :param grid: :py:class:`ForecastGrid` to evaluate.
+    :param lon_edges: Result cell longitude edges, see :py:func:`cell_edges`.
+    :param lat_edges: Result cell latitude edges.
+    :param operators: Optional :py:class:`RegridOperatorCache` of the grid.
+    :param columns: Optional slice of the result cell columns, i.e.
+        longitude intervals, to evaluate. Allows evaluating a result grid
+        in tiles.
+    :param alignment: Optional :py:class:`GridAlignment` of the result
+        grid, analysed with :py:func:`analyse_alignment` if not given.
+    :returns: Result array with columns :py:data:`RESULT_COLUMNS` followed
+        by the magnitude bins, with a row per result cell that overlaps the
+        forecast.
+    """
+    if alignment is None:
+        alignment = analyse_alignment(grid, lon_edges, lat_edges)
+    if alignment.aligned:
+        return evaluate_aligned(grid, lon_edges, lat_edges, alignment,
+                                columns)
+    return evaluate_overlap(grid, lon_edges, lat_edges, operators, columns)
@@ -0,0 +1,204 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Content addressed cache of model outputs.
+
+The output of the model only depends on the requested reservoir geometry
+and the forecast file, not on the forecast time window. Outputs are keyed
+by a hash of both, held in an LRU cache and optionally spilled to disk
+when evicted.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import (
+    CSEP_TAG_URL, source_identity)
+from ramsis.sfm.werhiressmom1italy5y.core.regrid import RESULT_COLUMNS
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+SPILL_SUFFIX = '.npz'
+
+
+def result_key(reservoir_geom, xml_path, tag_url=CSEP_TAG_URL,
+               mag_bins=None):
+    """ Key of the model output for a reservoir geometry and a version of
+    a forecast file.
+
+    :param reservoir_geom: Reservoir geometry with coordinate lists 'x',
+        'y' and 'z'.
+    :param str xml_path: Path to the forecast xml file.
+    :param str tag_url: Namespace of the xml tags.
+    :param mag_bins: :py:class:`MagnitudeBins` of the requested
+        magnitude bins, None for the bins of the forecast. Keyed by the
+        forecast bins they are built from, so that equivalent requests
+        share their output.
+    :rtype: str
+    """
+    key = json.dumps({
+        'geom': [[float(v) for v in reservoir_geom[axis]]
+                 for axis in ('x', 'y', 'z')],
+        'mag_bins': (None if mag_bins is None or mag_bins.identity
+                     else mag_bins.edges),
+        'forecast': [path.realpath(xml_path), tag_url,
+                     source_identity(xml_path)]}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """ LRU cache of model outputs, i.e. tuples of the result DataFrame,
+    the magnitude bins, the magnitude of completeness and the depth of the
+    forecast.
+
+    Cached DataFrames are shared between callers and must not be modified.
+
+    :param int maxsize: Maximum number of outputs held in memory.
+    :param max_bytes: Maximum total size of the DataFrames held in memory.
+        None for no bound.
+    :param spill_dir: Directory outputs evicted from memory are written
+        to, and read back from on a later request. None to drop evicted
+        outputs.
+    :param int max_spilled: Maximum number of outputs kept in spill_dir,
+        the least recently written are removed first.
+    """
+
+    def __init__(self, maxsize=16, max_bytes=None, spill_dir=None,
+                 max_spilled=256):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        self._outputs = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def nbytes(self):
+        with self._lock:
+            return sum(_nbytes(output) for output in self._outputs.values())
+
+    def get(self, key):
+        """ Return the output of a key, or None if it is not cached.
+        """
+        with self._lock:
+            try:
+                self._outputs.move_to_end(key)
+            except KeyError:
+                output = self._load(key)
+            else:
+                output = self._outputs[key]
+            if output is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key not in self._outputs:
+                self._outputs[key] = output
+                self._evict()
+            return output
+
+    def put(self, key, output):
+        """ Cache the output of a key.
+        """
+        with self._lock:
+            self._outputs[key] = output
+            self._outputs.move_to_end(key)
+            self._evict()
+
+    def configure(self, maxsize, spill_dir):
+        """ Change the bound and the spill directory of the cache.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self.spill_dir = spill_dir
+            self._evict()
+
+    def clear(self):
+        """ Remove all outputs held in memory. Spilled outputs are kept.
+        """
+        with self._lock:
+            self._outputs.clear()
+
+    def _evict(self):
+        while len(self._outputs) > self.maxsize or (
+                self.max_bytes is not None and len(self._outputs) > 1 and
+                self.nbytes() > self.max_bytes):
+            key, output = self._outputs.popitem(last=False)
+            self._spill(key, output)
+
+    def _spill_path(self, key):
+        return path.join(self.spill_dir, key + SPILL_SUFFIX)
+
+    def _spill(self, key, output):
+        if self.spill_dir is None or path.exists(self._spill_path(key)):
+            return
+        returned_df, mag_list, mc, depth_km = output
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.spill_dir,
+                                            suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, values=returned_df.values,
+                             mag_list=np.array(mag_list, dtype=str),
+                             scalars=np.array([mc, depth_km], dtype=float))
+                os.replace(tmp_path, self._spill_path(key))
+            except BaseException:
+                _remove(tmp_path)
+                raise
+        except OSError as err:
+            logger.warning(f"Unable to spill model output: {err}")
+            return
+
+        # The spill directory may be shared by several processes.
+        spilled = []
+        for spill_path in glob.glob(path.join(self.spill_dir,
+                                              '*' + SPILL_SUFFIX)):
+            try:
+                spilled.append((path.getmtime(spill_path), spill_path))
+            except FileNotFoundError:
+                pass
+        spilled.sort()
+        for _, spill_path in spilled[:max(len(spilled) -
+                                          self.max_spilled, 0)]:
+            _remove(spill_path)
+
+    def _load(self, key):
+        if self.spill_dir is None:
+            return None
+        try:
+            with np.load(self._spill_path(key), allow_pickle=False) as f:
+                mag_list = f['mag_list'].tolist()
+                mc, depth_km = f['scalars'].tolist()
+                returned_df = pd.DataFrame(
+                    f['values'], columns=RESULT_COLUMNS + mag_list)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning(f"Ignoring unreadable spilled model output: "
+                           f"{err}")
+            return None
+        return returned_df, mag_list, mc, depth_km
+
+
+def _nbytes(output):
+    return output[0].memory_usage(index=True).sum()
+
+
+def _remove(file_path):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,136 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Forecast grids shared by all processes of a host through named shared
+memory segments.
+
+The first process loading a forecast publishes its compiled grid to a
+segment in memory backed storage, named after the forecast file and its
+version. Other processes memory map the same segment, so that memory use
+per host does not grow with the number of processes.
+
+Segments are reference counted by means of file locks: every attached
+process holds a shared lock on its segment. A process detaching removes
+the segment if it can acquire an exclusive lock, i.e. if it was the last
+one attached. Locks of crashed processes are released by the kernel.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import weakref
+from os import path
+
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import (
+    COMPILED_SUFFIX, CSEP_TAG_URL, load_compiled_forecast, load_forecast,
+    source_identity, write_compiled_forecast)
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+# Memory backed storage of the segments, /dev/shm is where POSIX shared
+# memory objects live on Linux.
+SHM_DIR = '/dev/shm' if path.isdir('/dev/shm') else tempfile.gettempdir()
+SEGMENT_PREFIX = 'ramsis-wergrid-'
+
+
+def segment_name(xml_path, tag_url=CSEP_TAG_URL):
+    """ Name of the segment of a forecast version, shared by all processes
+    loading the same forecast file.
+    """
+    key = json.dumps([path.realpath(xml_path), tag_url,
+                      source_identity(xml_path)], sort_keys=True)
+    return (SEGMENT_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest() +
+            COMPILED_SUFFIX)
+
+
+class _Guard:
+    """ Exclusive lock serialising publishing and removing a segment
+    between processes.
+    """
+
+    def __init__(self, segment_path):
+        self.lock_path = segment_path + '.lock'
+
+    def __enter__(self):
+        while True:
+            self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            # The lock file may have been removed while waiting for it.
+            try:
+                if os.fstat(self.fd).st_ino == os.stat(self.lock_path).st_ino:
+                    return self
+            except FileNotFoundError:
+                pass
+            os.close(self.fd)
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+    def remove(self):
+        """ Remove the lock file while holding it.
+        """
+        os.unlink(self.lock_path)
+
+
+class SharedForecast:
+    """ Attachment of this process to the shared memory segment of a
+    forecast.
+
+    :param str xml_path: Path to the forecast xml file.
+    :param str tag_url: Namespace of the xml tags.
+    :param cache_dir: Directory of the compiled artifact used to publish
+        the segment, see :py:func:`load_forecast`.
+    :param str shm_dir: Directory of the segments.
+    """
+
+    def __init__(self, xml_path, tag_url=CSEP_TAG_URL, cache_dir=None,
+                 shm_dir=SHM_DIR):
+        source = source_identity(xml_path)
+        self.path = path.join(shm_dir, segment_name(xml_path, tag_url))
+        with _Guard(self.path):
+            try:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Publish the grid, preferring its compiled artifact.
+                grid = load_forecast(xml_path, tag_url=tag_url,
+                                     cache_dir=cache_dir)
+                write_compiled_forecast(grid, self.path, source=source,
+                                        tag_url=tag_url)
+                os.chmod(self.path, 0o644)
+                self._fd = os.open(self.path, os.O_RDONLY)
+                logger.info(f"Forecast grid published to: {self.path}")
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+        self.grid = load_compiled_forecast(self.path, source, tag_url)
+        # Also detaches at exit.
+        self._finalizer = weakref.finalize(self, _detach, self.path,
+                                           self._fd, os.getpid())
+
+    def close(self):
+        """ Detach from the segment, removing it if this was the last
+        process attached. The grid remains readable by this process.
+        """
+        self._finalizer()
+
+
+def _detach(segment_path, fd, pid):
+    if os.getpid() != pid:
+        # A forked process shares the lock of its parent rather than
+        # holding its own.
+        return
+    with _Guard(segment_path) as guard:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass
+        else:
+            # No other process is attached.
+            try:
+                os.unlink(segment_path)
+                logger.info(f"Removed forecast grid segment: {segment_path}")
+            except FileNotFoundError:
+                pass
+            guard.remove()
+        finally:
+            os.close(fd)
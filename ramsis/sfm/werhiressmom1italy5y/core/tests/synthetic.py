@@ -0,0 +1,67 @@
+"""
+Synthetic CSEP forecast xml files, so that tests do not depend on the
+original forecast data.
+"""
+import numpy as np
+
+CSEP_NS = "http://www.scec.org/xml-ns/csep/forecast/0.1"
+
+
+def write_csep_xml(filename, lon_min=5.55, lat_min=35.85, n_lon=20,
+                   n_lat=15, increment=0.1, mags=None, depth=(0.0, 30.0),
+                   missing_fraction=0.2, seed=0, layers=None):
+    """ Write a synthetic CSEP forecast xml file.
+
+    :param filename: Path of the xml file to write.
+    :param float lon_min: Centre longitude of the first cell column.
+    :param float lat_min: Centre latitude of the first cell row.
+    :param int n_lon: Number of cell columns.
+    :param int n_lat: Number of cell rows.
+    :param float increment: Cell size in both directions, degrees.
+    :param mags: Magnitude bin labels. Defaults to the Italy model bins.
+    :param tuple depth: (min, max) depth of a single layer, km.
+    :param layers: List of (min, max) depths of several layers, km. Takes
+        precedence over depth.
+    :param float missing_fraction: Fraction of cells randomly left out of
+        the forecast.
+    :param int seed: Seed of the random rates and missing cells.
+
+    :returns: Tuple of the cell centre lons, lats and the dense rate array
+        of shape (lon, lat, mag) with NaN for missing cells, of shape
+        (lon, lat, depth, mag) if layers are given.
+    """
+    if mags is None:
+        mags = [f"{m:.2f}" for m in np.arange(4.95, 9.05, 0.1)]
+    rng = np.random.RandomState(seed)
+    lons = np.round(lon_min + np.arange(n_lon) * increment, 2)
+    lats = np.round(lat_min + np.arange(n_lat) * increment, 2)
+    n_layers = 1 if layers is None else len(layers)
+    rates = rng.uniform(1e-6, 1e-2,
+                        size=(n_lon, n_lat, n_layers, len(mags)))
+    rates[rng.uniform(size=(n_lon, n_lat)) < missing_fraction] = np.nan
+
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<CSEPForecast xmlns="{CSEP_NS}">\n'
+                '<forecastData publicID="smi:synthetic">\n'
+                '<modelName>synthetic</modelName>\n'
+                f'<defaultCellDimension latRange="{increment}" '
+                f'lonRange="{increment}"/>\n'
+                '<defaultMagBinDimension>0.1</defaultMagBinDimension>\n'
+                '<lastMagBinOpen>1</lastMagBinOpen>\n')
+        for layer, (min_depth, max_depth) in enumerate(layers or [depth]):
+            f.write(f'<depthLayer max="{max_depth}" min="{min_depth}">\n')
+            for i, lon in enumerate(lons):
+                for j, lat in enumerate(lats):
+                    if np.isnan(rates[i, j, layer, 0]):
+                        continue
+                    f.write(f'<cell lat="{lat}" lon="{lon}">\n')
+                    for k, mag in enumerate(mags):
+                        rate = float(rates[i, j, layer, k])
+                        f.write(f'<bin m="{mag}">{rate!r}</bin>\n')
+                    f.write('</cell>\n')
+            f.write('</depthLayer>\n')
+        f.write('</forecastData>\n</CSEPForecast>\n')
+    if layers is None:
+        rates = rates[:, :, 0, :]
+    return lons, lats, rates
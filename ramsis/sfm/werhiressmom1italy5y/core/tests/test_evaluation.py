@@ -0,0 +1,136 @@
+"""
+Tests for the consistency tests of the forecast with a catalog.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.stats import poisson
+
+from ramsis.sfm.werhiressmom1italy5y.core import evaluation, parallel
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import \
+    parse_forecast_xml
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+class EvaluationTestCase(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel.close_pools()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        self.lons, self.lats, self.rates = write_csep_xml(xml_path)
+        self.grid = parse_forecast_xml(xml_path)
+        self.present = ~np.isnan(self.rates[:, :, 0])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def catalog(self, n_events, seed=0):
+        """ Catalog drawn from the forecast cells, one event per draw.
+        """
+        rng = np.random.RandomState(seed)
+        lon_index, lat_index = np.nonzero(self.present)
+        cells = rng.randint(len(lon_index), size=n_events)
+        return pd.DataFrame({
+            'mag': 4.95 + rng.randint(41, size=n_events) * 0.1 + 0.05,
+            'lat': self.lats[lat_index[cells]] + rng.uniform(
+                -0.049, 0.049, size=n_events),
+            'lon': self.lons[lon_index[cells]] + rng.uniform(
+                -0.049, 0.049, size=n_events),
+            'depth': rng.uniform(0.0, 30000.0, size=n_events)})
+
+    def test_bin_catalog(self):
+        i, j = [index[0] for index in np.nonzero(self.present)]
+        lon, lat = self.lons[i], self.lats[j]
+        catalog = pd.DataFrame({
+            'mag': [5.0, 5.0, 12.0, 4.0, 5.0, 5.0],
+            'lat': [lat, lat + 0.04, lat, lat, lat, lat],
+            'lon': [lon, lon - 0.04, lon, lon, lon - 10.0, lon],
+            'depth': [1000.0, 2000.0, 3000.0, 1000.0, 1000.0, 40000.0]})
+        observed = evaluation.bin_catalog(self.grid, catalog)
+        forecast = evaluation.forecast_counts(self.grid)
+        self.assertEqual(observed.shape, forecast.shape)
+        self.assertEqual(observed.sum(), 3)
+        # The cell is the first one defined by the forecast.
+        self.assertEqual(observed[0, 0], 2)
+        self.assertEqual(observed[0, -1], 1)
+        self.assertEqual(
+            evaluation.bin_catalog(self.grid, catalog,
+                                   last_bin_open=False).sum(), 2)
+
+    def test_log_likelihood(self):
+        forecast = evaluation.forecast_counts(self.grid, scale=50.0)
+        observed = evaluation.bin_catalog(self.grid, self.catalog(200))
+        self.assertAlmostEqual(
+            evaluation.log_likelihood(forecast, observed),
+            poisson.logpmf(observed, forecast).sum(), places=8)
+        forecast[observed > 0] = 0.0
+        self.assertEqual(evaluation.log_likelihood(forecast, observed),
+                         -np.inf)
+
+    def test_simulate_log_likelihoods(self):
+        # All events of a catalog fall into the single bin.
+        np.testing.assert_allclose(
+            evaluation.simulate_log_likelihoods([3.0], 4, seed=0,
+                                                n_events=5),
+            poisson.logpmf(5, 3.0))
+
+        # Simulated catalogs are distributed like the forecast.
+        rates = np.array([0.5, 0.0, 2.0, 0.25])
+        simulated = evaluation.simulate_log_likelihoods(rates, 20000, 1)
+        rng = np.random.RandomState(2)
+        expected = poisson.logpmf(
+            rng.poisson(rates, size=(20000, len(rates))), rates).sum(axis=1)
+        self.assertAlmostEqual(simulated.mean(), expected.mean(), places=1)
+        self.assertAlmostEqual(simulated.std(), expected.std(), places=1)
+
+    def test_batches(self):
+        forecast = evaluation.forecast_counts(self.grid, scale=10.0)
+        simulated = evaluation.simulated_log_likelihoods(
+            forecast, 250, seed=3, batch_size=100)
+        self.assertEqual(len(simulated), 250)
+        np.testing.assert_array_equal(
+            simulated, evaluation.simulated_log_likelihoods(
+                forecast, 250, seed=3, batch_size=100, n_workers=2))
+        self.assertFalse(np.array_equal(
+            simulated, evaluation.simulated_log_likelihoods(
+                forecast, 250, seed=4, batch_size=100)))
+
+    def test_evaluate_forecast(self):
+        forecast = evaluation.forecast_counts(self.grid, scale=20.0)
+        catalog = self.catalog(int(round(forecast.sum())))
+        results = evaluation.evaluate_forecast(
+            self.grid, catalog, scale=20.0, n_sims=500, seed=5)
+        self.assertEqual(list(results),
+                         ['N-Test', 'L-Test', 'S-Test', 'M-Test'])
+        n_test = results['N-Test']
+        self.assertEqual(n_test.observed_statistic, len(catalog))
+        self.assertGreater(min(n_test.quantile), 0.4)
+        for name in ['L-Test', 'S-Test', 'M-Test']:
+            self.assertEqual(len(results[name].test_distribution), 500)
+            self.assertTrue(0.0 <= results[name].quantile <= 1.0)
+        self.assertEqual(
+            results['S-Test'].as_dict(),
+            evaluation.evaluate_forecast(
+                self.grid, catalog, scale=20.0, n_sims=500,
+                seed=5)['S-Test'].as_dict())
+
+        # Events observed in a single cell are inconsistent with the
+        # spatial distribution of the forecast.
+        catalog['lon'] = catalog['lon'].iloc[0]
+        catalog['lat'] = catalog['lat'].iloc[0]
+        results = evaluation.evaluate_forecast(
+            self.grid, catalog, scale=20.0, n_sims=500, seed=5)
+        self.assertEqual(results['S-Test'].quantile, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
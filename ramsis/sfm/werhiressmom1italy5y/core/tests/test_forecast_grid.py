@@ -0,0 +1,121 @@
+"""
+Tests for the dense forecast grid and its compiled artifact.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import forecast_grid
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+class ForecastGridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        self.lons, self.lats, self.rates = write_csep_xml(self.xml_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertGridMatchesXml(self, grid):
+        present = ~np.isnan(self.rates[:, :, 0])
+        self.assertEqual(grid.lons.tolist(), self.lons.tolist())
+        self.assertEqual(grid.lats.tolist(), self.lats.tolist())
+        np.testing.assert_array_equal(grid.present, present)
+        np.testing.assert_array_equal(
+            np.asarray(grid.rates)[present], self.rates[present])
+        self.assertEqual(grid.min_depth_km, -30.0)
+        self.assertEqual(grid.max_depth_km, -0.0)
+        self.assertEqual(len(grid.mag_list), self.rates.shape[2])
+
+    def test_parse(self):
+        grid = forecast_grid.parse_forecast_xml(self.xml_path)
+        self.assertGridMatchesXml(grid)
+
+    def test_compile_and_memory_map(self):
+        grid = forecast_grid.load_forecast(self.xml_path)
+        self.assertGridMatchesXml(grid)
+        compiled = forecast_grid.compiled_path(self.xml_path)
+        self.assertTrue(os.path.exists(compiled))
+
+        grid = forecast_grid.load_forecast(self.xml_path)
+        self.assertIsInstance(grid.rates, np.memmap)
+        self.assertGridMatchesXml(grid)
+
+    def test_stale_artifact(self):
+        forecast_grid.load_forecast(self.xml_path)
+        self.lons, self.lats, self.rates = write_csep_xml(
+            self.xml_path, seed=1)
+        stat = os.stat(self.xml_path)
+        os.utime(self.xml_path,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        grid = forecast_grid.load_forecast(self.xml_path)
+        self.assertNotIsInstance(grid.rates, np.memmap)
+        self.assertGridMatchesXml(grid)
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.mkdir(cache_dir)
+        out_path = forecast_grid.compile_forecast(
+            self.xml_path, cache_dir=cache_dir)
+        self.assertEqual(os.path.dirname(out_path), cache_dir)
+        grid = forecast_grid.load_forecast(self.xml_path, cache_dir=cache_dir)
+        self.assertIsInstance(grid.rates, np.memmap)
+
+    def test_depth_layers(self):
+        _, _, rates = write_csep_xml(
+            self.xml_path, layers=[(0.0, 10.0), (10.0, 30.0)])
+        present = ~np.isnan(rates[:, :, 0, 0])
+        for grid in [forecast_grid.load_forecast(self.xml_path),
+                     forecast_grid.load_forecast(self.xml_path)]:
+            # The layers are only summed when the summed rates are used.
+            grid.layer_grid()
+            self.assertIsNone(grid._rates)
+            self.assertEqual(grid.shape, rates.shape[:2] + rates.shape[3:])
+            self.assertEqual(grid.depth_layers.tolist(),
+                             [[-10.0, -0.0], [-30.0, -10.0]])
+            self.assertEqual(grid.min_depth_km, -30.0)
+            self.assertEqual(grid.max_depth_km, -0.0)
+            np.testing.assert_array_equal(grid.present, present)
+            np.testing.assert_array_equal(
+                np.asarray(grid.layer_rates)[present], rates[present])
+            np.testing.assert_allclose(
+                grid.rates[present], rates[present].sum(axis=1))
+            layer_grid = grid.layer_grid()
+            self.assertEqual(layer_grid.shape[2], 2 * rates.shape[3])
+            self.assertEqual(len(layer_grid.mag_list), layer_grid.shape[2])
+        self.assertIsInstance(grid.layer_rates, np.memmap)
+
+
+class GridIndexTestCase(unittest.TestCase):
+
+    def test_centre_index(self):
+        index = forecast_grid.centre_index(
+            [5.55, 5.65 + 1e-9, 5.6, 5.45, 7.55], 5.55, 0.1, 20)
+        self.assertEqual(index.tolist(), [0, 1, -1, -1, -1])
+        self.assertEqual(forecast_grid.centre_index(
+            round(5.5 + 0.05, 2), 5.55, 0.1, 20), 0)
+
+    def test_covering_slice(self):
+        # Cells are centred on 5.55 + i * 0.1
+        self.assertEqual(forecast_grid.covering_slice(
+            5.5, 5.6, 5.55, 0.1, 20), slice(0, 1))
+        self.assertEqual(forecast_grid.covering_slice(
+            5.5 + 1e-12, 5.75, 5.55, 0.1, 20), slice(0, 3))
+        self.assertEqual(forecast_grid.covering_slice(
+            5.62, 5.63, 5.55, 0.1, 20), slice(1, 2))
+        self.assertEqual(forecast_grid.covering_slice(
+            0.0, 100.0, 5.55, 0.1, 20), slice(0, 20))
+        self.assertEqual(forecast_grid.covering_slice(
+            0.0, 1.0, 5.55, 0.1, 20), slice(0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests for the timing of model run stages.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import instrument, werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        write_csep_xml(self.xml_path)
+        self.reservoir_geom = {
+            'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+            'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+            'z': [-30000.0, 0.0]}
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_span_without_trace(self):
+        with instrument.span('stage'):
+            pass
+        self.assertIsNone(instrument.current_trace())
+
+    def test_trace(self):
+        store = instrument.TraceStore(maxsize=1)
+        with instrument.trace('run-1', store=store) as trace:
+            self.assertIs(instrument.current_trace(), trace)
+            for _ in range(3):
+                with instrument.span('stage'):
+                    sum(range(1000))
+        self.assertIsNone(instrument.current_trace())
+        self.assertIs(store.get('run-1'), trace)
+        stage = trace.as_dict()['stages'][0]
+        self.assertEqual(stage['name'], 'stage')
+        self.assertEqual(stage['calls'], 3)
+        self.assertGreater(stage['wall_seconds'], 0.0)
+        self.assertGreater(stage['peak_rss_bytes'], 0)
+
+        with instrument.trace('run-2', store=store):
+            pass
+        self.assertIsNone(store.get('run-1'))
+        self.assertEqual(len(store), 1)
+
+    def test_thread_cpu(self):
+        # CPU time spent by other threads is not attributed to the span.
+        done = threading.Event()
+
+        def spin():
+            while not done.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=spin)
+        thread.start()
+        try:
+            with instrument.trace(store=instrument.TraceStore()) as trace:
+                with instrument.span('stage'):
+                    time.sleep(0.2)
+        finally:
+            done.set()
+            thread.join()
+        stage = trace.stages['stage']
+        self.assertGreaterEqual(stage['wall_seconds'], 0.2)
+        self.assertLess(stage['cpu_seconds'], 0.05)
+
+    def test_exec_model_stages(self):
+        with instrument.trace(store=instrument.TraceStore()) as trace:
+            tiles, *_ = werner_model.iter_exec_model(
+                self.reservoir_geom, tile_size=3,
+                xml_filename=self.xml_path)
+            n_tiles = len(list(tiles))
+        self.assertEqual(
+            list(trace.stages),
+            ['xml_load', 'grid_match', 'cell_search', 'mag_binning',
+             'depth_weighting', 'forecast_scaling'])
+        # One more search finds the tiles exhausted.
+        self.assertEqual(trace.stages['cell_search']['calls'], n_tiles + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests for the selection and merging of magnitude bins.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.magnitudes import MagnitudeBins
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+MAG_LIST = [f"{m:.2f}" for m in np.arange(4.95, 9.05, 0.1)]
+
+
+class MagnitudeBinsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rates = np.random.RandomState(0).uniform(
+            size=(7, 2, len(MAG_LIST)))
+
+    def test_identity(self):
+        mag_bins = MagnitudeBins(MAG_LIST, 4.95, 9.05, 0.1)
+        self.assertTrue(mag_bins.identity)
+        self.assertEqual(mag_bins.mag_list, MAG_LIST)
+        self.assertIs(mag_bins(self.rates), self.rates)
+        self.assertTrue(MagnitudeBins(MAG_LIST).identity)
+
+    def test_select(self):
+        mag_bins = MagnitudeBins(MAG_LIST, min_mag=5.95, max_mag=7.0)
+        self.assertEqual(mag_bins.mag_list, MAG_LIST[10:21])
+        np.testing.assert_array_equal(mag_bins(self.rates),
+                                      self.rates[..., 10:21])
+
+    def test_merge(self):
+        mag_bins = MagnitudeBins(MAG_LIST, min_mag=5.95, max_mag=8.45,
+                                 increment=0.5)
+        self.assertEqual(mag_bins.mag_list,
+                         ['5.95', '6.45', '6.95', '7.45', '7.95', '8.45'])
+        rebinned = mag_bins(self.rates)
+        self.assertEqual(rebinned.shape[-1], 6)
+        for k, start in enumerate(range(10, len(MAG_LIST) - 1, 5)):
+            np.testing.assert_allclose(
+                rebinned[..., k], self.rates[..., start:start + 5].sum(-1),
+                rtol=1e-14)
+
+        # Bins beyond the last requested bin are truncated.
+        mag_bins = MagnitudeBins(MAG_LIST, max_mag=5.15, increment=0.2)
+        self.assertEqual(mag_bins.mag_list, ['4.95', '5.15'])
+        np.testing.assert_allclose(
+            mag_bins(self.rates),
+            self.rates[..., :4].reshape(7, 2, 2, 2).sum(-1), rtol=1e-14)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, increment=0.15)
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, min_mag=9.5)
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, min_mag=6.0, max_mag=5.0)
+
+    def test_partial_bin(self):
+        # The bins of 0.3 from 5.95 start at 7.75 and 8.05, not at 8.0.
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, 5.95, 8.0, 0.3)
+        # The bin of 8.95 would need a forecast bin of 9.05.
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, min_mag=5.95, increment=0.2)
+        with self.assertRaises(ValueError):
+            MagnitudeBins(MAG_LIST, 5.95, 9.15, 0.2)
+        mag_bins = MagnitudeBins(MAG_LIST, 5.95, 7.75, 0.3)
+        self.assertEqual(mag_bins.mag_list[-1], '7.75')
+        self.assertEqual(mag_bins.edges[-1], 31)
+
+
+class ExecModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        lons, lats, _ = write_csep_xml(
+            self.xml_path, layers=[(0.0, 10.0), (10.0, 30.0)])
+        self.reservoir_geom = {
+            'x': np.round(np.arange(5.42, 7.2, 0.23), 2).tolist(),
+            'y': lats[::2].tolist(),
+            'z': [-30000.0, -20000.0, -5000.0, 0.0]}
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_exec_model(self):
+        full_df, mag_list, *_ = werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path)
+        returned_df, returned_mag_list, *_ = werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path,
+            min_mag=5.95, max_mag=7.75, mag_increment=0.3)
+        mag_bins = MagnitudeBins(mag_list, 5.95, 7.75, 0.3)
+        self.assertEqual(returned_mag_list, mag_bins.mag_list)
+        self.assertEqual(len(returned_df.columns),
+                         len(full_df.columns) - len(mag_list) +
+                         len(mag_bins.mag_list))
+        np.testing.assert_array_equal(
+            returned_df.values[:, :5], full_df.values[:, :5])
+        np.testing.assert_allclose(
+            returned_df[returned_mag_list].values,
+            mag_bins(full_df[mag_list].values), rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Tests for the evaluation of result grids across worker processes.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ramsis.sfm.werhiressmom1italy5y.core import (forecast_grid, parallel,
+                                                  werner_model)
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+class ParallelTestCase(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel.close_pools()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        self.lons, self.lats, _ = write_csep_xml(self.xml_path)
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tile_columns(self):
+        self.assertEqual(parallel.tile_columns(10), [slice(0, 10)])
+        self.assertEqual(len(parallel.tile_columns(0)), 1)
+        self.assertEqual(parallel.tile_columns(10, tile_size=4),
+                         [slice(0, 4), slice(4, 8), slice(8, 12)])
+        self.assertEqual(len(parallel.tile_columns(40, n_workers=2)), 8)
+
+    def test_shared_grid(self):
+        grid = forecast_grid.parse_forecast_xml(self.xml_path)
+        shared = parallel.SharedGrid(grid)
+        self.assertTrue(os.path.exists(shared.path))
+        attached = forecast_grid.load_compiled_forecast(shared.path)
+        np.testing.assert_array_equal(attached.rates, grid.rates)
+        path = shared.path
+        del shared
+        self.assertFalse(os.path.exists(path))
+
+        compiled = forecast_grid.compile_forecast(self.xml_path)
+        grid = forecast_grid.load_forecast(self.xml_path)
+        self.assertEqual(parallel.SharedGrid(grid).path, compiled)
+
+    def test_attach(self):
+        paths = []
+        for seed in range(parallel.MAX_ATTACHED + 1):
+            grid = forecast_grid.parse_forecast_xml(self.xml_path)
+            path = os.path.join(self.tmp_dir, f'{seed}.grid')
+            forecast_grid.write_compiled_forecast(grid, path)
+            paths.append(path)
+            parallel._attach(path)
+        self.assertLessEqual(len(parallel._attached),
+                             parallel.MAX_ATTACHED)
+        self.assertNotIn(paths[0], parallel._attached)
+
+        # A replaced artifact is attached again.
+        attached, _ = parallel._attach(paths[-1])
+        self.assertIs(parallel._attach(paths[-1])[0], attached)
+        write_csep_xml(self.xml_path, seed=1)
+        forecast_grid.write_compiled_forecast(
+            forecast_grid.parse_forecast_xml(self.xml_path), paths[-1])
+        grid, _ = parallel._attach(paths[-1])
+        self.assertIsNot(grid, attached)
+        np.testing.assert_array_equal(
+            grid.rates,
+            forecast_grid.parse_forecast_xml(self.xml_path).rates)
+        parallel._attached.clear()
+
+    def test_updated_forecast(self):
+        reservoir_geom = {
+            'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+            'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+            'z': [-30000.0, 0.0]}
+        for seed in range(2):
+            if seed:
+                # The artifact is recompiled to the same path.
+                write_csep_xml(self.xml_path, seed=seed)
+                stat = os.stat(self.xml_path)
+                os.utime(self.xml_path,
+                         ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            expected_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path)
+            returned_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path, n_workers=2)
+            pd.testing.assert_frame_equal(returned_df, expected_df)
+
+    def test_exec_model(self):
+        for reservoir_geom in [
+                {'x': np.round(np.arange(self.lons[0], self.lons[-1], 0.1),
+                               2).tolist(),
+                 'y': np.round(np.arange(self.lats[0], self.lats[-1], 0.1),
+                               2).tolist(),
+                 'z': [-30000.0, 0.0]},
+                {'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+                 'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+                 'z': [-30000.0, 0.0]}]:
+            expected_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path)
+            returned_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path, n_workers=2)
+            pd.testing.assert_frame_equal(returned_df, expected_df)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for the forecast locator registry.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from ramsis.sfm.werhiressmom1italy5y.core.registry import LocatorRegistry
+
+
+class DummyLocator:
+
+    nbytes = 100
+
+    def __init__(self, xml_filename, tag_url):
+        self.xml_filename = xml_filename
+        self.tag_url = tag_url
+
+
+class LocatorRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            xml_path = os.path.join(self.tmp_dir, f'forecast{i}.xml')
+            open(xml_path, 'w').close()
+            self.paths.append(xml_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_warm_get(self):
+        registry = LocatorRegistry(DummyLocator)
+        locator = registry.get(self.paths[0], 'ns')
+        self.assertIs(registry.get(self.paths[0], 'ns'), locator)
+        self.assertIsNot(registry.get(self.paths[0], 'other'), locator)
+        self.assertEqual((registry.hits, registry.misses), (1, 2))
+
+    def test_reload_on_mtime_change(self):
+        registry = LocatorRegistry(DummyLocator)
+        locator = registry.get(self.paths[0], 'ns')
+        stat = os.stat(self.paths[0])
+        os.utime(self.paths[0],
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNot(registry.get(self.paths[0], 'ns'), locator)
+        self.assertEqual(len(registry), 1)
+
+    def test_lru_bound(self):
+        registry = LocatorRegistry(DummyLocator, maxsize=2)
+        first = registry.get(self.paths[0], 'ns')
+        registry.get(self.paths[1], 'ns')
+        registry.get(self.paths[0], 'ns')
+        registry.get(self.paths[2], 'ns')
+        self.assertEqual(len(registry), 2)
+        self.assertIs(registry.get(self.paths[0], 'ns'), first)
+        self.assertEqual(registry.misses, 3)
+
+    def test_byte_bound(self):
+        registry = LocatorRegistry(DummyLocator, max_bytes=250)
+        for xml_path in self.paths:
+            registry.get(xml_path, 'ns')
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.nbytes(), 200)
+
+    def test_invalidate(self):
+        registry = LocatorRegistry(DummyLocator)
+        for xml_path in self.paths:
+            registry.get(xml_path, 'ns')
+        registry.invalidate(self.paths[0])
+        self.assertEqual(len(registry), 2)
+        registry.invalidate()
+        self.assertEqual(len(registry), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,53 +3,98 @@ Test script used for regression testing of WerHiResSmoM1Italy5y model
 """
 
 import os
-import pandas as pd
+import shutil
+import tempfile
 import unittest
-from datetime import datetime, timedelta
-from ramsis.sfm.wer_hires_smo_m1_italy_5y.core import wer_hires_smo_m1_italy_5y_model as e
 
+import numpy as np
 
-# A stand alone test is recommended for the model itself,
-# if the model code is kept in this repo.
-# Some models are converted from other languages and forms,
-# so at the very least a comparison test is required where
-# outputs from both versions are compared.
+from ramsis.sfm.werhiressmom1italy5y.core import werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
 
-dirpath = os.path.dirname(os.path.abspath(__file__))
 
-###
-# Insert test code
-# transform data as the model_adaptor would, and call the
-# required function in the model code.
-# For a real test, see the WerHiResSmoM1Italy5y implementation test of the same name.
+# The model output is compared to a straightforward reimplementation
+# working on the rates written to a synthetic forecast, so that neither
+# the original forecast nor comparison files are needed.
 
-###
-# Test code
-###
+def reimplemented_forecast(lons, lats, rates, reservoir_geom,
+                           increment=0.1):
+    """ Average the forecast rates over every requested result cell,
+    weighted by the fraction of each forecast cell covered, and scale them
+    from five years to one year.
 
+    :returns: Array of the rows of the model output.
+    """
+    half = increment / 2.0
+    x = reservoir_geom['x']
+    y = reservoir_geom['y']
+    lon_edges = [round(x[0] - half, 2)] + [round(v + half, 2)
+                                           for v in x[:-1]]
+    lat_edges = [round(y[0] - half, 2)] + [round(v + half, 2)
+                                           for v in y[:-1]]
+    rows = []
+    for min_lon, max_lon in zip(lon_edges, lon_edges[1:]):
+        for min_lat, max_lat in zip(lat_edges, lat_edges[1:]):
+            overlap = 0.0
+            cell_rates = np.zeros(rates.shape[2])
+            for i, lon in enumerate(lons):
+                for j, lat in enumerate(lats):
+                    if np.isnan(rates[i, j, 0]):
+                        continue
+                    dx = min(max_lon, lon + half) - max(min_lon, lon - half)
+                    dy = min(max_lat, lat + half) - max(min_lat, lat - half)
+                    if dx <= 0.0 or dy <= 0.0:
+                        continue
+                    fraction = dx * dy / increment ** 2
+                    overlap += fraction
+                    cell_rates += fraction * rates[i, j]
+            if overlap < werner_model.MIN_OVERLAP:
+                continue
+            rows.append([min_lon, max_lon, min_lat, max_lat, overlap] +
+                        (cell_rates * 0.2).tolist())
+    return np.array(rows)
 
-# Run test and test results against comparison files
+
+# Run test and test results against the reimplementation
 class WerHiResSmoM1Italy5yOutput(unittest.TestCase):
 
     def setUp(self):
-        self.allowed_error = 1e-3
-        self.comparison_n = open_comparison_data(
-            "data/output.csv")
-        a, b, mc, forecast_values = exec_forecast()
-        self.output_a = a
-        self.output_b = b
-        self.output_mc = mc
-        self.output_forecast_values = forecast_values
-
-    def test_forecast(self):
-        """Test the full model output."""
-        diff = (self.comparison_n - self.output_forecast_values).abs()
-        diff_truth = (diff < self.allowed_error).all()
-        self.assertTrue(diff_truth.N)
-        self.assertTrue(diff_truth.volume)
-
-    def test_training_values(self):
-        """Test the full model output."""
-        self.assertTrue((self.output_a - 0.21982619) < self.allowed_error)
-        self.assertTrue((self.output_b - 1.74624935) < self.allowed_error)
-        self.assertTrue((self.output_mc - 0.8) < self.allowed_error)
+        self.allowed_error = 1e-9
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        self.lons, self.lats, self.rates = write_csep_xml(
+            self.xml_path, n_lon=12, n_lat=9, seed=3)
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def assertForecast(self, reservoir_geom):
+        forecast_values, mag_list, mc, depth_km = werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+        expected = reimplemented_forecast(
+            self.lons, self.lats, self.rates, reservoir_geom)
+        self.assertEqual(forecast_values.shape, expected.shape)
+        np.testing.assert_allclose(forecast_values.values, expected,
+                                   rtol=self.allowed_error)
+        self.assertEqual(mc, werner_model.MAGNITUDE_COMPLETENESS)
+        self.assertEqual(depth_km, 30.0)
+
+    def test_forecast_grid_match(self):
+        """Test the model output on the forecast grid."""
+        self.assertForecast({
+            'x': np.round(np.arange(5.55, 6.65, 0.1), 2).tolist(),
+            'y': np.round(np.arange(35.85, 36.65, 0.1), 2).tolist(),
+            'z': [-30000.0, 0.0]})
+
+    def test_forecast_off_grid(self):
+        """Test the model output on a grid not matching the forecast."""
+        self.assertForecast({
+            'x': [5.43, 5.61, 5.92, 6.3, 6.71, 7.0],
+            'y': [35.8, 35.97, 36.2, 36.58, 37.1],
+            'z': [-30000.0, 0.0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Tests for the model output cache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ramsis.sfm.werhiressmom1italy5y.core import werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.magnitudes import MagnitudeBins
+from ramsis.sfm.werhiressmom1italy5y.core.result_cache import (
+    ResultCache, result_key)
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        write_csep_xml(self.xml_path)
+        self.reservoir_geom = {
+            'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+            'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+            'z': [-30000.0, 0.0]}
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_result_key(self):
+        key = result_key(self.reservoir_geom, self.xml_path)
+        self.assertEqual(key, result_key(
+            dict(self.reservoir_geom,
+                 x=np.array(self.reservoir_geom['x'])), self.xml_path))
+        self.assertNotEqual(key, result_key(
+            dict(self.reservoir_geom, z=[-20000.0, 0.0]), self.xml_path))
+        mag_list = werner_model.get_result_locator(
+            xml_filename=self.xml_path).mag_list
+        self.assertEqual(key, result_key(
+            self.reservoir_geom, self.xml_path,
+            mag_bins=MagnitudeBins(mag_list, 4.95, 9.05, 0.1)))
+        self.assertNotEqual(key, result_key(
+            self.reservoir_geom, self.xml_path,
+            mag_bins=MagnitudeBins(mag_list, 5.05, None, 0.2)))
+        self.assertEqual(
+            result_key(self.reservoir_geom, self.xml_path,
+                       mag_bins=MagnitudeBins(mag_list, 5.05, None, 0.2)),
+            result_key(self.reservoir_geom, self.xml_path,
+                       mag_bins=MagnitudeBins(mag_list, 5.0, 8.85, 0.2)))
+        stat = os.stat(self.xml_path)
+        os.utime(self.xml_path,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(key, result_key(self.reservoir_geom,
+                                            self.xml_path))
+
+    def test_exec_model(self):
+        cache = ResultCache()
+        output = werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertIs(werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path, cache=cache),
+            output)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Requests with the default bins of the forecast are served by
+        # the output of a warm-up without bins.
+        self.assertIs(werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path, cache=cache,
+            min_mag=4.95, max_mag=9.05, mag_increment=0.1), output)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_spill(self):
+        spill_dir = os.path.join(self.tmp_dir, 'spill')
+        cache = ResultCache(maxsize=1, spill_dir=spill_dir)
+        output = werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path, cache=cache)
+        werner_model.exec_model(
+            dict(self.reservoir_geom, x=self.reservoir_geom['x'][1:]),
+            xml_filename=self.xml_path, cache=cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(os.listdir(spill_dir)), 1)
+
+        returned_df, mag_list, mc, depth_km = werner_model.exec_model(
+            self.reservoir_geom, xml_filename=self.xml_path, cache=cache)
+        self.assertEqual(cache.hits, 1)
+        pd.testing.assert_frame_equal(returned_df, output[0])
+        self.assertEqual((mag_list, mc, depth_km), output[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Tests for forecast grids shared through shared memory segments.
+"""
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import forecast_grid, werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.shm import SharedForecast
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+def attach_and_report(xml_path, shm_dir, queue):
+    shared = SharedForecast(xml_path, shm_dir=shm_dir)
+    queue.put((shared.path, os.stat(shared.path).st_ino))
+    shared.close()
+
+
+class SharedForecastTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shm_dir = os.path.join(self.tmp_dir, 'shm')
+        os.mkdir(self.shm_dir)
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        _, _, self.rates = write_csep_xml(self.xml_path)
+
+    def tearDown(self):
+        werner_model.configure_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reference_counting(self):
+        first = SharedForecast(self.xml_path, shm_dir=self.shm_dir)
+        self.assertIsInstance(first.grid.rates, np.memmap)
+        present = ~np.isnan(self.rates[:, :, 0])
+        np.testing.assert_array_equal(
+            np.asarray(first.grid.rates)[present], self.rates[present])
+
+        second = SharedForecast(self.xml_path, shm_dir=self.shm_dir)
+        self.assertEqual(second.path, first.path)
+        inode = os.stat(first.path).st_ino
+
+        # Another process maps the published segment.
+        queue = multiprocessing.get_context('spawn').Queue()
+        process = multiprocessing.get_context('spawn').Process(
+            target=attach_and_report,
+            args=(self.xml_path, self.shm_dir, queue))
+        process.start()
+        self.assertEqual(queue.get(timeout=60), (first.path, inode))
+        process.join()
+
+        first.close()
+        self.assertTrue(os.path.exists(second.path))
+        del second
+        gc.collect()
+        self.assertFalse(os.path.exists(first.path))
+        # The grid remains readable after detaching.
+        np.testing.assert_array_equal(
+            np.asarray(first.grid.rates)[present], self.rates[present])
+
+    def test_new_forecast_version(self):
+        first = SharedForecast(self.xml_path, shm_dir=self.shm_dir)
+        write_csep_xml(self.xml_path, seed=1)
+        stat = os.stat(self.xml_path)
+        os.utime(self.xml_path,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        second = SharedForecast(self.xml_path, shm_dir=self.shm_dir)
+        self.assertNotEqual(second.path, first.path)
+        first.close()
+        second.close()
+
+    def test_result_locator(self):
+        werner_model.configure_result_locators(shared_memory=True)
+        locator = werner_model.get_result_locator(
+            xml_filename=self.xml_path)
+        segment = locator.grid.rates.filename
+        self.assertTrue(os.path.exists(segment))
+        self.assertIs(werner_model.get_result_locator(
+            xml_filename=self.xml_path), locator)
+        grid = forecast_grid.parse_forecast_xml(self.xml_path)
+        np.testing.assert_array_equal(locator.grid.present, grid.present)
+
+        del locator
+        werner_model.configure_result_locators()
+        gc.collect()
+        self.assertFalse(os.path.exists(segment))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests for the streaming QuakeML catalog reader.
+"""
+import sys
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+try:
+    import ramsis.utils.error  # noqa
+except ImportError:
+    # The error facilities of the core only need the base classes.
+    error = types.ModuleType('ramsis.utils.error')
+    error.Error = type('Error', (Exception,), {})
+    error.ErrorWithTraceback = type('ErrorWithTraceback', (error.Error,), {})
+    sys.modules.setdefault('ramsis.utils', types.ModuleType('ramsis.utils'))
+    sys.modules['ramsis.utils.error'] = error
+
+from ramsis.sfm.werhiressmom1italy5y.core import utils  # noqa: E402
+from ramsis.sfm.werhiressmom1italy5y.core.error import \
+    WerHiResSmoM1Italy5yObspyCatalogError  # noqa: E402
+
+EVENT = '''
+<event publicID="smi:ch.ethz.sed/event/{0}">
+  <preferredOriginID>smi:ch.ethz.sed/origin/{0}b</preferredOriginID>
+  <preferredMagnitudeID>smi:ch.ethz.sed/magnitude/{0}</preferredMagnitudeID>
+  <origin publicID="smi:ch.ethz.sed/origin/{0}a">
+    <time><value>2000-01-01T00:00:00Z</value></time>
+    <latitude><value>0.0</value></latitude>
+    <longitude><value>0.0</value></longitude>
+    <depth><value>0.0</value></depth>
+  </origin>
+  <origin publicID="smi:ch.ethz.sed/origin/{0}b">
+    <time><value>{1}</value></time>
+    <latitude><value>{3}</value></latitude>
+    <longitude><value>{4}</value></longitude>
+    {5}
+  </origin>
+  <magnitude publicID="smi:ch.ethz.sed/magnitude/{0}">
+    <mag><value>{2}</value></mag>
+  </magnitude>
+</event>'''
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<q:quakeml xmlns:q="http://quakeml.org/xmlns/quakeml/1.2"
+    xmlns="http://quakeml.org/xmlns/bed/1.2">
+  <eventParameters publicID="smi:ch.ethz.sed/catalog">{}
+  </eventParameters>
+</q:quakeml>'''
+
+
+def quakeml(*events):
+    """ QuakeML document of events given as tuples of the origin time,
+    magnitude, latitude, longitude and depth. A depth of None omits the
+    depth of the origin.
+    """
+    return DOCUMENT.format(''.join(
+        EVENT.format(i, time, mag, lat, lon,
+                     '' if depth is None else
+                     f'<depth><value>{depth}</value></depth>')
+        for i, (time, mag, lat, lon, depth) in enumerate(events)))
+
+
+class ReadQuakeMLCatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [
+            ('2019-01-02T03:04:05.123456Z', 2.5, 46.1, 7.5, 3500.0),
+            ('2019-01-01T00:00:00', 1.25, 46.2, 7.6, 1200.5)]
+
+    def test_read(self):
+        catalog = utils.read_quakeml_catalog(
+            quakeml(*self.events).encode('utf-8'))
+        self.assertEqual(list(catalog.columns),
+                         ['mag', 'lat', 'lon', 'depth'])
+        # Events are kept in the order of the document, the preferred
+        # origins are read.
+        self.assertEqual(list(catalog.index), [
+            pd.Timestamp('2019-01-02T03:04:05.123456'),
+            pd.Timestamp('2019-01-01T00:00:00')])
+        np.testing.assert_array_equal(
+            catalog.values, [event[1:] for event in self.events])
+
+    def test_catalog_parser(self):
+        catalog = utils.obspy_catalog_parser(quakeml(*self.events))
+        self.assertTrue(catalog.index.is_monotonic_increasing)
+        self.assertEqual(catalog['mag'].tolist(), [1.25, 2.5])
+        with self.assertRaises(WerHiResSmoM1Italy5yObspyCatalogError):
+            utils.obspy_catalog_parser(quakeml())
+
+    def test_unsupported(self):
+        unsupported = [
+            # Missing optional fields.
+            quakeml(self.events[0][:4] + (None,)),
+            quakeml(*self.events).replace(
+                '<preferredMagnitudeID>smi:ch.ethz.sed/magnitude/1<',
+                '<preferredMagnitudeID>smi:ch.ethz.sed/magnitude/2<'),
+            quakeml(*self.events).replace(
+                '<preferredOriginID>smi:ch.ethz.sed/origin/0b'
+                '</preferredOriginID>', ''),
+            # Times ObsPy converts differently.
+            quakeml(('2019-01-01T00:00:00+01:00',) + self.events[0][1:]),
+            quakeml(self.events[0][:1] + ('NaN-ish',) + self.events[0][2:]),
+            quakeml(*self.events)[:-20],
+            quakeml(*self.events).replace('quakeml/1.2', 'quakeml/1.1')]
+        for document in unsupported:
+            with self.assertRaises(utils.UnsupportedQuakeMLError):
+                utils.read_quakeml_catalog(document.encode('utf-8'))
+
+            # The catalog is read with ObsPy instead.
+            with mock.patch.object(utils, '_obspy_catalog_parser',
+                                   return_value=mock.sentinel.catalog) as \
+                    parser:
+                self.assertIs(utils.obspy_catalog_parser(document),
+                              mock.sentinel.catalog)
+            parser.assert_called_once_with(document.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
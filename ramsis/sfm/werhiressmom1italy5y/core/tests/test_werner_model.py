@@ -0,0 +1,213 @@
+"""
+Tests for the evaluation of the forecast on requested result grids.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ramsis.sfm.werhiressmom1italy5y.core import regrid, werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+
+
+def reference_results(locator, reservoir_geom, grid_match):
+    """ Search each result cell separately, as exec_model used to.
+    """
+    cells = []
+    min_lon = round(reservoir_geom['x'][0] - locator.lon_add, 2)
+    for lon in reservoir_geom['x'][:-1]:
+        max_lon = round(lon + locator.lon_add, 2)
+        min_lat = round(reservoir_geom['y'][0] - locator.lat_add, 2)
+        for lat in reservoir_geom['y'][:-1]:
+            max_lat = round(lat + locator.lat_add, 2)
+            cell_results = locator.cell_search(
+                min_lon, max_lon, min_lat, max_lat, grid_match=grid_match)
+            if cell_results is not None:
+                cells.append(cell_results)
+            min_lat = max_lat
+        min_lon = max_lon
+    returned_df = pd.concat(cells, ignore_index=True)
+    return werner_model.forecast_scaling(returned_df, locator.mag_list)
+
+
+class ExecModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        self.lons, self.lats, _ = write_csep_xml(self.xml_path)
+        self.locator = werner_model.get_result_locator(
+            xml_filename=self.xml_path)
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        shutil.rmtree(self.tmp_dir)
+
+    def assertMatchesReference(self, reservoir_geom, grid_match):
+        returned_df, mag_list, _, depth_km = werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+        expected_df = reference_results(
+            self.locator, reservoir_geom, grid_match)
+        self.assertEqual(depth_km, 30.0)
+        self.assertEqual(list(returned_df.columns), list(expected_df.columns))
+        np.testing.assert_allclose(returned_df.values, expected_df.values,
+                                   rtol=1e-12, atol=1e-15)
+
+    def test_cell_search(self):
+        results_df = self.locator.results_df
+        lons = results_df['lon'].values
+        lats = results_df['lat'].values
+        for box in [(5.5, 5.6, 35.8, 35.9), (5.62, 6.31, 35.87, 36.55),
+                    (4.0, 5.5, 35.0, 36.0), (7.1, 9.0, 37.0, 38.0),
+                    (5.61, 5.63, 36.01, 36.02), (0.0, 30.0, 30.0, 50.0)]:
+            dx = np.clip(np.minimum(box[1], lons + 0.05) -
+                         np.maximum(box[0], lons - 0.05), 0.0, None)
+            dy = np.clip(np.minimum(box[3], lats + 0.05) -
+                         np.maximum(box[2], lats - 0.05), 0.0, None)
+            overlap = dx * dy / self.locator.cell_area
+            result = self.locator.cell_search(*box, grid_match=False)
+            if overlap.sum() < 1e-3:
+                self.assertIsNone(result)
+                continue
+            self.assertAlmostEqual(result['overlap'][0], overlap.sum())
+            np.testing.assert_allclose(
+                result[self.locator.mag_list].values[0],
+                overlap.dot(results_df[self.locator.mag_list].values))
+
+    def test_grid_match(self):
+        # Built the same way as the default reservoir in settings.
+        reservoir_geom = {
+            'x': np.round(np.arange(self.lons[0], self.lons[-1], 0.1), 2)
+            .tolist(),
+            'y': np.round(np.arange(self.lats[0], self.lats[-1], 0.1), 2)
+            .tolist(),
+            'z': [-30000.0, 0.0]}
+        alignment = regrid.analyse_alignment(
+            self.locator.grid,
+            regrid.cell_edges(reservoir_geom['x'], self.locator.lon_add),
+            regrid.cell_edges(reservoir_geom['y'], self.locator.lat_add))
+        self.assertEqual(alignment.kind, regrid.IDENTICAL)
+        self.assertMatchesReference(reservoir_geom, grid_match=True)
+
+    def test_off_grid(self):
+        reservoir_geom = {'x': np.round(np.arange(5.42, 7.8, 0.23), 2)
+                          .tolist(),
+                          'y': np.round(np.arange(35.9, 37.5, 0.07), 2)
+                          .tolist(),
+                          'z': [-30000.0, 0.0]}
+        # The summed area table is only built for cell searches.
+        werner_model.exec_model(reservoir_geom, xml_filename=self.xml_path)
+        self.assertIsNone(self.locator._summed_area)
+        nbytes = self.locator.nbytes
+        self.assertMatchesReference(reservoir_geom, grid_match=False)
+        self.assertGreater(self.locator.nbytes,
+                           nbytes + self.locator.grid.rates.nbytes)
+        # The overlap weights are reused for the same result grid.
+        self.assertMatchesReference(reservoir_geom, grid_match=False)
+        self.assertEqual(len(self.locator.operators), 1)
+
+    def test_alignment(self):
+        grid = self.locator.grid
+        lon_add, lat_add = self.locator.lon_add, self.locator.lat_add
+        lons = np.round(self.lons - 0.3, 2)
+        for x, y, kind in [
+                (self.lons[:-1], self.lats[:-1], regrid.IDENTICAL),
+                (self.lons[3:12], self.lats[2:], regrid.SUBWINDOW),
+                # Extending beyond the forecast.
+                (lons, self.lats[5:], regrid.SUBWINDOW),
+                (self.lons[1::2], self.lats[::3], regrid.COARSENED),
+                (lons[::4], self.lats[::2], regrid.COARSENED),
+                (np.round(np.arange(5.42, 7.8, 0.23), 2), self.lats,
+                 regrid.ARBITRARY)]:
+            lon_edges = regrid.cell_edges(list(x), lon_add)
+            lat_edges = regrid.cell_edges(list(y), lat_add)
+            alignment = regrid.analyse_alignment(grid, lon_edges, lat_edges)
+            self.assertEqual(alignment.kind, kind)
+            # Aligned grids are evaluated like through overlap weights.
+            expected = regrid.evaluate_overlap(grid, lon_edges, lat_edges)
+            for columns in [None, slice(2, 5), slice(4, None)]:
+                result = regrid.evaluate_grid(
+                    grid, lon_edges, lat_edges, alignment=alignment,
+                    columns=columns)
+                start, stop, _ = (columns or slice(None)).indices(
+                    len(lon_edges) - 1)
+                tile = ((expected[:, 0] >= lon_edges[start]) &
+                        (expected[:, 1] <= lon_edges[stop]))
+                np.testing.assert_allclose(result, expected[tile],
+                                           rtol=1e-12, atol=1e-15)
+
+        reservoir_geom = {'x': self.lons[1::2].tolist(),
+                          'y': self.lats[::3].tolist(),
+                          'z': [-30000.0, 0.0]}
+        self.assertMatchesReference(reservoir_geom, grid_match=False)
+
+    def test_depth_layers(self):
+        self.lons, self.lats, rates = write_csep_xml(
+            self.xml_path, layers=[(0.0, 10.0), (10.0, 30.0)])
+        werner_model.invalidate_result_locators()
+        locator = werner_model.get_result_locator(xml_filename=self.xml_path)
+        reservoir_geom = {'x': self.lons[2:9].tolist(),
+                          'y': self.lats[1:7].tolist(),
+                          'z': [-30000.0, 0.0]}
+        total_df, mag_list, _, depth_km = werner_model.exec_model(
+            reservoir_geom, xml_filename=self.xml_path)
+        self.assertEqual(depth_km, 30.0)
+        # A single depth slice holds the sum of all depth layers.
+        for _, row in total_df.iterrows():
+            i = int(np.rint((row['min_lon'] + 0.05 - self.lons[0]) / 0.1))
+            j = int(np.rint((row['min_lat'] + 0.05 - self.lats[0]) / 0.1))
+            np.testing.assert_allclose(
+                row[mag_list].values.astype(float),
+                0.2 * rates[i, j].sum(axis=0), rtol=1e-12)
+
+        # Slices take the covered fraction of every layer.
+        weights = [[0.0, 0.5], [0.5, 0.5], [0.5, 0.0]]
+        np.testing.assert_allclose(
+            regrid.depth_weights([-30000.0, -20000.0, -5000.0, 0.0],
+                                 locator.grid.depth_layers), weights)
+        for reservoir_geom['x'] in [
+                self.lons[2:9].tolist(),
+                np.round(np.arange(5.72, 6.9, 0.23), 2).tolist()]:
+            reservoir_geom['z'] = [-30000.0, 0.0]
+            total_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path)
+            reservoir_geom['z'] = [-30000.0, -20000.0, -5000.0, 0.0]
+            returned_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path)
+            self.assertEqual(len(returned_df), 3 * len(total_df))
+            np.testing.assert_array_equal(
+                returned_df[regrid.RESULT_COLUMNS].values[::3],
+                total_df[regrid.RESULT_COLUMNS].values)
+            slices = returned_df[mag_list].values.reshape(
+                len(total_df), 3, len(mag_list))
+            np.testing.assert_allclose(slices.sum(axis=1),
+                                       total_df[mag_list].values,
+                                       rtol=1e-12)
+
+    def test_tiles(self):
+        for reservoir_geom in [
+                {'x': np.round(np.arange(self.lons[0], self.lons[-1], 0.1),
+                               2).tolist(),
+                 'y': np.round(np.arange(self.lats[0], self.lats[-1], 0.1),
+                               2).tolist(),
+                 'z': [-30000.0, 0.0]},
+                {'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+                 'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+                 'z': [-30000.0, 0.0]}]:
+            returned_df, *_ = werner_model.exec_model(
+                reservoir_geom, xml_filename=self.xml_path)
+            tiles, *_ = werner_model.iter_exec_model(
+                reservoir_geom, tile_size=3, xml_filename=self.xml_path)
+            tiles = list(tiles)
+            self.assertEqual(len(tiles),
+                             -(-(len(reservoir_geom['x']) - 1) // 3))
+            pd.testing.assert_frame_equal(
+                pd.concat(tiles, ignore_index=True), returned_df)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,27 @@
 """
 Miscellaneous WerHiResSmoM1Italy5y model core facilities.
 """
+import io
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
 import pandas as pd
-from obspy import read_events
 
-from ramsis.sfm.wer_hires_smo_m1_italy_5y.core.error import (WerHiResSmoM1Italy5yObspyCatalogError,
-                                       WerHiResSmoM1Italy5yWellInputError)
+from ramsis.sfm.werhiressmom1italy5y.core.error import (
+    WerHiResSmoM1Italy5yObspyCatalogError, WerHiResSmoM1Italy5yWellInputError)
+
+LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
+logger = logging.getLogger(LOGGER)
+
+QUAKEML_TAG_URL = "{http://quakeml.org/xmlns/quakeml/1.2}"
+QUAKEML_BED_TAG_URL = "{http://quakeml.org/xmlns/bed/1.2}"
+# Origin times converted by the streaming reader exactly as by ObsPy, i.e.
+# UTC times of at most microsecond precision. Catalogs with other times,
+# e.g. with UTC offsets, are read with ObsPy.
+QUAKEML_TIME = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}'
+                          r'(\.\d{1,6})?$')
 
 # This file should contain utility functions that convert data from
 # original format given by marshmallow parser to something the model
@@ -16,9 +32,106 @@ from ramsis.sfm.wer_hires_smo_m1_italy_5y.core.error import (WerHiResSmoM1Italy5
 # different model runs, any created files should be created in a model
 # run specific folder.
 
+class UnsupportedQuakeMLError(Exception):
+    """Raised if a document is not read by the streaming QuakeML reader."""
+
+
+def _preferred(event, tag, id_tag):
+    """ Child element of an event referred to by its preferred id.
+    """
+    public_id = event.findtext(f"{QUAKEML_BED_TAG_URL}{id_tag}")
+    if public_id is None:
+        raise UnsupportedQuakeMLError(f"Event without {id_tag}.")
+    public_id = public_id.strip()
+    for element in event.findall(f"{QUAKEML_BED_TAG_URL}{tag}"):
+        if element.get('publicID') == public_id:
+            return element
+    raise UnsupportedQuakeMLError(f"{id_tag} not found in event.")
+
+
+def _quantity(element, tag):
+    # Child lookups by plain tags avoid the slower path expressions.
+    quantity = element.find(f"{QUAKEML_BED_TAG_URL}{tag}")
+    value = None if quantity is None else quantity.findtext(
+        f"{QUAKEML_BED_TAG_URL}value")
+    if value is None:
+        raise UnsupportedQuakeMLError(f"Missing {tag} value.")
+    return value
+
+
+def read_quakeml_catalog(xml_string):
+    """ Read the preferred origins and magnitudes of the events of a
+    QuakeML 1.2 document into columns.
+
+    The document is parsed incrementally, every event element is cleared
+    once its values are collected, so that no object per event is kept.
+
+    :param bytes xml_string: QuakeML document.
+    :raises UnsupportedQuakeMLError: If the document is not QuakeML 1.2 or
+        an event can not be read the same way as by ObsPy, e.g. because it
+        lacks a preferred origin or magnitude.
+    :returns: DataFrame with columns 'mag', 'lat', 'lon' and 'depth',
+        indexed by origin time in the order of the document.
+    """
+    event_tag = f"{QUAKEML_BED_TAG_URL}event"
+    columns = ([], [], [], [], [])
+    try:
+        elements = ET.iterparse(io.BytesIO(xml_string), events=('end',))
+        for _, elem in elements:
+            if elem.tag == event_tag:
+                origin = _preferred(elem, 'origin', 'preferredOriginID')
+                magnitude = _preferred(elem, 'magnitude',
+                                       'preferredMagnitudeID')
+                for column, value in zip(columns, (
+                        _quantity(origin, 'time'),
+                        _quantity(magnitude, 'mag'),
+                        _quantity(origin, 'latitude'),
+                        _quantity(origin, 'longitude'),
+                        _quantity(origin, 'depth'))):
+                    column.append(value)
+                elem.clear()
+    except ET.ParseError as err:
+        raise UnsupportedQuakeMLError(err)
+    if elements.root.tag != f"{QUAKEML_TAG_URL}quakeml":
+        raise UnsupportedQuakeMLError(
+            f"Not a QuakeML 1.2 document: {elements.root.tag}")
+
+    times = [time.strip().rstrip('Z') for time in columns[0]]
+    if not all(QUAKEML_TIME.match(time) for time in times):
+        raise UnsupportedQuakeMLError("Unsupported origin time format.")
+    try:
+        values = [np.array(column, dtype=float) for column in columns[1:]]
+    except ValueError as err:
+        raise UnsupportedQuakeMLError(err)
+    index = pd.DatetimeIndex(np.array(times, dtype='datetime64[us]'))
+    return pd.DataFrame(dict(zip(['mag', 'lat', 'lon', 'depth'], values)),
+                        index=index)
+
+
 def obspy_catalog_parser(xml_string):
+    """ Read the preferred origins and magnitudes of the events of a
+    catalog into a DataFrame indexed by origin time.
+
+    QuakeML 1.2 documents are streamed into columns, see
+    :py:func:`read_quakeml_catalog`. Other documents are read with ObsPy.
+    """
     if isinstance(xml_string, str):
         xml_string = xml_string.encode('utf-8')
+    try:
+        catalog = read_quakeml_catalog(xml_string)
+    except UnsupportedQuakeMLError as err:
+        logger.debug(f"Reading catalog with ObsPy: {err}")
+        return _obspy_catalog_parser(xml_string)
+    if catalog.empty:
+        raise WerHiResSmoM1Italy5yObspyCatalogError(
+            "Number of events is zero.")
+    # sort_index() is required for the model. If the index is not
+    # in order, it cannot be searched and sliced.
+    return catalog.sort_index()
+
+
+def _obspy_catalog_parser(xml_string):
+    from obspy import read_events
     try:
         obspy_catalog = read_events(xml_string)
     except AttributeError:
@@ -26,7 +139,8 @@ def obspy_catalog_parser(xml_string):
     # TODO (sarsonl) Should there be further checks on the information,
     # such as lat and lon?
     if len(obspy_catalog.events) == 0:
-        raise WerHiResSmoM1Italy5yObspyCatalogError("Number of events is zero.")
+        raise WerHiResSmoM1Italy5yObspyCatalogError(
+            "Number of events is zero.")
     (dttime_column,
      mag_column,
      latitude_column,
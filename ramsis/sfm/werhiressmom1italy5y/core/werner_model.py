@@ -2,12 +2,25 @@
 WerHiResSmoM1Italy5y model code that maps results from an XML file
 to a spatial grid.
 """
+import functools
 import os.path as path
 import pandas as pd
-import xml.etree.ElementTree as ET
 import logging
-from numpy import round as nround
-from numpy import arange
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import parallel
+from ramsis.sfm.werhiressmom1italy5y.core.instrument import span
+from ramsis.sfm.werhiressmom1italy5y.core.magnitudes import MagnitudeBins
+from ramsis.sfm.werhiressmom1italy5y.core.forecast_grid import (
+    CSEP_TAG_URL, load_forecast)
+from ramsis.sfm.werhiressmom1italy5y.core.regrid import (
+    MIN_OVERLAP, RESULT_COLUMNS, RegridOperatorCache, SummedAreaTable,
+    analyse_alignment, cell_edges, contract_depth, depth_weights,
+    evaluate_grid)
+from ramsis.sfm.werhiressmom1italy5y.core.registry import LocatorRegistry
+from ramsis.sfm.werhiressmom1italy5y.core.result_cache import (
+    ResultCache, result_key)
+from ramsis.sfm.werhiressmom1italy5y.core.shm import SharedForecast
 
 LOGGER = 'ramsis.sfm.wer_hires_smo_m1_italy_5y_model'
 NAME = 'WerHiResSmoM1Italy5yMODEL'
@@ -15,6 +28,7 @@ logger = logging.getLogger(LOGGER)
 ABS_PATH = path.dirname(path.realpath(__file__))
 PARENT_ABS_PATH = path.dirname(ABS_PATH)
 MAGNITUDE_COMPLETENESS = 1.0 ### dummy value, find what this should be # noqa
+XML_FILENAME = "werner.HiResSmoSeis-m1.italy.5yr.xml"
 
 class ResultLocator:
     """ Class to translate model results from an xml file
@@ -22,53 +36,95 @@ class ResultLocator:
     """
 
     def __init__(
-            self, tag_url="{http://www.scec.org/xml-ns/csep/forecast/0.1}",
-            xml_filename="werner.HiResSmoSeis-m1.italy.5yr.xml"):
+            self, tag_url=CSEP_TAG_URL, xml_filename=XML_FILENAME,
+            cache_dir=None, shared_memory=False):
         logger.info(f"Loading xml file: {xml_filename}")
-        tree = ET.parse(path.join(ABS_PATH, xml_filename))
-        root = tree.getroot()
-
-        # Depth element of model.
-        cell_depth_element = root.find(
-            f"./{tag_url}forecastData/{tag_url}depthLayer")
-
-        # Reverse the direction of depth to altitude
-        self.max_depth_km = -float(cell_depth_element.get('min'))
-        self.min_depth_km = -float(cell_depth_element.get('max'))
+        xml_path = path.join(ABS_PATH, xml_filename)
+        if shared_memory:
+            # The grid is mapped from a segment shared by all processes of
+            # the host, which is held as long as the locator.
+            self._shared_forecast = SharedForecast(
+                xml_path, tag_url=tag_url, cache_dir=cache_dir)
+            self.grid = self._shared_forecast.grid
+        else:
+            # The compiled grid artifact is memory mapped if available, the
+            # xml file is only parsed when it is missing or stale.
+            self.grid = load_forecast(xml_path, tag_url=tag_url,
+                                      cache_dir=cache_dir)
+        self.max_depth_km = self.grid.max_depth_km
+        self.min_depth_km = self.grid.min_depth_km
 
-        cell_dimension_element = root.find(
-            f"./{tag_url}forecastData/{tag_url}defaultCellDimension")
-        self.lon_increment = float(cell_dimension_element.get('lonRange'))
-        self.lat_increment = float(cell_dimension_element.get('latRange'))
+        self.lon_increment = self.grid.lon_increment
+        self.lat_increment = self.grid.lat_increment
 
-        self.lon_add = float(cell_dimension_element.get('lonRange')) / 2.0
-        self.lat_add = float(cell_dimension_element.get('latRange')) / 2.0
+        self.lon_add = self.lon_increment / 2.0
+        self.lat_add = self.lat_increment / 2.0
 
         # List of available magnitudes in model.
-        cells = root.findall(
-            f"./{tag_url}forecastData/{tag_url}depthLayer/{tag_url}cell")
-        self.mag_list = [element.get('m') for element in list(cells[0])]
-
-        # Create dataframe containing all information
-        dict_list = []
-        for cell in cells:
-            row_dict = {element.get('m'): float(element.text)
-                        for element in cell.iter() if element.get('m')}
-            row_dict["lon"] = float(cell.get('lon'))
-            row_dict["lat"] = float(cell.get('lat'))
-            dict_list.append(row_dict)
-        self.results_df = pd.DataFrame.from_dict(dict_list)
+        self.mag_list = self.grid.mag_list
+        self._results_df = None
+        self._shared_grid = None
+        # Overlap weight matrices of recently requested non-matching grids
+        self.operators = RegridOperatorCache()
+        self._summed_area = None
         logger.info("Successfully loaded xml file")
 
         self.cell_area = self.lon_increment * self.lat_increment
-        self.lon_min = self.results_df['lon'].min()
-        self.lon_max = self.results_df['lon'].max()
-        self.lat_min = self.results_df['lat'].min()
-        self.lat_max = self.results_df['lat'].max()
+        self.lon_min = self.grid.lons[0]
+        self.lon_max = self.grid.lons[-1]
+        self.lat_min = self.grid.lats[0]
+        self.lat_max = self.grid.lats[-1]
+
+    @property
+    def results_df(self):
+        """ Dataframe containing a row for each cell of the forecast, with
+        columns for every magnitude bin as well as the cell centre lon and
+        lat. Built from the dense grid on first access.
+        """
+        if self._results_df is None:
+            present = np.asarray(self.grid.present)
+            lon_index, lat_index = np.nonzero(present)
+            results_df = pd.DataFrame(np.asarray(self.grid.rates)[present],
+                                      columns=self.mag_list)
+            results_df["lon"] = self.grid.lons[lon_index]
+            results_df["lat"] = self.grid.lats[lat_index]
+            self._results_df = results_df
+        return self._results_df
+
+    @property
+    def shared_grid(self):
+        """ :py:class:`parallel.SharedGrid` handle of the forecast grid
+        for worker processes, published on first access.
+        """
+        if self._shared_grid is None:
+            self._shared_grid = parallel.SharedGrid(self.grid)
+        return self._shared_grid
+
+    @property
+    def summed_area(self):
+        """ :py:class:`regrid.SummedAreaTable` integrating the grid over
+        boxes not matching it, built on first access. Only used by
+        :py:meth:`cell_search`, the evaluation of result grids does not
+        need it.
+        """
+        if self._summed_area is None:
+            self._summed_area = SummedAreaTable(self.grid)
+        return self._summed_area
+
+    @property
+    def nbytes(self):
+        """ Memory held by the locator in bytes.
+        """
+        nbytes = self.grid.nbytes + self.operators.nbytes
+        if self._summed_area is not None:
+            nbytes += self._summed_area.nbytes
+        if self._results_df is not None:
+            nbytes += self._results_df.memory_usage(index=True).sum()
+        return nbytes
 
     def cell_search(self, min_lon, max_lon,
                     min_lat, max_lat, grid_match=True):
-        """ Search through dataframe for result cells that overlap
+        """ Search the grid index for result cells that overlap
         with the submitted area. If grid_match then assume that there
         is only one result cell that matches, and reduce the search time.
 
@@ -91,68 +147,47 @@ class ResultLocator:
             index=[0])
         if grid_match:
             # Cater for original csep case in a more time efficient way.
-            lon = round(min_lon + self.lon_add, 2)
-            lat = round(min_lat + self.lat_add, 2)
-            mask_lon = self.results_df['lon'].values == lon
-            mask_lat = self.results_df['lat'].values == lat
-            result = self.results_df[mask_lon & mask_lat]
-            assert len(result) in [0, 1], ("One or zeros rows expected: "
-                                           f"{len(result)} rows returned")
-            if result.empty:
+            index = self.cell_index(min_lon + self.lon_add,
+                                    min_lat + self.lat_add)
+            if index is None:
                 return None
-            else:
-                result.drop(columns=['lat', 'lon'], axis=1)
-                result.reset_index(drop=True, inplace=True)
-                retval = pd.concat([result_row_df, result], axis=1)
-                return retval
+            result = pd.DataFrame([self.grid.rates[index]],
+                                  columns=self.mag_list)
+            return pd.concat([result_row_df, result], axis=1)
 
         else:
-            #result_area = (max_lon - min_lon) * (max_lat - min_lat)
-            # return all cells that have overlapping area
-            mask_grid = (
-                ((self.results_df['lon'].values + self.lon_add) >= min_lon) & # noqa
-                ((self.results_df['lon'].values - self.lon_add) < max_lon) & # noqa
-                ((self.results_df['lat'].values + self.lat_add) >= min_lat) & # noqa
-                ((self.results_df['lat'].values - self.lat_add) < max_lat)) # noqa
-            result = self.results_df[mask_grid].copy()
-            if result.empty:
-                return None
-
-            result['overlap'] = 0.0
-            # Calculate fractional overlap of each grid cell with
-            # result area
-            for ind, row in result.iterrows():
-                row_min_lon = row['lon'] - self.lon_add
-                row_max_lon = row['lon'] + self.lon_add
-                row_min_lat = row['lat'] - self.lat_add
-                row_max_lat = row['lat'] + self.lat_add
-                dx = min(max_lon, row_max_lon) - max(min_lon, row_min_lon)
-                dy = min(max_lat, row_max_lat) - max(min_lat, row_min_lat)
-                area = dx * dy
-                if area > 0.0:
-                    # Calculate the fraction of the cell that is occupied
-                    # by the result cell.
-                    row['overlap'] = area / self.cell_area
-                else:
-                    result.drop(index=ind, inplace=True)
-            # Calculate the contribution to the result from each cell.
-            result[self.mag_list] = result[self.mag_list].multiply(
-                result['overlap'], axis="index")
-            # group by dummy value to maintain dataframe shape and sum rows
-            result['dummy'] = 0
-            result = result.groupby('dummy').sum()
-            result.index_name = None
+            # Integrate all cells that have overlapping area, each
+            # weighted by the fraction of the cell occupied by the result
+            # cell.
+            overlap, rates = self.summed_area.integrate(
+                min_lon, max_lon, min_lat, max_lat)
 
             # If a result cell is only 'touching', the result should not
             # be returned
-            if result.empty or result['overlap'][0] < 1e-3:
+            if overlap < MIN_OVERLAP:
                 return None
             # Around edges, have assumed nearest expectation is valid
-            result.drop(columns=['lat', 'lon'], axis=1)
-            assert result.shape[0] in [0, 1], (
-                f"One or zeros rows expected: {len(row)} rows returned")
+            result = pd.DataFrame([rates], columns=self.mag_list)
+            result_row_df["overlap"] = overlap
             return pd.concat([result_row_df, result], axis=1)
 
+    def cell_index(self, lon, lat):
+        """ Grid index of the result cell centred on a location.
+
+        Locations within a small tolerance of a cell centre are accepted,
+        so that rounded coordinates are found.
+
+        :param float lon: Longitude of the cell centre, degrees.
+        :param float lat: Latitude of the cell centre, degrees.
+        :returns: Tuple (i, j) indexing the lon and lat axes of the grid,
+            or None if there is no result cell at the location.
+        """
+        i = int(self.grid.lon_index(lon))
+        j = int(self.grid.lat_index(lat))
+        if i < 0 or j < 0 or not self.grid.present[i, j]:
+            return None
+        return i, j
+
     def validate_reservoir(self, reservoir):
         """ Validate the input reservoir information
         against the information from the xml file.
@@ -167,46 +202,57 @@ class ResultLocator:
         assert max(depth_list) >= self.max_depth_km * 1000.
 
 
-def check_grid_match(reservoir_geom, lon_min, lon_max, lon_inc,
-                     lat_min, lat_max, lat_inc):
-    """ Check whether queried results grid matches the results
-    grid available from the xml file.
-    Right now, this only checks if the two grids are identical,
-    and does not check whether one grid has same resolution
-    but is of a different total dimension.
+# Loaded locators are shared between requests of a worker process.
+LOCATOR_REGISTRY = LocatorRegistry(ResultLocator)
+
+
+def configure_result_locators(shared_memory=False):
+    """ Configure how locators are loaded by this process. Registered
+    locators are removed if the configuration changes.
+
+    :param bool shared_memory: Map the forecast grids from shared memory
+        segments held by all processes of the host, see
+        :py:class:`SharedForecast`.
+    """
+    factory = functools.partial(ResultLocator, shared_memory=shared_memory)
+    current = LOCATOR_REGISTRY.factory
+    if isinstance(current, functools.partial) and \
+            current.keywords == factory.keywords:
+        return
+    LOCATOR_REGISTRY.factory = factory
+    LOCATOR_REGISTRY.invalidate()
+
+
+# Model outputs of recently requested reservoirs.
+RESULT_CACHE = ResultCache()
+
+
+def configure_result_cache(maxsize=16, spill_dir=None):
+    """ Configure the model output cache of this process.
+
+    :param int maxsize: Maximum number of outputs held in memory.
+    :param spill_dir: Directory evicted outputs are spilled to.
+    """
+    RESULT_CACHE.configure(maxsize, spill_dir)
+
+
+def get_result_locator(tag_url=CSEP_TAG_URL, xml_filename=XML_FILENAME):
+    """ Return the registered :py:class:`ResultLocator` of a forecast
+    file, loading it on first use.
+    """
+    return LOCATOR_REGISTRY.get(path.join(ABS_PATH, xml_filename), tag_url)
+
 
-    :param reservoir_geom: dict keys: [x, y, z] each element contains
-        a list of values describing the edges of the forecast areas.
-    :param lon_min: minimum longitude of xml result.
-    :param lon_max: maximum longitude of xml result.
-    :param lat_min: minimum longitude of xml result.
-    :param lat_max: maximum longitude of xml result.
+def invalidate_result_locators(xml_filename=None, tag_url=None):
+    """ Remove registered locators, forcing a reload on next use.
 
-    :rtype: Bool describing whether thegrid matches.
+    :param xml_filename: Only remove locators of this forecast file.
+    :param tag_url: Only remove locators loaded with this namespace.
     """
-    model_lon_list = nround(arange(lon_min, lon_max, lon_inc), 2).\
-        tolist()
-    model_lat_list = nround(arange(lat_min, lat_max, lat_inc), 2).\
-        tolist()
-
-    # compare with reservoir geom
-    compare_lon = reservoir_geom['x'] == model_lon_list
-    compare_lat = reservoir_geom['y'] == model_lat_list
-    # Figure out what to do for non-matching depths
-    # where depth within range, allow and scale expected
-    # values accordingly
-    # where depth values are out of range, return full
-    # expected value?
-    grid_match = True
-    if not compare_lon:
-        logger.warn("input longitudes do not match model longitudes"
-                    "new_grid will be generated")
-        grid_match = False
-    if not compare_lat:
-        logger.warn("input latitudes do not match model latitudes"
-                    "new_grid will be generated")
-        grid_match = False
-    return grid_match
+    if xml_filename is not None:
+        xml_filename = path.join(ABS_PATH, xml_filename)
+    LOCATOR_REGISTRY.invalidate(xml_filename, tag_url)
+
 
 def forecast_scaling(returned_df, mag_column_names):
     # The database stores values in a values per year format,
@@ -215,51 +261,139 @@ def forecast_scaling(returned_df, mag_column_names):
     return returned_df
 
 
-def exec_model(reservoir_geom):
-    """
-    Access model results
+def iter_exec_model(reservoir_geom, tile_size=None, n_workers=None,
+                    xml_filename=XML_FILENAME, min_mag=None, max_mag=None,
+                    mag_increment=None):
+    """ Access model results in spatial tiles.
+
+    The requested grid is validated and prepared immediately, the result
+    cells are evaluated lazily, one tile of longitude columns at a time,
+    so that memory use is bounded by the tile size rather than the size of
+    the reservoir. With several worker processes the tiles are evaluated
+    in parallel and yielded in order, so that the results are the same as
+    those of the serial evaluation.
+
+    All depth layers of the forecast are evaluated laterally at once and
+    distributed over the requested depth slices by their overlap, see
+    :py:func:`regrid.depth_weights`. The result DataFrames hold a row per
+    result cell and depth slice, ordered by cell, then by depth slice.
+    The magnitude bins of every tile are selected and merged before the
+    depth slices are expanded, see :py:class:`MagnitudeBins`.
+
+    :param reservoir_geom: Reservoir geometry with coordinate lists 'x',
+        'y' and 'z'.
+    :param int tile_size: Number of result cell columns per tile. See
+        :py:func:`parallel.tile_columns` for the default.
+    :param int n_workers: Number of worker processes. The tiles are
+        evaluated in the calling process if not given.
+    :param str xml_filename: Forecast file name.
+    :param min_mag: Minimum reference magnitude of the returned bins.
+    :param max_mag: Maximum reference magnitude of the returned bins.
+    :param mag_increment: Width of the returned magnitude bins. The bins
+        of the forecast are returned as they are by default.
+    :returns: Tuple of a generator of result DataFrames, one per tile, the
+        magnitude bins, the magnitude of completeness and the depth of the
+        forecast, km.
     """
-    # Initialize class from xml data for easy data access
-    result_locator = ResultLocator()
+    # Locators are loaded once per process and shared between requests
+    with span('xml_load'):
+        result_locator = get_result_locator(xml_filename=xml_filename)
     result_locator.validate_reservoir(reservoir_geom)
+    mag_bins = MagnitudeBins(result_locator.mag_list, min_mag, max_mag,
+                             mag_increment)
+
+    # All result cells of a tile are evaluated at once rather than searched
+    # for one by one.
+    lon_edges = cell_edges(reservoir_geom['x'], result_locator.lon_add)
+    lat_edges = cell_edges(reservoir_geom['y'], result_locator.lat_add)
+    # Grids aligned with the model grid are sliced or summed from the
+    # model rates, others are evaluated through overlap weights.
+    with span('grid_match'):
+        alignment = analyse_alignment(result_locator.grid, lon_edges,
+                                      lat_edges)
+    logger.info("Alignment of the grid with the original model grid: "
+                f"{alignment}")
+    n_layers = len(result_locator.grid.depth_layers)
+    weights = depth_weights(reservoir_geom['z'],
+                            result_locator.grid.depth_layers)
+    n_workers = parallel.worker_count(n_workers)
+    tiles = parallel.tile_columns(len(lon_edges) - 1, tile_size, n_workers)
+    if n_workers > 1 and len(tiles) > 1:
+        logger.info(f"Evaluating {len(tiles)} tiles on {n_workers} "
+                    "processes.")
+        results = parallel.imap_tiles(
+            result_locator.shared_grid, lon_edges, lat_edges, tiles,
+            alignment, n_workers)
+    else:
+        layer_grid = result_locator.grid.layer_grid()
+        results = (evaluate_grid(layer_grid, lon_edges, lat_edges,
+                                 alignment=alignment,
+                                 operators=result_locator.operators,
+                                 columns=tile)
+                   for tile in tiles)
+    columns = RESULT_COLUMNS + mag_bins.mag_list
+
+    def result_tiles():
+        logger.info("Starting results collection for input spatial grid")
+        n_cells = 0
+        while True:
+            # Tiles are evaluated on demand, only time the evaluation.
+            with span('cell_search'):
+                tile = next(results, None)
+            if tile is None:
+                break
+            with span('mag_binning'):
+                tile = mag_bins.rebin_result(tile, n_layers)
+            with span('depth_weighting'):
+                tile = contract_depth(tile, weights)
+            tile_df = pd.DataFrame(tile, columns=columns)
+            if not tile_df.empty:
+                # Scale by forecast time from 5 year value to one year value
+                with span('forecast_scaling'):
+                    tile_df = forecast_scaling(tile_df, mag_bins.mag_list)
+            n_cells += len(tile_df)
+            yield tile_df
+        logger.info(f"Successfully returning {n_cells} subgeometries "
+                    "from model.")
 
-    returned_df = pd.DataFrame(
-        columns=["min_lon", "max_lon", "min_lat", "max_lat", "overlap"].extend(
-            result_locator.mag_list))
-    grid_match = check_grid_match(reservoir_geom,
-                                  result_locator.lon_min,
-                                  result_locator.lon_max,
-                                  result_locator.lon_increment,
-                                  result_locator.lat_min,
-                                  result_locator.lat_max,
-                                  result_locator.lat_increment)
-    logger.info("Check if the grid matches the original model grid: "
-                f"{grid_match}")
-
-    logger.info("Starting results collection for input spatial grid")
-    min_lon = round(reservoir_geom['x'][0] - result_locator.lon_add, 2)
-    min_lat = round(reservoir_geom['y'][0] - result_locator.lat_add, 2)
-
-    for lon in reservoir_geom['x'][:-1]:
-        max_lon = round(lon + result_locator.lon_add, 2)
-        for lat in reservoir_geom['y'][:-1]:
-            max_lat = round(lat + result_locator.lat_add, 2)
-            cell_results = result_locator.cell_search(
-                min_lon, max_lon, min_lat, max_lat, grid_match=grid_match)
-            if cell_results is None:
-                pass
-            else:
-                returned_df = pd.concat([returned_df, cell_results],
-                                        ignore_index=True)
-            min_lat = max_lat
-        min_lon = max_lon
-
-    if not returned_df.empty:
-        # Scale by forecast time from 5 year value to one year value
-        returned_df = forecast_scaling(returned_df,
-                                       result_locator.mag_list)
     mc = MAGNITUDE_COMPLETENESS
-    logger.info(f"Successfully returning {len(returned_df)} subgeometries "
-                "from model.")
     depth_km = abs(result_locator.max_depth_km - result_locator.min_depth_km)
-    return returned_df, result_locator.mag_list, mc, depth_km
+    return result_tiles(), mag_bins.mag_list, mc, depth_km
+
+
+def exec_model(reservoir_geom, xml_filename=XML_FILENAME, n_workers=None,
+               cache=None, min_mag=None, max_mag=None, mag_increment=None):
+    """
+    Access model results
+
+    :param int n_workers: Number of worker processes evaluating the
+        result grid in tiles, see :py:func:`iter_exec_model`.
+    :param cache: Optional :py:class:`ResultCache` the output is looked up
+        in and added to. The cached result DataFrame must not be modified.
+    :param min_mag: Minimum reference magnitude of the returned bins.
+    :param max_mag: Maximum reference magnitude of the returned bins.
+    :param mag_increment: Width of the returned magnitude bins.
+    """
+    if cache is not None:
+        mag_bins = MagnitudeBins(
+            get_result_locator(xml_filename=xml_filename).mag_list,
+            min_mag, max_mag, mag_increment)
+        key = result_key(reservoir_geom, path.join(ABS_PATH, xml_filename),
+                         mag_bins=mag_bins)
+        output = cache.get(key)
+        if output is not None:
+            logger.info("Returning cached model output.")
+            return output
+
+    tiles, mag_list, mc, depth_km = iter_exec_model(
+        reservoir_geom, n_workers=n_workers, xml_filename=xml_filename,
+        min_mag=min_mag, max_mag=max_mag, mag_increment=mag_increment)
+    tiles = list(tiles)
+    if len(tiles) == 1:
+        returned_df, = tiles
+    else:
+        returned_df = pd.concat(tiles, ignore_index=True)
+    output = returned_df, mag_list, mc, depth_km
+    if cache is not None:
+        cache.put(key, output)
+    return output
@@ -3,6 +3,8 @@
 SFM-Worker (server) related general purpose utilities.
 """
 
+import logging
+import time
 import uuid
 
 from flask import Flask, g
@@ -21,6 +23,17 @@ def create_app(config_dict={}):
     app.config.update(config_dict)
     db.init_app(app)
 
+    model_defaults = app.config.get('RAMSIS_SFM_DEFAULTS', {})
+    from ramsis.sfm.werhiressmom1italy5y.server.scheduler import SCHEDULER
+    SCHEDULER.configure(
+        max_running=model_defaults.get('max_running', SCHEDULER.max_running),
+        max_queued=model_defaults.get('max_queued', SCHEDULER.max_queued))
+    from ramsis.sfm.werhiressmom1italy5y.server import metrics
+    metrics.init_app(app, metrics_dir=model_defaults.get('metrics_dir'))
+
+    if app.config.get('PRELOAD'):
+        preload(app)
+
     # XXX(damb): Avoid circular imports.
     from ramsis.sfm.werhiressmom1italy5y.server.v1 import blueprint as api_v1_bp, API_VERSION_V1
     app.register_blueprint(
@@ -34,4 +47,30 @@ def create_app(config_dict={}):
         """
         g.request_id = uuid.uuid4()
 
+    @app.after_request
+    def return_request_id(response):
+        """
+        Return the request identifier, which model run timings are
+        retrievable by.
+        """
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = str(g.request_id)
+        return response
+
     return app
+
+
+def preload(app):
+    """
+    Warm up the model before serving requests, see
+    :py:func:`model_adaptor.warm_up`.
+
+    :param app: Flask application configured with the model defaults.
+    """
+    from ramsis.sfm.werhiressmom1italy5y.server.model_adaptor import warm_up
+    logger = logging.getLogger('ramsis.sfm.worker.model_adaptor')
+    start = time.time()
+    locator, n_cells = warm_up(app.config['RAMSIS_SFM_DEFAULTS'])
+    logger.info(f"Model warmed up in {time.time() - start:.2f} s: "
+                f"{locator.nbytes} bytes loaded, {n_cells} default grid "
+                "cells evaluated.")
@@ -4,9 +4,13 @@ RAMSIS WerHiResSmoM1Italy5y SFM-Worker implementation.
 """
 
 import argparse
+import atexit
 import copy
 import json
+import os
+import shutil
 import sys
+import tempfile
 import traceback
 import multiprocessing
 
@@ -96,6 +100,44 @@ class WerHiResSmoM1Italy5yWorkerWebservice(App):
         parser.add_argument('-p', '--port', metavar='PORT', type=int,
                             default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_PORT,
                             help='server port')
+        parser.add_argument('--host', metavar='HOST',
+                            default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_HOST,
+                            help='server host (default: %(default)s)')
+        parser.add_argument('--server', choices=('local', 'production'),
+                            default='local',
+                            help=("WSGI server: 'local' is the Werkzeug "
+                                  "development server, 'production' a "
+                                  "pre-forking gunicorn server. "
+                                  "(default: %(default)s)"))
+        parser.add_argument('--workers', metavar='NUM', type=int,
+                            default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_WORKERS,
+                            help=('number of production server worker '
+                                  'processes. The max_running and '
+                                  'max_queued model defaults apply per '
+                                  'worker process (default: %(default)s)'))
+        parser.add_argument('--threads', metavar='NUM', type=int,
+                            default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_THREADS,
+                            help=('number of threads per production server '
+                                  'worker (default: %(default)s)'))
+        parser.add_argument('--keep-alive', metavar='SECONDS', type=int,
+                            dest='keep_alive',
+                            default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_KEEPALIVE,
+                            help=('seconds to wait for requests on a '
+                                  'keep-alive connection (default: '
+                                  '%(default)s)'))
+        parser.add_argument('--backlog', metavar='NUM', type=int,
+                            default=settings.RAMSIS_WORKER_WerHiResSmoM1Italy5y_BACKLOG,
+                            help=('maximum number of pending connections '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--preload', dest='preload',
+                            action='store_true', default=True,
+                            help=('load the forecast grid and warm up the '
+                                  'model before serving requests '
+                                  '(default)'))
+        parser.add_argument('--no-preload', dest='preload',
+                            action='store_false',
+                            help=('load the forecast grid on the first '
+                                  'request, starting faster'))
         parser.add_argument('--model-defaults', metavar='DICT',
                             type=model_defaults, dest='model_defaults',
                             default=settings.RAMSIS_WORKER_SFM_DEFAULTS,
@@ -122,8 +164,12 @@ class WerHiResSmoM1Italy5yWorkerWebservice(App):
             self.logger.debug(
                 'Model defaults configured: {!r}'.format(
                     self.args.model_defaults))
-            self.logger.info('Serving with local WSGI server.')
-            app.run(threaded=True, debug=True, port=self.args.port)
+            if self.args.server == 'production':
+                self.serve_production(app)
+            else:
+                self.logger.info('Serving with local WSGI server.')
+                app.run(threaded=True, debug=True, host=self.args.host,
+                        port=self.args.port)
 
         except Error as err:
             self.logger.error(err)
@@ -149,7 +195,13 @@ class WerHiResSmoM1Italy5yWorkerWebservice(App):
             'PORT': self.args.port,
             'SQLALCHEMY_DATABASE_URI': self.args.db_url,
             'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-            'RAMSIS_SFM_DEFAULTS': self.args.model_defaults,
+            # The DB URL is passed on to the model adaptor for bulk
+            # persistence of results.
+            'RAMSIS_SFM_DEFAULTS': dict(self.args.model_defaults,
+                                        db_url=self.args.db_url),
+            # Warm up the model before serving, in the master process of
+            # the production server before the workers are forked.
+            'PRELOAD': self.args.preload,
             'PATH_LOGGING_CONFIG': self.args.path_logging_conf,
             'LOG_ID': self.log_id
         }
@@ -157,6 +209,45 @@ class WerHiResSmoM1Italy5yWorkerWebservice(App):
 
         return app
 
+    def serve_production(self, app):
+        """
+        Serve the application with the production WSGI server. The
+        application, and with it the forecast grid if preloaded, is loaded
+        before forking the workers.
+
+        :param app: The configured Flask application instance.
+        """
+        try:
+            from ramsis.sfm.werhiressmom1italy5y.server.wsgi import WSGIServer
+        except ImportError as err:
+            raise Error(
+                f"The production server requires gunicorn ({err}). Install "
+                "the 'production' extra.")
+
+        from ramsis.sfm.werhiressmom1italy5y.server.metrics import METRICS
+        if METRICS.metrics_dir is None:
+            # The workers share their metrics through a directory removed
+            # when the server exits.
+            metrics_dir = tempfile.mkdtemp(prefix='ramsis-metrics-')
+            METRICS.configure(metrics_dir)
+            pid = os.getpid()
+            atexit.register(
+                lambda: os.getpid() == pid and shutil.rmtree(
+                    metrics_dir, ignore_errors=True))
+        # Includes the warm-up of the application.
+        METRICS.flush()
+
+        options = {
+            'bind': f'{self.args.host}:{self.args.port}',
+            'workers': self.args.workers,
+            'threads': self.args.threads,
+            'keepalive': self.args.keep_alive,
+            'backlog': self.args.backlog,
+            'post_fork': lambda server, worker: METRICS.after_fork()}
+        self.logger.info(
+            'Serving with production WSGI server: {!r}'.format(options))
+        WSGIServer(app, options=options).run()
+
 
 # ----------------------------------------------------------------------------
 def main():
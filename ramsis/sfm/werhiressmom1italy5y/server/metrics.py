@@ -0,0 +1,464 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Metrics of the worker webservice in the Prometheus text exposition format.
+
+Every process keeps its own counters and histograms. If a metrics
+directory is configured, each process writes a snapshot of its metrics to
+a file of its own in the directory whenever they change, and the metrics
+served are the sum over all snapshots, so that they aggregate across the
+processes of a pre-forking server. Counters and histograms of exited
+processes are merged into a single retired snapshot and their own
+snapshots are removed, gauges are only summed over live processes.
+"""
+import fcntl
+import glob
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from os import path
+
+from flask import g, request
+
+LOGGER = 'ramsis.sfm.worker.metrics'
+logger = logging.getLogger(LOGGER)
+
+PREFIX = 'ramsis_worker_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+RUN_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+               600.0)
+
+# Help texts and types of the metrics served.
+METRICS_HELP = OrderedDict([
+    ('http_requests_total',
+     ('counter', 'HTTP requests handled, by route, method and status.')),
+    ('http_request_duration_seconds',
+     ('histogram', 'HTTP request latency, by route and method.')),
+    ('model_run_duration_seconds',
+     ('histogram', 'Model run duration including queueing, by outcome.')),
+    ('model_cells_total',
+     ('counter', 'Result cells produced by model runs.')),
+    ('model_subgeometries_total',
+     ('counter', 'Subgeometries produced by model runs.')),
+    ('result_cache_hits_total',
+     ('counter', 'Model outputs served from the result cache.')),
+    ('result_cache_misses_total',
+     ('counter', 'Model outputs not found in the result cache.')),
+    ('forecast_grid_loads_total',
+     ('counter', 'Forecast grids loaded.')),
+    ('forecast_grid_load_seconds_total',
+     ('counter', 'Time spent loading forecast grids.')),
+    ('model_runs_in_flight',
+     ('gauge', 'Model runs executing.')),
+    ('model_runs_queued',
+     ('gauge', 'Model runs waiting for execution.')),
+    ('process_resident_memory_bytes',
+     ('gauge', 'Resident memory of the worker processes.')),
+    ('processes',
+     ('gauge', 'Live worker processes reporting metrics.'))])
+
+# Snapshot of the counters and histograms of exited processes.
+RETIRED = 'retired.snapshot'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_memory():
+    """ Current resident set size of this process in bytes, the peak size
+    where the current one is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """ Metrics of this process.
+
+    :param metrics_dir: Directory the snapshots of all processes are
+        written to. None serves the metrics of this process only.
+    """
+
+    def __init__(self, metrics_dir=None):
+        self.metrics_dir = metrics_dir
+        self._lock = threading.RLock()
+        self._counters = {}
+        self._histograms = {}
+        # Callables returning cumulative counter values, and gauge values,
+        # of state kept elsewhere, by metric name.
+        self._counter_collectors = OrderedDict()
+        self._gauge_collectors = OrderedDict()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._token = uuid.uuid4().hex
+        self._counters.clear()
+        self._histograms.clear()
+        # Values collected from state inherited by a forked process are
+        # accounted for by its parent.
+        self._baseline = {name: collect()
+                          for name, collect in
+                          self._counter_collectors.items()}
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def after_fork(self):
+        """ Start counting anew in a forked process.
+        """
+        with self._lock:
+            self._reset()
+
+    def configure(self, metrics_dir=None, clear=False):
+        """ Configure the metrics directory.
+
+        :param metrics_dir: Directory of the snapshots.
+        :param bool clear: Remove the snapshots of previous processes,
+            e.g. when the server is started.
+        """
+        with self._lock:
+            self.metrics_dir = metrics_dir
+            if metrics_dir is None:
+                return
+            os.makedirs(metrics_dir, exist_ok=True)
+            if clear:
+                for snapshot_path in glob.glob(path.join(metrics_dir,
+                                                         '*.json')):
+                    _remove(snapshot_path)
+                _remove(path.join(metrics_dir, RETIRED))
+
+    def register_counter(self, name, collect):
+        """ Serve a counter kept elsewhere.
+
+        :param str name: Metric name.
+        :param collect: Callable returning the cumulative value.
+        """
+        with self._lock:
+            self._counter_collectors[name] = collect
+            self._baseline[name] = 0
+
+    def register_gauge(self, name, collect):
+        """ Serve a gauge.
+
+        :param str name: Metric name.
+        :param collect: Callable returning the current value.
+        """
+        with self._lock:
+            self._gauge_collectors[name] = collect
+
+    def inc(self, name, value=1, **labels):
+        """ Increment a counter.
+        """
+        with self._lock:
+            self._check_fork()
+            key = (name, _labels(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=REQUEST_BUCKETS, **labels):
+        """ Add an observation to a histogram.
+        """
+        with self._lock:
+            self._check_fork()
+            key = (name, _labels(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': list(buckets),
+                    'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """ Metrics of this process.
+
+        :rtype: dict
+        """
+        with self._lock:
+            self._check_fork()
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self._counters.items()]
+            for name, collect in self._counter_collectors.items():
+                counters.append([name, [], collect() - self._baseline[name]])
+            return {
+                'pid': self._pid,
+                'counters': counters,
+                'histograms': [[name, list(labels),
+                                dict(histogram,
+                                     counts=list(histogram['counts']))]
+                               for (name, labels), histogram in
+                               self._histograms.items()],
+                'gauges': [[name, [], collect()]
+                           for name, collect in
+                           self._gauge_collectors.items()] +
+                [['process_resident_memory_bytes', [], resident_memory()],
+                 ['processes', [], 1]]}
+
+    def flush(self):
+        """ Write the snapshot of this process to the metrics directory.
+        """
+        if self.metrics_dir is None:
+            return
+        try:
+            _write(self._snapshot_path(), self.snapshot())
+        except OSError as err:
+            logger.warning(f"Unable to write metrics: {err}")
+
+    def _snapshot_path(self):
+        return path.join(self.metrics_dir, f"{self._pid}-{self._token}.json")
+
+    def collect(self):
+        """ Snapshots of all processes, the one of this process being
+        current.
+        """
+        own = self.snapshot()
+        if self.metrics_dir is None:
+            return [own]
+        self.flush()
+        snapshots = []
+        exited = []
+        for snapshot_path in glob.glob(path.join(self.metrics_dir,
+                                                 '*.json')):
+            if snapshot_path == self._snapshot_path():
+                continue
+            snapshot = _read(snapshot_path)
+            if snapshot is None:
+                continue
+            if _alive(snapshot['pid']):
+                snapshots.append(snapshot)
+            else:
+                exited.append(snapshot_path)
+        retired = self._retire(exited)
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots + [own]
+
+    def _retire(self, snapshot_paths):
+        """ Merge the snapshots of exited processes into the retired
+        snapshot and remove them.
+
+        :returns: The retired snapshot, or None if there is none.
+        """
+        retired_path = path.join(self.metrics_dir, RETIRED)
+        if not snapshot_paths:
+            return _read(retired_path)
+        try:
+            with open(retired_path + '.lock', 'a') as lock:
+                # Processes collecting at the same time must not merge a
+                # snapshot twice.
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                retired = _read(retired_path)
+                merged = []
+                for snapshot_path in snapshot_paths:
+                    snapshot = _read(snapshot_path)
+                    if snapshot is not None:
+                        merged.append(snapshot)
+                if not merged:
+                    return retired
+                if retired is not None:
+                    merged.insert(0, retired)
+                retired = _merge(merged)
+                _write(retired_path, retired)
+                for snapshot_path in snapshot_paths:
+                    _remove(snapshot_path)
+                return retired
+        except OSError as err:
+            logger.warning(f"Unable to retire metrics snapshots: {err}")
+            return _read(retired_path)
+
+    def render(self):
+        """ Metrics of all processes in the Prometheus text format.
+
+        :rtype: str
+        """
+        samples = OrderedDict((name, OrderedDict()) for name in METRICS_HELP)
+        for snapshot in self.collect():
+            for kind in ('counters', 'gauges'):
+                for name, labels, value in snapshot[kind]:
+                    series = samples.setdefault(name, OrderedDict())
+                    key = tuple(map(tuple, labels))
+                    series[key] = series.get(key, 0) + value
+            for name, labels, histogram in snapshot['histograms']:
+                series = samples.setdefault(name, OrderedDict())
+                key = tuple(map(tuple, labels))
+                total = series.setdefault(key, {
+                    'buckets': histogram['buckets'],
+                    'counts': [0] * len(histogram['buckets']),
+                    'sum': 0.0, 'count': 0})
+                total['counts'] = [a + b for a, b in zip(total['counts'],
+                                                         histogram['counts'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+
+        lines = []
+        for name, series in samples.items():
+            kind, help_text = METRICS_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for labels, value in series.items():
+                if kind != 'histogram':
+                    lines.append(f"{PREFIX}{name}{_format(labels)} "
+                                 f"{_number(value)}")
+                    continue
+                for bound, count in zip(value['buckets'], value['counts']):
+                    lines.append(
+                        f"{PREFIX}{name}_bucket"
+                        f"{_format(labels + (('le', _number(bound)),))} "
+                        f"{count}")
+                lines.append(f"{PREFIX}{name}_bucket"
+                             f"{_format(labels + (('le', '+Inf'),))} "
+                             f"{value['count']}")
+                lines.append(f"{PREFIX}{name}_sum{_format(labels)} "
+                             f"{_number(value['sum'])}")
+                lines.append(f"{PREFIX}{name}_count{_format(labels)} "
+                             f"{value['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def init_app(app, metrics_dir=None):
+    """
+    Record the requests of an application and serve the state of the model
+    caches and the model run queue.
+
+    :param app: Flask application.
+    :param metrics_dir: Directory of the snapshots of all processes
+        serving the application. Snapshots of previous processes are
+        removed.
+    """
+    # XXX: Avoid circular imports.
+    from ramsis.sfm.werhiressmom1italy5y.core import werner_model
+    from ramsis.sfm.werhiressmom1italy5y.server.scheduler import SCHEDULER
+
+    METRICS.configure(metrics_dir, clear=True)
+    METRICS.register_counter('result_cache_hits_total',
+                             lambda: werner_model.RESULT_CACHE.hits)
+    METRICS.register_counter('result_cache_misses_total',
+                             lambda: werner_model.RESULT_CACHE.misses)
+    METRICS.register_counter('forecast_grid_loads_total',
+                             lambda: werner_model.LOCATOR_REGISTRY.misses)
+    METRICS.register_counter(
+        'forecast_grid_load_seconds_total',
+        lambda: werner_model.LOCATOR_REGISTRY.load_seconds)
+    METRICS.register_gauge('model_runs_in_flight', lambda: SCHEDULER.running)
+    METRICS.register_gauge('model_runs_queued', lambda: SCHEDULER.queued)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        METRICS.inc('http_requests_total', route=route,
+                    method=request.method, status=response.status_code)
+        if 'request_start' in g:
+            METRICS.observe('http_request_duration_seconds',
+                            time.perf_counter() - g.request_start,
+                            route=route, method=request.method)
+        METRICS.flush()
+        return response
+
+
+def _merge(snapshots):
+    """ Snapshot of the sums of the counters and histograms of snapshots.
+    """
+    counters = OrderedDict()
+    histograms = OrderedDict()
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, {
+                'buckets': histogram['buckets'],
+                'counts': [0] * len(histogram['buckets']),
+                'sum': 0.0, 'count': 0})
+            total['counts'] = [a + b for a, b in zip(total['counts'],
+                                                     histogram['counts'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+    return {
+        'pid': None,
+        'counters': [[name, list(labels), value]
+                     for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), histogram]
+                       for (name, labels), histogram in histograms.items()],
+        'gauges': []}
+
+
+def _read(snapshot_path):
+    try:
+        with open(snapshot_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logger.debug(f"Skipping metrics snapshot: {err}")
+        return None
+
+
+def _write(snapshot_path, snapshot):
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(snapshot_path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"')
+                         .replace('\n', r'\n'))
+        for k, v in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _remove(file_path):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+# Metrics of this process.
+METRICS = Metrics()
@@ -4,14 +4,23 @@ WerHiResSmoM1Italy5y model adaptor facilities.
 """
 import traceback
 from collections import ChainMap
+from contextlib import ExitStack
 import numpy as np
 from datetime import timedelta
 
+from flask import g, has_app_context
+
 from ramsis.sfm.worker import orm
 from ramsis.sfm.worker.model_adaptor import \
     ModelAdaptor as _ModelAdaptor, ModelError, ModelResult
 from ramsis.sfm.werhiressmom1italy5y.core import \
-    werner_model
+    instrument, werner_model
+from ramsis.sfm.werhiressmom1italy5y.server.metrics import \
+    METRICS, RUN_BUCKETS
+from ramsis.sfm.werhiressmom1italy5y.server.persistence import \
+    BulkResultWriter, discretemfd_shareable
+from ramsis.sfm.werhiressmom1italy5y.server.scheduler import \
+    SCHEDULER, reservoir_cells
 
 # Example of a model adaptor. This takes inputs from the base worker
 # and converts data to something the model can consume. Further validations
@@ -25,6 +34,152 @@ class ValidationError(WerHiResSmoM1Italy5yError):
     """ValidationError ({})."""
 
 
+class MFDBuilder:
+    """
+    Builds :py:class:`orm.DiscreteMFD` instances from event number vectors.
+
+    If the worker schema allows a MFD to be referenced by several samples,
+    a single instance is shared by all samples with identical event numbers,
+    e.g. all epochs of a subgeometry.
+
+    :param mag_list: Reference magnitudes of the bins.
+    :param min_mag: Minimum magnitude of the MFDs.
+    :param max_mag: Maximum magnitude of the MFDs.
+    :param float binwidth: Width of the magnitude bins.
+    :param bool shared: Share instances between samples.
+    """
+
+    def __init__(self, mag_list, min_mag, max_mag, binwidth, shared=True):
+        self.mag_list = mag_list
+        self.min_mag = min_mag
+        self.max_mag = max_mag
+        self.binwidth = binwidth
+        self.shared = shared
+        self._mfds = {}
+
+    def __call__(self, event_numbers, uncertainties=None):
+        """
+        :param event_numbers: Array of event numbers per magnitude bin.
+        :param uncertainties: Array of the event number uncertainties,
+            computed from the event numbers if not given.
+        :rtype: :py:class:`orm.DiscreteMFD`
+        """
+        key = event_numbers.tobytes()
+        if self.shared and key in self._mfds:
+            return self._mfds[key]
+
+        # Question: a variance/uncertainty at this level
+        # won't propagate to OQ hazard, so what would
+        # be preferential to store, given the
+        # choice between:
+        # uncertainty/variance/confidencelevel/any?
+        if uncertainties is None:
+            uncertainties = np.sqrt(event_numbers)
+        mfd_curve = orm.DiscreteMFD(
+            minmag=self.min_mag,
+            maxmag=self.max_mag,
+            binwidth=self.binwidth,
+            magbins=[orm.MFDBin(referencemagnitude=mag_bin,
+                                eventnumber_value=event_number,
+                                eventnumber_uncertainty=uncertainty)
+                     for mag_bin, event_number, uncertainty in zip(
+                         self.mag_list, event_numbers.tolist(),
+                         uncertainties.tolist())])
+        if self.shared:
+            self._mfds[key] = mfd_curve
+        return mfd_curve
+
+
+# Result columns bounding the cell of a subgeometry.
+CELL_BOUNDS = ['min_lon', 'max_lon', 'min_lat', 'max_lat']
+
+
+def event_numbers_by_slice(forecast_values, mag_list, n_depths):
+    """
+    Event numbers of every result cell and depth slice.
+
+    :param forecast_values: Model output with a row per result cell and
+        depth slice, ordered by cell, then by depth slice.
+    :param mag_list: Magnitude bin columns.
+    :param int n_depths: Number of depth slices of the reservoir.
+    :returns: Array of shape (cells, depth slices, mag).
+    """
+    return np.asarray(forecast_values[mag_list].values, dtype=float).\
+        reshape(-1, n_depths, len(mag_list))
+
+
+def request_id():
+    """
+    Identifier of the request a model run was submitted by, generated by
+    the application for every request, or None outside of a request.
+    """
+    if has_app_context():
+        request_id = g.get('request_id')
+        if request_id is not None:
+            return str(request_id)
+    return None
+
+
+def scheduler_ticket():
+    """
+    Reservation of the model run of the request, see
+    :py:meth:`JobScheduler.admit`, or None outside of a request.
+    """
+    if has_app_context():
+        return g.get('scheduler_ticket')
+    return None
+
+
+def magnitude_bins(model_config):
+    """
+    Requested magnitude bins of a model configuration, as keyword
+    arguments of :py:func:`werner_model.exec_model`.
+
+    :param model_config: Model parameters.
+    """
+    return {'min_mag': model_config.get('model_min_mag'),
+            'max_mag': model_config.get('model_max_mag'),
+            'mag_increment': model_config.get('mag_increment')}
+
+
+def result_cache(model_defaults):
+    """
+    Configure the model output cache from the model defaults.
+
+    :returns: The cache, or None if disabled.
+    """
+    maxsize = model_defaults.get("result_cache_size")
+    if not maxsize:
+        return None
+    werner_model.configure_result_cache(
+        maxsize=maxsize, spill_dir=model_defaults.get("result_cache_dir"))
+    return werner_model.RESULT_CACHE
+
+
+def warm_up(model_defaults):
+    """
+    Load the forecast grid used by the model adaptor and evaluate it once
+    on the default reservoir, so that the first request does not pay for
+    loading the grid, mapping its pages or building lookup structures.
+    The output is added to the result cache, if enabled.
+
+    :param dict model_defaults: Model default configuration.
+    """
+    werner_model.configure_result_locators(
+        shared_memory=bool(model_defaults.get("shared_memory")))
+    xml_filename = model_defaults.get("xml_filename",
+                                      werner_model.XML_FILENAME)
+    # Evaluated in this process, worker processes must not be started
+    # before the server forks. The magnitude bins are the default bins of
+    # requests, so that the output is found in the cache.
+    forecast_values, *_ = werner_model.exec_model(
+        model_defaults["reservoir"]["geom"], xml_filename=xml_filename,
+        cache=result_cache(model_defaults),
+        **magnitude_bins(model_defaults.get("model_parameters", {})))
+    locator = werner_model.get_result_locator(xml_filename=xml_filename)
+    return locator, len(forecast_values)
+
+
 class ModelAdaptor(_ModelAdaptor):
     """
     WerHiResSmoM1Italy5y model implementation running the
@@ -35,6 +190,13 @@ class ModelAdaptor(_ModelAdaptor):
         WKT format.
     :param dict model_parameters: Dictionary of model parameters used by
         default.
+    :param str xml_filename: Forecast file, relative to the model core,
+        used instead of the Italy forecast.
+    :param int n_workers: Number of processes evaluating the result grid.
+    :param bool shared_memory: Share the forecast grid between the
+        processes of the host.
+    :param int result_cache_size: Number of model outputs cached.
+    :param str result_cache_dir: Directory cached outputs are spilled to.
     """
 
     LOGGER = 'ramsis.sfm.worker.model_adaptor'
@@ -47,11 +209,34 @@ class ModelAdaptor(_ModelAdaptor):
         self.model_defaults = kwargs
         self._default_reservoir = kwargs.get("reservoir")
         self._default_model_parameters = kwargs.get("model_parameters")
+        self._db_url = kwargs.get("db_url")
+        self._xml_filename = kwargs.get("xml_filename",
+                                        werner_model.XML_FILENAME)
+        self._n_workers = kwargs.get("n_workers")
+        werner_model.configure_result_locators(
+            shared_memory=bool(kwargs.get("shared_memory")))
+        self._result_cache = result_cache(kwargs)
 
     def _run(self, **kwargs):
         """
         :param kwargs: Model specific keyword value parameters.
         """
+        # The stages of the run are timed, see instrument.TRACES. The trace
+        # is only held by the thread of the run, an adaptor instance may
+        # serve several runs at once.
+        outcome = 'error'
+        try:
+            with instrument.trace(request_id()) as trace:
+                result = self._run_scenario(**kwargs)
+                outcome = 'ok'
+            return result
+        finally:
+            METRICS.observe('model_run_duration_seconds',
+                            trace.wall_seconds, buckets=RUN_BUCKETS,
+                            outcome=outcome)
+            METRICS.flush()
+
+    def _run_scenario(self, **kwargs):
         self.logger.debug(
             'Importing model specific configuration ...')
         # Simple chain map can combine parameters if they are a flat hierarchy
@@ -89,28 +274,60 @@ class ModelAdaptor(_ModelAdaptor):
             self.logger.info('No reservoir exists.')
             raise WerHiResSmoM1Italy5yError("No reservoir provided.")
 
+        # Bound the number of concurrent model runs, smaller reservoirs
+        # first.
+        with ExitStack() as stack:
+            with instrument.span('queue_wait'):
+                stack.enter_context(
+                    SCHEDULER.slot(reservoir_cells(reservoir_geom),
+                                   ticket=scheduler_ticket()))
+            return self._run_model(reservoir_geom, model_config,
+                                   datetime_list)
+
+    def _run_model(self, reservoir_geom, model_config, datetime_list):
+        """
+        Run the model on a reservoir geometry and build its results.
+        """
         self.logger.info("Calling the WerHiResSmoM1Italy5y model...")
 
-        # Return arrays for each result attribute.
+        # Return a generator of result tiles. The model output does not
+        # depend on the forecast window, repeated reservoirs are taken from
+        # the cache unless the results are streamed in tiles.
+        tile_size = model_config.get('tile_size')
+        # Only the requested magnitude bins are evaluated further.
+        mag_bins = magnitude_bins(model_config)
         try:
-            (forecast_values,
-             mag_list,
-             mc,
-             depth_km) = werner_model.exec_model(
-                reservoir_geom)
+            if self._result_cache is not None and not tile_size:
+                (forecast_values,
+                 mag_list,
+                 mc,
+                 depth_km) = werner_model.exec_model(
+                    reservoir_geom, xml_filename=self._xml_filename,
+                    n_workers=self._n_workers, cache=self._result_cache,
+                    **mag_bins)
+                forecast_tiles = iter([forecast_values])
+            else:
+                (forecast_tiles,
+                 mag_list,
+                 mc,
+                 depth_km) = werner_model.iter_exec_model(
+                    reservoir_geom, tile_size=tile_size,
+                    n_workers=self._n_workers,
+                    xml_filename=self._xml_filename, **mag_bins)
         except Exception:
             # sarsonl This is not nice, but we need to raise an error twice
             # if one occurs in the model to get a sensible traceback statement
             err = traceback.print_exc()
-            forecast_values = None
+            forecast_tiles = None
         else:
             err = False
         if err:
             raise
         # Quirk of set-up means that we need to raise another error.
-        if forecast_values is None:
+        if forecast_tiles is None:
             raise WerHiResSmoM1Italy5yError(
                 'Error raised in WerHiResSmoM1Italy5y model')
+        forecast_tiles = self._checked_tiles(forecast_tiles)
 
         self.logger.debug("Result received from WerHiResSmoM1Italy5y model.")
 
@@ -118,52 +335,62 @@ class ModelAdaptor(_ModelAdaptor):
         min_mag = min(mag_list)
         max_mag = max(mag_list)
         # Assume that the increment between bins is static and positive
-        mag_increment = round(float(mag_list[1]) - float(mag_list[0]), 1)
+        mag_increment = mag_bins['mag_increment'] or round(
+            float(mag_list[1]) - float(mag_list[0]), 1)
+
+        if model_config.get('bulk_persistence'):
+            reservoir = self._persist_bulk(
+                reservoir_geom, forecast_tiles, mag_list, mc,
+                datetime_list, (min_mag, max_mag, mag_increment))
+            return ModelResult.ok(
+                data={"reservoir": reservoir},
+                warning=self.stderr if self.stderr else self.stdout)
+
+        build_mfd = MFDBuilder(mag_list, min_mag, max_mag, mag_increment,
+                               shared=discretemfd_shareable())
+        depth_slices = list(zip(reservoir_geom['z'], reservoir_geom['z'][1:]))
+        epochs = list(zip(datetime_list, datetime_list[1:]))
         subgeoms = []
         samples = []
-        for index, row in forecast_values.iterrows():
-            # Validate the depths list in the parsing stage.
-            for min_depth, max_depth in \
-                    zip(reservoir_geom['z'], reservoir_geom['z'][1:]):
-                depth_fraction = (max_depth - min_depth) / (depth_km * 1000.0)
-                samples = []
-                for start_date, end_date in zip(datetime_list,
-                                                datetime_list[1:]):
-                    result_bins = []
-                    for mag_bin in mag_list:
-                        event_number = row[mag_bin]/depth_fraction
-                        result_bins.append(orm.MFDBin(
-                            referencemagnitude=mag_bin,
-                            eventnumber_value=event_number,
-                            # Question: a variance/uncertainty at this level
-                            # won't propagate to OQ hazard, so what would
-                            # be preferential to store, given the
-                            # choice between:
-                            # uncertainty/variance/confidencelevel/any?
-                            eventnumber_uncertainty=np.sqrt(event_number)))
-
-                    mfd_curve = orm.DiscreteMFD(
-                        minmag=min_mag,
-                        maxmag=max_mag,
-                        binwidth=mag_increment,
-                        magbins=result_bins)
-
-                    samples.append(orm.ModelResultSample(
-                                   starttime=start_date,
-                                   endtime=end_date,
-                                   mc_value=mc,
-                                   discretemfd=mfd_curve))
-
-                subgeom = orm.Reservoir(
-                    x_min=row['min_lon'],
-                    x_max=row['max_lon'],
-                    y_min=row['min_lat'],
-                    y_max=row['max_lat'],
-                    z_min=min_depth,
-                    z_max=max_depth,
-                    samples=samples)
-
-                subgeoms.append(subgeom)
+        n_cells = 0
+        # The ORM object graph is returned as a whole, only the model
+        # results are held one tile at a time.
+        for forecast_values in forecast_tiles:
+            with instrument.span('orm_build'):
+                if forecast_values.empty:
+                    continue
+                # The event numbers of all cells and depth slices are
+                # weighted by the model at once, the ORM objects are built
+                # from them.
+                event_numbers = event_numbers_by_slice(
+                    forecast_values, mag_list, len(depth_slices))
+                uncertainties = np.sqrt(event_numbers)
+                cell_bounds = forecast_values[CELL_BOUNDS].values[
+                    ::len(depth_slices)].tolist()
+                n_cells += len(cell_bounds)
+                for (min_lon, max_lon, min_lat, max_lat), \
+                        cell_event_numbers, cell_uncertainties in zip(
+                            cell_bounds, event_numbers, uncertainties):
+                    for (min_depth, max_depth), numbers, uncertainty in zip(
+                            depth_slices, cell_event_numbers,
+                            cell_uncertainties):
+                        # The event numbers do not depend on the epoch.
+                        samples = [
+                            orm.ModelResultSample(
+                                starttime=start_date,
+                                endtime=end_date,
+                                mc_value=mc,
+                                discretemfd=build_mfd(numbers, uncertainty))
+                            for start_date, end_date in epochs]
+
+                        subgeoms.append(orm.Reservoir(
+                            x_min=min_lon,
+                            x_max=max_lon,
+                            y_min=min_lat,
+                            y_max=max_lat,
+                            z_min=min_depth,
+                            z_max=max_depth,
+                            samples=samples))
 
         # Top level reservoir contains the total dimensions of the
         # requested search area.
@@ -176,7 +403,82 @@ class ModelAdaptor(_ModelAdaptor):
             z_max=max(reservoir_geom['z']),
             subgeometries=subgeoms)
         self.logger.info(f"{len(samples)} valid forecast samples")
+        METRICS.inc('model_cells_total', n_cells)
+        METRICS.inc('model_subgeometries_total', len(subgeoms))
 
         return ModelResult.ok(
             data={"reservoir": reservoir},
             warning=self.stderr if self.stderr else self.stdout)
+
+    def _checked_tiles(self, forecast_tiles):
+        """
+        Re-raise errors occurring in the model while evaluating result
+        tiles the same way as errors raised when calling the model.
+        """
+        try:
+            yield from forecast_tiles
+        except Exception:
+            traceback.print_exc()
+            raise WerHiResSmoM1Italy5yError(
+                'Error raised in WerHiResSmoM1Italy5y model')
+
+    def _persist_bulk(self, reservoir_geom, forecast_tiles, mag_list, mc,
+                      datetime_list, mfd):
+        """
+        Write the results straight to the worker DB without building the
+        ORM object graph.
+
+        The results are written one tile at a time, so that memory use is
+        bounded by the tile size, within a single transaction, so that a
+        failure leaves no partial results in the DB.
+
+        :returns: Detached top level :py:class:`orm.Reservoir` referring to
+            the persisted results.
+        """
+        if not self._db_url:
+            raise WerHiResSmoM1Italy5yError(
+                "Bulk persistence requires the worker DB URL.")
+        try:
+            writer = BulkResultWriter(self._db_url)
+        except ValueError as err:
+            raise WerHiResSmoM1Italy5yError(str(err))
+
+        z = np.asarray(reservoir_geom['z'], dtype=float)
+        n_depths = len(z) - 1
+        epochs = list(zip(datetime_list, datetime_list[1:]))
+        mag_values = [float(mag) for mag in mag_list]
+        n_cells = n_subgeoms = 0
+        try:
+            with writer.begin() as connection:
+                reservoir = writer.create_reservoir(connection, [
+                    min(reservoir_geom['x']), max(reservoir_geom['x']),
+                    min(reservoir_geom['y']), max(reservoir_geom['y']),
+                    min(reservoir_geom['z']), max(reservoir_geom['z'])])
+                for forecast_values in forecast_tiles:
+                    if forecast_values.empty:
+                        continue
+                    # Subgeometries are ordered by cell, then by depth
+                    # slice.
+                    cell_bounds = forecast_values[CELL_BOUNDS].values[
+                        ::n_depths]
+                    bounds = np.column_stack([
+                        forecast_values[CELL_BOUNDS].values,
+                        np.tile(z[:-1], len(cell_bounds)),
+                        np.tile(z[1:], len(cell_bounds))])
+                    event_numbers = event_numbers_by_slice(
+                        forecast_values, mag_list,
+                        n_depths).reshape(-1, len(mag_list))
+                    with instrument.span('db_commit'):
+                        writer.write_subgeometries(
+                            connection, reservoir, bounds, epochs, mc, mfd,
+                            mag_values, event_numbers,
+                            np.sqrt(event_numbers))
+                    n_cells += len(cell_bounds)
+                    n_subgeoms += len(bounds)
+        finally:
+            writer.engine.dispose()
+            METRICS.inc('model_cells_total', n_cells)
+            METRICS.inc('model_subgeometries_total', n_subgeoms)
+        self.logger.info(
+            f"{n_subgeoms} subgeometries written in bulk.")
+        return reservoir
@@ -0,0 +1,330 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Bulk persistence of WerHiResSmoM1Italy5y model results.
+
+Results are written straight to the tables of the worker ORM by means of
+chunked executemany inserts, bypassing the ORM object graph and its unit of
+work. Table, column and foreign key names are taken from the ORM mappers,
+so that the writer follows the worker schema.
+
+All rows of a reservoir are written within a single transaction, so that a
+failure leaves no partial results behind.
+"""
+import logging
+
+import numpy as np
+from sqlalchemy import create_engine, func, inspect, select, text
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from ramsis.sfm.worker import orm
+
+LOGGER = 'ramsis.sfm.worker.model_adaptor'
+logger = logging.getLogger(LOGGER)
+
+# Attributes of orm.Reservoir describing its bounds, in the column order of
+# the bounds arrays passed to the writer.
+BOUNDS_ATTRS = ('x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max')
+
+# Backends primary key values can be reserved on, see allocate_ids.
+SUPPORTED_DIALECTS = ('postgresql', 'sqlite')
+
+
+def _column_name(cls, attr):
+    """ Name of the table column mapped to an ORM attribute.
+    """
+    return inspect(cls).attrs[attr].columns[0].name
+
+
+def _primary_key(cls):
+    pk, = inspect(cls).primary_key
+    return pk
+
+
+def allocate_ids(connection, cls, n):
+    """ Reserve primary key values for rows to be inserted.
+
+    On PostgreSQL the values are drawn from the sequence of the primary
+    key column in a single round trip. SQLite holds a single write lock
+    per database, so once the transaction has written a row the values
+    following the current maximum can not be taken by a concurrent
+    transaction. Other backends are not supported.
+
+    :param connection: SQLAlchemy connection with an open transaction. On
+        SQLite the transaction must already have written to the database.
+    :param cls: ORM class of the rows.
+    :param int n: Number of values to reserve.
+    :rtype: :py:class:`numpy.ndarray`
+    :raises ValueError: If the backend is not supported.
+    """
+    pk = _primary_key(cls)
+    if connection.dialect.name not in SUPPORTED_DIALECTS:
+        raise ValueError(f"Unable to reserve primary keys on "
+                         f"{connection.dialect.name}.")
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    if connection.dialect.name == 'postgresql':
+        seq = connection.execute(select([func.pg_get_serial_sequence(
+            pk.table.fullname, pk.name)])).scalar()
+        rows = connection.execute(
+            text("SELECT nextval(:seq) FROM generate_series(1, :n)"),
+            seq=seq, n=n)
+        return np.fromiter((row[0] for row in rows), dtype=np.int64,
+                           count=n)
+    start = (connection.execute(select([func.max(pk)])).scalar() or 0) + 1
+    return np.arange(start, start + n, dtype=np.int64)
+
+
+def _reverse_relationships(relationship):
+    """ Relationships of the related class mapping the foreign key of a
+    relationship in the opposite direction.
+    """
+    (local, remote), = relationship.local_remote_pairs
+    reverse = []
+    for other in relationship.mapper.relationships:
+        pairs = other.local_remote_pairs
+        if (len(pairs) == 1 and pairs[0][0] is remote and
+                pairs[0][1] is local):
+            reverse.append(other)
+    return reverse
+
+
+class _Link:
+    """ Foreign key link of an ORM relationship.
+
+    :param cls: ORM class owning the relationship.
+    :param str name: Name of the relationship.
+    """
+
+    def __init__(self, cls, name):
+        relationship = inspect(cls).relationships[name]
+        (local, remote), = relationship.local_remote_pairs
+        # True if the foreign key is held by the owning class.
+        self.many_to_one = relationship.direction is MANYTOONE
+        self.key = local.name if self.many_to_one else remote.name
+        # A row referenced by a many to one relationship may be shared by
+        # several owners, unless the relationship is one to one.
+        self.shareable = (
+            self.many_to_one and not relationship.single_parent and
+            all(reverse.uselist
+                for reverse in _reverse_relationships(relationship)))
+
+
+def discretemfd_shareable():
+    """ Whether a :py:class:`orm.DiscreteMFD` may be referenced by several
+    samples in the worker schema.
+    """
+    return _Link(orm.ModelResultSample, 'discretemfd').shareable
+
+
+class BulkResultWriter:
+    """
+    Writes model results to the worker DB without building ORM objects.
+
+    Every subgeometry shares the same magnitude bins and epochs. Rows are
+    generated and inserted in chunks of roughly `chunk_size` magnitude bin
+    rows, so that memory use is bounded by the chunk size rather than the
+    size of the result. All rows are written on the connection of a
+    transaction opened by :py:meth:`begin`::
+
+        with writer.begin() as connection:
+            reservoir = writer.create_reservoir(connection, bounds)
+            writer.write_subgeometries(connection, reservoir, ...)
+
+    :param bind: SQLAlchemy engine or DB URL of the worker DB.
+    :param int chunk_size: Approximate number of magnitude bin rows per
+        executemany.
+    :raises ValueError: If primary keys can not be reserved on the
+        backend of the worker DB, see :py:func:`allocate_ids`.
+    """
+
+    def __init__(self, bind, chunk_size=50000):
+        if isinstance(bind, str):
+            bind = create_engine(bind)
+        if bind.dialect.name not in SUPPORTED_DIALECTS:
+            raise ValueError(f"Bulk persistence is not supported on "
+                             f"{bind.dialect.name}.")
+        self.engine = bind
+        self.chunk_size = chunk_size
+
+        self._subgeometries = _Link(orm.Reservoir, 'subgeometries')
+        self._samples = _Link(orm.Reservoir, 'samples')
+        self._discretemfd = _Link(orm.ModelResultSample, 'discretemfd')
+        self._magbins = _Link(orm.DiscreteMFD, 'magbins')
+
+        self._reservoir_pk = _primary_key(orm.Reservoir).name
+        self._sample_pk = _primary_key(orm.ModelResultSample).name
+        self._mfd_pk = _primary_key(orm.DiscreteMFD).name
+        self._bounds = [_column_name(orm.Reservoir, attr)
+                        for attr in BOUNDS_ATTRS]
+        self._sample_columns = [
+            _column_name(orm.ModelResultSample, attr)
+            for attr in ('starttime', 'endtime', 'mc_value')]
+        self._mfd_columns = [
+            _column_name(orm.DiscreteMFD, attr)
+            for attr in ('minmag', 'maxmag', 'binwidth')]
+        self._bin_columns = [
+            _column_name(orm.MFDBin, attr)
+            for attr in ('referencemagnitude', 'eventnumber_value',
+                         'eventnumber_uncertainty')]
+
+    def begin(self):
+        """ Open the transaction results are written in. It is committed
+        when the block is left and rolled back on errors.
+
+        :returns: Context manager of the SQLAlchemy connection.
+        """
+        return self.engine.begin()
+
+    def create_reservoir(self, connection, bounds):
+        """ Insert a top level reservoir. Its primary key is generated by
+        the DB. This is the first row written in a transaction.
+
+        :param connection: Connection opened by :py:meth:`begin`.
+        :param bounds: Sequence of the reservoir bounds, see
+            :py:data:`BOUNDS_ATTRS`.
+        :returns: A detached :py:class:`orm.Reservoir` identifying the
+            row. Adding it to a session does not insert it again.
+        """
+        bounds = [float(value) for value in bounds]
+        reservoir_id, = connection.execute(
+            orm.Reservoir.__table__.insert(),
+            dict(zip(self._bounds, bounds))).inserted_primary_key
+
+        reservoir = orm.Reservoir(**dict(zip(BOUNDS_ATTRS, bounds)))
+        pk_attr = inspect(orm.Reservoir).get_property_by_column(
+            _primary_key(orm.Reservoir)).key
+        setattr(reservoir, pk_attr, int(reservoir_id))
+        make_transient_to_detached(reservoir)
+        return reservoir
+
+    def write_subgeometries(self, connection, reservoir, bounds, epochs, mc,
+                            mfd, mag_values, event_numbers, uncertainties):
+        """ Insert the subgeometries of a reservoir.
+
+        If the worker schema allows a magnitude frequency distribution to
+        be referenced by several samples, every distinct distribution is
+        stored only once and shared by all epochs and subgeometries with
+        identical event numbers.
+
+        :param connection: Connection opened by :py:meth:`begin`.
+        :param reservoir: Parent reservoir as returned by
+            :py:meth:`create_reservoir` on the same connection.
+        :param bounds: Array of shape (subgeometries, 6), see
+            :py:data:`BOUNDS_ATTRS`.
+        :param epochs: List of (starttime, endtime) tuples of the samples
+            of each subgeometry.
+        :param float mc: Magnitude of completeness of the samples.
+        :param tuple mfd: Minimum magnitude, maximum magnitude and bin
+            width of the magnitude frequency distributions.
+        :param mag_values: Reference magnitudes of the bins.
+        :param event_numbers: Array of shape (subgeometries, mag) of event
+            numbers, shared by all epochs.
+        :param uncertainties: Array of the same shape as event_numbers.
+        """
+        parent_id = inspect(reservoir).identity[0]
+        n_epochs = len(epochs)
+        link = self._discretemfd
+        step = max(self.chunk_size // max(n_epochs * len(mag_values), 1), 1)
+        if link.shareable:
+            vectors, index, inverse = np.unique(
+                event_numbers, axis=0, return_index=True,
+                return_inverse=True)
+            inverse = inverse.reshape(-1)
+            shared_ids = self._insert_mfds(
+                connection, mfd, mag_values, vectors,
+                uncertainties[index])
+            logger.debug(f"Sharing {len(vectors)} distinct MFDs between "
+                         f"{len(bounds) * n_epochs} samples.")
+
+        for start in range(0, len(bounds), step):
+            stop = start + step
+            geom_ids = self._insert_geoms(connection, parent_id,
+                                          bounds[start:stop])
+            if link.shareable:
+                self._insert_samples(
+                    connection, geom_ids, epochs, mc,
+                    mfd_ids=np.repeat(shared_ids[inverse[start:stop]],
+                                      n_epochs))
+                continue
+            # Event numbers are the same for every epoch of a
+            # subgeometry.
+            values = np.repeat(event_numbers[start:stop], n_epochs,
+                               axis=0)
+            errors = np.repeat(uncertainties[start:stop], n_epochs,
+                               axis=0)
+            # Rows referenced by a foreign key are inserted first.
+            if link.many_to_one:
+                mfd_ids = self._insert_mfds(connection, mfd, mag_values,
+                                            values, errors)
+                self._insert_samples(connection, geom_ids, epochs, mc,
+                                     mfd_ids=mfd_ids)
+            else:
+                sample_ids = self._insert_samples(connection, geom_ids,
+                                                  epochs, mc)
+                self._insert_mfds(connection, mfd, mag_values, values,
+                                  errors, sample_ids=sample_ids)
+        logger.debug(f"Bulk inserted {len(bounds)} subgeometries.")
+
+    def _insert_geoms(self, connection, parent_id, bounds):
+        geom_ids = allocate_ids(connection, orm.Reservoir, len(bounds))
+        geom_rows = [dict(zip(self._bounds, row)) for row in bounds.tolist()]
+        for row, geom_id in zip(geom_rows, geom_ids.tolist()):
+            row[self._reservoir_pk] = geom_id
+            row[self._subgeometries.key] = parent_id
+        connection.execute(orm.Reservoir.__table__.insert(), geom_rows)
+        return geom_ids
+
+    def _insert_samples(self, connection, geom_ids, epochs, mc,
+                        mfd_ids=None):
+        """ Insert a sample per epoch and subgeometry, referencing the
+        given MFDs if the samples hold the foreign key.
+        """
+        sample_ids = allocate_ids(connection, orm.ModelResultSample,
+                                  len(geom_ids) * len(epochs))
+        sample_rows = []
+        for i, (sample_id, geom_id, (starttime, endtime)) in enumerate(zip(
+                sample_ids.tolist(),
+                np.repeat(geom_ids, len(epochs)).tolist(),
+                epochs * len(geom_ids))):
+            row = dict(zip(self._sample_columns, (starttime, endtime, mc)))
+            row[self._sample_pk] = sample_id
+            row[self._samples.key] = geom_id
+            if mfd_ids is not None:
+                row[self._discretemfd.key] = int(mfd_ids[i])
+            sample_rows.append(row)
+        connection.execute(orm.ModelResultSample.__table__.insert(),
+                           sample_rows)
+        return sample_ids
+
+    def _insert_mfds(self, connection, mfd, mag_values, event_numbers,
+                     uncertainties, sample_ids=None):
+        """ Insert a MFD with its bins per row of event_numbers,
+        referencing the given samples if the MFDs hold the foreign key.
+        """
+        n_mags = len(mag_values)
+        mfd_ids = allocate_ids(connection, orm.DiscreteMFD,
+                               len(event_numbers))
+        step = max(self.chunk_size // max(n_mags, 1), 1)
+        for start in range(0, len(mfd_ids), step):
+            stop = start + step
+            ids = mfd_ids[start:stop].tolist()
+            mfd_rows = []
+            for i, mfd_id in enumerate(ids, start):
+                row = dict(zip(self._mfd_columns, mfd))
+                row[self._mfd_pk] = mfd_id
+                if sample_ids is not None:
+                    row[self._discretemfd.key] = int(sample_ids[i])
+                mfd_rows.append(row)
+            connection.execute(orm.DiscreteMFD.__table__.insert(), mfd_rows)
+
+            bin_rows = [
+                dict(zip(self._bin_columns, row),
+                     **{self._magbins.key: mfd_id})
+                for mfd_id, row in zip(
+                    np.repeat(ids, n_mags).tolist(),
+                    zip(np.tile(mag_values, len(ids)).tolist(),
+                        event_numbers[start:stop].ravel().tolist(),
+                        uncertainties[start:stop].ravel().tolist()))]
+            connection.execute(orm.MFDBin.__table__.insert(), bin_rows)
+        return mfd_ids
@@ -0,0 +1,192 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Scheduling of model runs within a worker process.
+
+The number of concurrently executed model runs is bounded, further runs
+wait in a bounded queue. A place in the queue is reserved when a run is
+admitted, so that concurrently submitted runs can not exceed the bound, and
+taken over by the run when it waits for an execution slot. Waiting runs are
+started smallest reservoir first, runs waiting for long are started in
+order of arrival so that large reservoirs are not starved.
+"""
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = 'ramsis.sfm.worker.scheduler'
+logger = logging.getLogger(LOGGER)
+
+
+class QueueFull(Exception):
+    """Raised if a run is submitted while the queue is full."""
+
+
+def reservoir_cells(reservoir_geom):
+    """ Number of subgeometries a reservoir geometry is evaluated on, used
+    as the priority of its run.
+    """
+    return max(len(reservoir_geom['x']) - 1, 1) * \
+        max(len(reservoir_geom['y']) - 1, 1) * \
+        max(len(reservoir_geom['z']) - 1, 1)
+
+
+class JobScheduler:
+    """
+    Bounded priority scheduler of model runs.
+
+    :param int max_running: Maximum number of concurrently executed runs.
+    :param int max_queued: Maximum number of runs waiting for execution.
+    :param float aging: Seconds after which a waiting run is started in
+        order of arrival rather than by size.
+    :param float reservation_timeout: Seconds after which a reservation of
+        an admitted run that did not start is released.
+    """
+
+    def __init__(self, max_running=2, max_queued=16, aging=60.0,
+                 reservation_timeout=300.0):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.aging = aging
+        self.reservation_timeout = reservation_timeout
+        self._cond = threading.Condition()
+        self._waiting = {}
+        # Reservation times of admitted runs not waiting for a slot yet.
+        self._reserved = {}
+        self._seq = itertools.count()
+        self.running = 0
+        # Totals since start, for rates and averages of the wait time.
+        self.started = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def configure(self, max_running, max_queued):
+        with self._cond:
+            self.max_running = max_running
+            self.max_queued = max_queued
+            self._cond.notify_all()
+
+    @property
+    def queued(self):
+        return len(self._waiting) + len(self._reserved)
+
+    def admit(self):
+        """ Reserve a place for a run, either an execution slot or a place
+        in the queue.
+
+        :returns: Ticket of the reservation, to be passed to
+            :py:meth:`slot`, or to :py:meth:`release` if the run is not
+            started.
+        :raises QueueFull: If all slots are taken and the queue is full.
+        """
+        with self._cond:
+            now = time.monotonic()
+            for ticket, reserved in list(self._reserved.items()):
+                if now - reserved >= self.reservation_timeout:
+                    logger.warning(f"Releasing reservation {ticket} of a "
+                                   f"model run that did not start.")
+                    del self._reserved[ticket]
+            if self.running + self.queued >= \
+                    self.max_running + self.max_queued:
+                self.rejected += 1
+                raise QueueFull(
+                    f"{self.queued} model runs queued, "
+                    f"{self.running} running.")
+            ticket = next(self._seq)
+            self._reserved[ticket] = now
+            return ticket
+
+    def release(self, ticket):
+        """ Release the reservation of a run that is not started. Does
+        nothing if the run took it over.
+        """
+        with self._cond:
+            if self._reserved.pop(ticket, None) is not None:
+                self._cond.notify_all()
+
+    def retry_after(self):
+        """ Seconds a client should wait before submitting again, the
+        average wait time of the runs started so far.
+        """
+        with self._cond:
+            if not self.started:
+                return 1
+            return max(1, int(round(self.wait_seconds_total /
+                                    self.started)))
+
+    @contextmanager
+    def slot(self, cells, ticket=None):
+        """ Wait for an execution slot.
+
+        :param int cells: Size of the run, see :py:func:`reservoir_cells`.
+        :param ticket: Reservation of the run returned by :py:meth:`admit`,
+            taken over by the run. Runs without a reservation are not
+            bounded by the queue.
+        """
+        with self._cond:
+            if ticket is None or \
+                    self._reserved.pop(ticket, None) is None:
+                ticket = next(self._seq)
+            submitted = time.monotonic()
+            self._waiting[ticket] = (cells, submitted)
+            try:
+                while not (self.running < self.max_running and
+                           self._next() == ticket):
+                    self._cond.wait(timeout=self.aging)
+            except BaseException:
+                del self._waiting[ticket]
+                self._cond.notify_all()
+                raise
+            del self._waiting[ticket]
+            self.running += 1
+            waited = time.monotonic() - submitted
+            self.started += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            # Another slot may still be free for the next run.
+            self._cond.notify_all()
+        logger.debug(f"Model run of {cells} cells started after "
+                     f"{waited:.3f} s.")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._cond.notify_all()
+
+    def _next(self):
+        now = time.monotonic()
+
+        def key(item):
+            ticket, (cells, submitted) = item
+            aged = now - submitted >= self.aging
+            return (not aged, 0 if aged else cells, ticket)
+        return min(self._waiting.items(), key=key)[0]
+
+    def stats(self):
+        """ Queue metrics.
+
+        :rtype: dict
+        """
+        with self._cond:
+            now = time.monotonic()
+            return {
+                'queued': self.queued,
+                'reserved': len(self._reserved),
+                'running': self.running,
+                'max_queued': self.max_queued,
+                'max_running': self.max_running,
+                'started_total': self.started,
+                'rejected_total': self.rejected,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'oldest_wait_seconds': max(
+                    (now - submitted
+                     for _, submitted in self._waiting.values()),
+                    default=0.0)}
+
+
+# Scheduler of the model runs of this process.
+SCHEDULER = JobScheduler()
@@ -0,0 +1,97 @@
+"""
+Tests for the metrics of the worker processes.
+"""
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from ramsis.sfm.werhiressmom1italy5y.server.metrics import (
+    PREFIX, RETIRED, Metrics)
+
+
+def record_and_exit(metrics_dir, cells):
+    metrics = Metrics(metrics_dir)
+    metrics.inc('model_cells_total', cells)
+    metrics.observe('model_run_duration_seconds', cells, buckets=(1, 5),
+                    outcome='ok')
+    metrics.flush()
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+
+    def samples(self, metrics):
+        """ Samples of the rendered metrics, by series.
+        """
+        return dict(line.rsplit(' ', 1)
+                    for line in metrics.render().splitlines()
+                    if not line.startswith('#'))
+
+    def test_histogram(self):
+        metrics = Metrics()
+        for value in (0.5, 1.0, 3.0, 10.0):
+            metrics.observe('model_run_duration_seconds', value,
+                            buckets=(1.0, 5.0), outcome='ok')
+        metrics.observe('model_run_duration_seconds', 2.0,
+                        buckets=(1.0, 5.0), outcome='error')
+        samples = self.samples(metrics)
+        series = PREFIX + 'model_run_duration_seconds'
+        # Buckets are cumulative.
+        self.assertEqual(samples[series + '_bucket{outcome="ok",le="1.0"}'],
+                         '2')
+        self.assertEqual(samples[series + '_bucket{outcome="ok",le="5.0"}'],
+                         '3')
+        self.assertEqual(samples[series + '_bucket{outcome="ok",le="+Inf"}'],
+                         '4')
+        self.assertEqual(samples[series + '_sum{outcome="ok"}'], '14.5')
+        self.assertEqual(samples[series + '_count{outcome="ok"}'], '4')
+        self.assertEqual(
+            samples[series + '_bucket{outcome="error",le="1.0"}'], '0')
+        self.assertEqual(samples[series + '_count{outcome="error"}'], '1')
+
+    def test_processes(self):
+        metrics = Metrics(self.metrics_dir)
+        metrics.inc('model_cells_total', 1)
+        # Another live process.
+        other = Metrics(self.metrics_dir)
+        other.inc('model_cells_total', 10)
+        other.flush()
+        for cells in (2, 4):
+            process = multiprocessing.Process(
+                target=record_and_exit, args=(self.metrics_dir, cells))
+            process.start()
+            process.join()
+
+        series = PREFIX + 'model_run_duration_seconds'
+        for _ in range(2):
+            samples = self.samples(metrics)
+            self.assertEqual(samples[PREFIX + 'model_cells_total'], '17')
+            self.assertEqual(
+                samples[series + '_bucket{outcome="ok",le="1"}'], '0')
+            self.assertEqual(
+                samples[series + '_bucket{outcome="ok",le="5"}'], '2')
+            self.assertEqual(samples[series + '_sum{outcome="ok"}'], '6.0')
+            # Gauges are only reported by live processes.
+            self.assertEqual(samples[PREFIX + 'processes'], '2')
+            # The snapshots of exited processes are merged.
+            self.assertEqual(
+                len(glob.glob(os.path.join(self.metrics_dir, '*.json'))),
+                2)
+            self.assertTrue(os.path.exists(
+                os.path.join(self.metrics_dir, RETIRED)))
+
+        metrics.configure(self.metrics_dir, clear=True)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.metrics_dir, RETIRED)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Tests for the model adaptor facilities.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ramsis.sfm.werhiressmom1italy5y.core import werner_model
+from ramsis.sfm.werhiressmom1italy5y.core.tests.synthetic import \
+    write_csep_xml
+from ramsis.sfm.werhiressmom1italy5y.server.model_adaptor import (
+    magnitude_bins, warm_up)
+
+
+class WarmUpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, 'forecast.xml')
+        write_csep_xml(self.xml_path)
+        self.model_defaults = {
+            'xml_filename': self.xml_path,
+            'result_cache_size': 4,
+            'reservoir': {'geom': {
+                'x': np.round(np.arange(5.42, 7.8, 0.23), 2).tolist(),
+                'y': np.round(np.arange(35.9, 37.5, 0.07), 2).tolist(),
+                'z': [-30000.0, 0.0]}},
+            'model_parameters': {'model_min_mag': 5.95,
+                                 'model_max_mag': 7.95,
+                                 'mag_increment': 0.2}}
+
+    def tearDown(self):
+        werner_model.invalidate_result_locators()
+        werner_model.RESULT_CACHE.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_warm_up(self):
+        cache = werner_model.RESULT_CACHE
+        warm_up(self.model_defaults)
+        hits, misses = cache.hits, cache.misses
+
+        # A request with the default model parameters is served from the
+        # cache.
+        model_parameters = self.model_defaults['model_parameters']
+        _, mag_list, *_ = werner_model.exec_model(
+            self.model_defaults['reservoir']['geom'],
+            xml_filename=self.xml_path, cache=cache,
+            **magnitude_bins(model_parameters))
+        self.assertEqual((cache.hits, cache.misses), (hits + 1, misses))
+        self.assertEqual(mag_list[0], '5.95')
+        self.assertEqual(len(mag_list), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests for the bulk persistence of model results.
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from ramsis.sfm.worker import orm
+from ramsis.sfm.werhiressmom1italy5y.server.persistence import (
+    BOUNDS_ATTRS, BulkResultWriter, discretemfd_shareable)
+
+MFD = (4.95, 5.15, 0.1)
+MAG_VALUES = [4.95, 5.05, 5.15]
+
+
+class BulkResultWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(
+            self.tmp_dir, 'worker.db'))
+        orm.Reservoir.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        self.bounds = np.array([
+            [5.5, 5.6, 36.0, 36.1, -30000.0, -10000.0],
+            [5.5, 5.6, 36.0, 36.1, -10000.0, 0.0],
+            [5.6, 5.7, 36.0, 36.1, -30000.0, -10000.0],
+            [5.6, 5.7, 36.0, 36.1, -10000.0, 0.0]])
+        start = datetime.datetime(2020, 1, 1)
+        self.epochs = [(start, start + datetime.timedelta(days=1)),
+                       (start + datetime.timedelta(days=1),
+                        start + datetime.timedelta(days=2))]
+        # The first and last subgeometries share their event numbers.
+        self.event_numbers = np.array([
+            [0.5, 0.25, 0.125], [1.0, 0.5, 0.25], [2.0, 1.0, 0.5],
+            [0.5, 0.25, 0.125]])
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def persist_orm(self):
+        """ Persist the results as ORM objects, the way the model adaptor
+        does without bulk persistence.
+        """
+        shared = discretemfd_shareable()
+        mfds = {}
+        subgeoms = []
+        for bounds, numbers in zip(self.bounds.tolist(),
+                                   self.event_numbers):
+            samples = []
+            for starttime, endtime in self.epochs:
+                mfd = mfds.get(numbers.tobytes()) if shared else None
+                if mfd is None:
+                    mfd = orm.DiscreteMFD(
+                        minmag=MFD[0], maxmag=MFD[1], binwidth=MFD[2],
+                        magbins=[
+                            orm.MFDBin(referencemagnitude=mag,
+                                       eventnumber_value=number,
+                                       eventnumber_uncertainty=np.sqrt(
+                                           number))
+                            for mag, number in zip(MAG_VALUES,
+                                                   numbers.tolist())])
+                    mfds[numbers.tobytes()] = mfd
+                samples.append(orm.ModelResultSample(
+                    starttime=starttime, endtime=endtime, mc_value=1.0,
+                    discretemfd=mfd))
+            subgeoms.append(orm.Reservoir(
+                samples=samples, **dict(zip(BOUNDS_ATTRS, bounds))))
+        reservoir = orm.Reservoir(subgeometries=subgeoms, **dict(zip(
+            BOUNDS_ATTRS, [5.5, 5.7, 36.0, 36.1, -30000.0, 0.0])))
+        self.session.add(reservoir)
+        self.session.commit()
+        return reservoir
+
+    def persist_bulk(self, writer, chunks=1):
+        with writer.begin() as connection:
+            reservoir = writer.create_reservoir(
+                connection, [5.5, 5.7, 36.0, 36.1, -30000.0, 0.0])
+            for bounds, event_numbers in zip(
+                    np.array_split(self.bounds, chunks),
+                    np.array_split(self.event_numbers, chunks)):
+                writer.write_subgeometries(
+                    connection, reservoir, bounds, self.epochs, 1.0, MFD,
+                    MAG_VALUES, event_numbers, np.sqrt(event_numbers))
+        return reservoir
+
+    def results(self, reservoir):
+        """ Results of a persisted reservoir, read through the ORM
+        relationships, and the number of distinct MFDs.
+        """
+        self.session.expire_all()
+        reservoir = self.session.merge(reservoir, load=True)
+        results = []
+        mfds = set()
+        for geom in reservoir.subgeometries:
+            for sample in geom.samples:
+                mfd = sample.discretemfd
+                mfds.add(id(mfd))
+                results.append((
+                    [getattr(geom, attr) for attr in BOUNDS_ATTRS],
+                    sample.starttime, sample.endtime, sample.mc_value,
+                    (mfd.minmag, mfd.maxmag, mfd.binwidth),
+                    sorted((mag_bin.referencemagnitude,
+                            mag_bin.eventnumber_value,
+                            mag_bin.eventnumber_uncertainty)
+                           for mag_bin in mfd.magbins)))
+        return sorted(results), len(mfds)
+
+    def test_write(self):
+        expected = self.results(self.persist_orm())
+        self.assertEqual(len(expected[0]),
+                         len(self.bounds) * len(self.epochs))
+
+        writer = BulkResultWriter(self.engine, chunk_size=6)
+        reservoir = self.persist_bulk(writer)
+        self.assertEqual(self.results(reservoir), expected)
+        # MFDs are only shared within a call, primary keys do not collide
+        # with rows of earlier writes.
+        results, _ = self.results(self.persist_bulk(writer, chunks=3))
+        self.assertEqual(results, expected[0])
+
+    def test_rollback(self):
+        writer = BulkResultWriter(self.engine)
+        with self.assertRaises(RuntimeError):
+            with writer.begin() as connection:
+                reservoir = writer.create_reservoir(
+                    connection, [5.5, 5.7, 36.0, 36.1, -30000.0, 0.0])
+                writer.write_subgeometries(
+                    connection, reservoir, self.bounds, self.epochs, 1.0,
+                    MFD, MAG_VALUES, self.event_numbers,
+                    np.sqrt(self.event_numbers))
+                raise RuntimeError
+        for cls in (orm.Reservoir, orm.ModelResultSample, orm.DiscreteMFD,
+                    orm.MFDBin):
+            self.assertEqual(self.session.query(cls).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
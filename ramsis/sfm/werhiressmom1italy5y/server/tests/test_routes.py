@@ -0,0 +1,89 @@
+"""
+Tests for the resources of the worker API.
+"""
+import unittest
+from unittest import mock
+
+from ramsis.sfm.werhiressmom1italy5y import settings
+from ramsis.sfm.werhiressmom1italy5y.core import instrument
+from ramsis.sfm.werhiressmom1italy5y.server import create_app
+from ramsis.sfm.werhiressmom1italy5y.server.scheduler import SCHEDULER
+from ramsis.sfm.werhiressmom1italy5y.server.v1 import routes
+from ramsis.sfm.worker.resource import SFMRamsisWorkerListResource
+
+
+class RoutesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.limits = SCHEDULER.max_running, SCHEDULER.max_queued
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'RAMSIS_SFM_DEFAULTS': {'max_running': 0, 'max_queued': 0}})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        for ticket in list(SCHEDULER._reserved):
+            SCHEDULER.release(ticket)
+        SCHEDULER.configure(*self.limits)
+
+    def test_queue_full(self):
+        response = self.client.post(
+            '/v1' + settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_SCENARIOS,
+            json={})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'],
+                         str(SCHEDULER.retry_after()))
+        self.assertIn('message', response.get_json())
+        self.assertIn('X-Request-ID', response.headers)
+
+        response = self.client.get(
+            '/v1' + settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_QUEUE)
+        self.assertEqual(response.get_json()['rejected_total'],
+                         SCHEDULER.rejected)
+
+    def test_reservation(self):
+        SCHEDULER.configure(max_running=1, max_queued=0)
+        url = '/v1' + settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_SCENARIOS
+        # The reservation of a scenario that is not accepted is released.
+        with mock.patch.object(SFMRamsisWorkerListResource, 'post',
+                               return_value=({'message': 'invalid'}, 422)):
+            self.assertEqual(self.client.post(url, json={}).status_code,
+                             422)
+        self.assertEqual(SCHEDULER.queued, 0)
+        with mock.patch.object(SFMRamsisWorkerListResource, 'post',
+                               side_effect=RuntimeError):
+            self.client.post(url, json={})
+        self.assertEqual(SCHEDULER.queued, 0)
+
+        # Accepted scenarios keep their place until their run starts.
+        with mock.patch.object(SFMRamsisWorkerListResource, 'post',
+                               return_value=({'message': 'accepted'}, 202)):
+            self.assertEqual(self.client.post(url, json={}).status_code,
+                             202)
+            self.assertEqual(self.client.post(url, json={}).status_code,
+                             503)
+        self.assertEqual(SCHEDULER.queued, 1)
+
+    def test_timings(self):
+        store = instrument.TraceStore()
+        with instrument.trace('run-1', store=store) as trace:
+            with instrument.span('xml_load'):
+                pass
+            with instrument.span('regrid'):
+                pass
+        url = '/v1' + settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_TIMINGS
+        with mock.patch.object(routes, 'TRACES', store):
+            response = self.client.get(url + '/run-1')
+            self.assertEqual(response.status_code, 200)
+            timings = response.get_json()
+            self.assertEqual(timings, trace.as_dict())
+            self.assertEqual([stage['name'] for stage in timings['stages']],
+                             ['xml_load', 'regrid'])
+
+            response = self.client.get(url + '/run-2')
+            self.assertEqual(response.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Tests for the scheduling of model runs.
+"""
+import threading
+import time
+import unittest
+
+from ramsis.sfm.werhiressmom1italy5y.server.scheduler import (
+    JobScheduler, QueueFull, reservoir_cells)
+
+
+class JobSchedulerTestCase(unittest.TestCase):
+
+    def run_jobs(self, scheduler, jobs):
+        """ Submit runs of the given sizes while all slots are taken, and
+        return the sizes in the order the runs started.
+        """
+        started = []
+
+        def run(cells):
+            with scheduler.slot(cells):
+                started.append(cells)
+
+        with scheduler.slot(1):
+            threads = []
+            for cells in jobs:
+                thread = threading.Thread(target=run, args=(cells,))
+                thread.start()
+                threads.append(thread)
+                # Wait for the run to be queued, so that runs are queued in
+                # order.
+                while scheduler.queued < len(threads):
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join(timeout=5)
+        return started
+
+    def test_reservoir_cells(self):
+        self.assertEqual(reservoir_cells(
+            {'x': [0, 1, 2], 'y': [0, 1], 'z': [0, 1, 2, 3]}), 6)
+        self.assertEqual(reservoir_cells({'x': [0], 'y': [0], 'z': [0]}), 1)
+
+    def test_admit(self):
+        scheduler = JobScheduler(max_running=1, max_queued=1)
+        ticket = scheduler.admit()
+        queued = scheduler.admit()
+        # Admitted runs count against the bounds before they start.
+        with self.assertRaises(QueueFull):
+            scheduler.admit()
+        self.assertEqual(scheduler.stats()['rejected_total'], 1)
+        with scheduler.slot(1, ticket=ticket):
+            self.assertEqual(scheduler.stats()['queued'], 1)
+            with self.assertRaises(QueueFull):
+                scheduler.admit()
+            scheduler.release(queued)
+            scheduler.release(queued)
+            self.assertEqual(scheduler.stats()['queued'], 0)
+            scheduler.release(scheduler.admit())
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+        # Reservations of runs that did not start expire.
+        scheduler = JobScheduler(max_running=1, max_queued=0,
+                                 reservation_timeout=0.0)
+        scheduler.admit()
+        scheduler.admit()
+        self.assertEqual(scheduler.stats()['reserved'], 1)
+
+    def test_concurrent_admit(self):
+        scheduler = JobScheduler(max_running=2, max_queued=3)
+        barrier = threading.Barrier(20)
+        tickets = []
+
+        def submit():
+            barrier.wait()
+            try:
+                tickets.append(scheduler.admit())
+            except QueueFull:
+                pass
+
+        threads = [threading.Thread(target=submit) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(len(tickets), 5)
+        self.assertEqual(scheduler.stats()['rejected_total'], 15)
+        self.assertEqual(scheduler.queued, 5)
+
+    def test_priority(self):
+        scheduler = JobScheduler(max_running=1)
+        # Smallest reservoirs first.
+        self.assertEqual(self.run_jobs(scheduler, [30, 10, 20]),
+                         [10, 20, 30])
+        # Aged runs in order of arrival.
+        scheduler = JobScheduler(max_running=1, aging=0.0)
+        self.assertEqual(self.run_jobs(scheduler, [30, 10, 20]),
+                         [30, 10, 20])
+
+    def test_release(self):
+        scheduler = JobScheduler(max_running=1, max_queued=0)
+        with self.assertRaises(RuntimeError):
+            with scheduler.slot(1):
+                raise RuntimeError
+        self.assertEqual(scheduler.stats()['running'], 0)
+        with scheduler.slot(1, ticket=scheduler.admit()):
+            self.assertEqual(scheduler.stats()['running'], 1)
+            self.assertEqual(scheduler.stats()['queued'], 0)
+
+    def test_retry_after(self):
+        scheduler = JobScheduler()
+        self.assertEqual(scheduler.retry_after(), 1)
+        scheduler.started = 2
+        scheduler.wait_seconds_total = 9.0
+        self.assertEqual(scheduler.retry_after(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,20 @@
 """
 WerHiResSmoM1Italy5y resource facilities.
 """
-from flask_restful import Api
+import logging
+
+from flask import Response, g, jsonify, make_response
+from flask_restful import Api, Resource
+from flask_restful.utils import unpack
 
 from ramsis.sfm.werhiressmom1italy5y import settings
+from ramsis.sfm.werhiressmom1italy5y.core.instrument import TRACES
 from ramsis.sfm.werhiressmom1italy5y.server import db
+from ramsis.sfm.werhiressmom1italy5y.server.metrics import \
+    CONTENT_TYPE, METRICS
 from ramsis.sfm.werhiressmom1italy5y.server.model_adaptor import ModelAdaptor
+from ramsis.sfm.werhiressmom1italy5y.server.scheduler import \
+    SCHEDULER, QueueFull
 from ramsis.sfm.werhiressmom1italy5y.server.v1 import blueprint
 from ramsis.sfm.werhiressmom1italy5y.server.v1.schema import create_sfm_worker_imessage_schema
 from ramsis.sfm.worker.parser import parser
@@ -48,6 +57,63 @@ class WerHiResSmoM1Italy5yListAPI(SFMRamsisWorkerListResource):
                          locations=locations)
         return p
 
+    def post(self):
+        # Reject scenarios rather than queueing model runs without bound.
+        # The place of the run is reserved until the run takes it over.
+        try:
+            g.scheduler_ticket = SCHEDULER.admit()
+        except QueueFull as err:
+            logging.getLogger(self.LOGGER).warning(
+                f"Rejecting scenario: {err}")
+            response = make_response(
+                jsonify({'message': 'Too many model runs, retry later.'}),
+                503)
+            response.headers['Retry-After'] = str(SCHEDULER.retry_after())
+            return response
+        try:
+            response = super().post()
+        except BaseException:
+            SCHEDULER.release(g.scheduler_ticket)
+            raise
+        status = response.status_code if isinstance(response, Response) \
+            else unpack(response)[1]
+        if status >= 400:
+            # The scenario was not accepted, its run is never started.
+            SCHEDULER.release(g.scheduler_ticket)
+        return response
+
+
+class WerHiResSmoM1Italy5yQueueAPI(Resource):
+    """
+    Metrics of the model run queue of the worker process, e.g. to scale
+    workers on.
+    """
+
+    def get(self):
+        return SCHEDULER.stats()
+
+
+class WerHiResSmoM1Italy5yMetricsAPI(Resource):
+    """
+    Metrics of all processes of the worker in the Prometheus text format.
+    """
+
+    def get(self):
+        return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
+class WerHiResSmoM1Italy5yTimingsAPI(Resource):
+    """
+    Stage timings of a model run, identified by the request id returned in
+    the X-Request-ID header of the scenario POST request. Only the runs of
+    the serving worker process are known.
+    """
+
+    def get(self, request_id):
+        trace = TRACES.get(request_id)
+        if trace is None:
+            return {'message': f'No timings of request {request_id}.'}, 404
+        return trace.as_dict()
 
 
 api_v1.add_resource(WerHiResSmoM1Italy5yAPI,
@@ -60,3 +126,14 @@ api_v1.add_resource(WerHiResSmoM1Italy5yListAPI,
                     resource_class_kwargs={
                         'model': ModelAdaptor,
                         'db': db})
+
+api_v1.add_resource(WerHiResSmoM1Italy5yQueueAPI,
+                    settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_QUEUE)
+
+api_v1.add_resource(WerHiResSmoM1Italy5yMetricsAPI,
+                    settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_METRICS)
+
+api_v1.add_resource(
+    WerHiResSmoM1Italy5yTimingsAPI,
+    '{}/<request_id>'.format(
+        settings.PATH_RAMSIS_WerHiResSmoM1Italy5y_TIMINGS))
@@ -14,6 +14,9 @@ class WerHiResSmoM1Italy5yModelParameterSchema(ModelParameterSchemaBase):
     model_end_training = UTCDateTime('utc_isoformat')
     model_training_events_threshold = fields.Integer()
     model_threshold_magnitude = fields.Float()
+    model_min_mag = fields.Float()
+    model_max_mag = fields.Float()
+    mag_increment = fields.Float()
 
 
 SFMWorkerIMessageSchema = create_sfm_worker_imessage_schema(
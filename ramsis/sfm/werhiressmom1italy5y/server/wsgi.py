@@ -0,0 +1,34 @@
+# Copyright 2018, ETH Zurich - Swiss Seismological Service SED
+"""
+Production WSGI server for the WerHiResSmoM1Italy5y worker webservice.
+
+The webservice is served by a pre-forking `gunicorn
+<https://gunicorn.org/>`_ server. The application, warmed up with the
+forecast grid, is loaded by the master process before the workers are
+forked and before the server socket is bound, so that all workers share
+the pages of the grid copy-on-write.
+"""
+from gunicorn.app.base import BaseApplication
+
+
+class WSGIServer(BaseApplication):
+    """
+    gunicorn application serving a Flask application.
+
+    :param app: The Flask application.
+    :param dict options: gunicorn settings, e.g. `bind`, `workers`,
+        `threads`, `keepalive` and `backlog`.
+    """
+
+    def __init__(self, app, options=None):
+        self.application = app
+        self.options = dict(options or {}, preload_app=True)
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+    def load(self):
+        return self.application
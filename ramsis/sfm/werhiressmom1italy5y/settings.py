@@ -8,10 +8,23 @@ from ramsis.sfm.worker import settings
 
 RAMSIS_WORKER_WerHiResSmoM1Italy5y_ID = 'WerHiResSmoM1Italy5y'
 RAMSIS_WORKER_WerHiResSmoM1Italy5y_PORT = 5000
-RAMSIS_WORKER_WerHiResSmoM1Italy5y_CONFIG_SECTION = 'CONFIG_SFM_WORKER_WerHiResSmoM1Italy5y'
+# Production WSGI server defaults, see server.wsgi.
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_HOST = '127.0.0.1'
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_WORKERS = 4
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_THREADS = 1
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_KEEPALIVE = 2
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_BACKLOG = 2048
+RAMSIS_WORKER_WerHiResSmoM1Italy5y_CONFIG_SECTION = (
+    'CONFIG_SFM_WORKER_WerHiResSmoM1Italy5y')
 
-PATH_RAMSIS_WerHiResSmoM1Italy5y_SCENARIOS = ('/' + RAMSIS_WORKER_WerHiResSmoM1Italy5y_ID +
-                             settings.PATH_RAMSIS_WORKER_SCENARIOS)
+PATH_RAMSIS_WerHiResSmoM1Italy5y_SCENARIOS = '/{}{}'.format(
+    RAMSIS_WORKER_WerHiResSmoM1Italy5y_ID,
+    settings.PATH_RAMSIS_WORKER_SCENARIOS)
+PATH_RAMSIS_WerHiResSmoM1Italy5y_QUEUE = (
+    '/' + RAMSIS_WORKER_WerHiResSmoM1Italy5y_ID + '/queue')
+PATH_RAMSIS_WerHiResSmoM1Italy5y_METRICS = '/metrics'
+PATH_RAMSIS_WerHiResSmoM1Italy5y_TIMINGS = (
+    '/' + RAMSIS_WORKER_WerHiResSmoM1Italy5y_ID + '/timings')
 
 
 # choose how data is handled when input to
@@ -42,6 +55,26 @@ lon_list = nround(arange(lon_min, lon_max, lon_increment), 2).tolist()
 lat_list = nround(arange(lat_min, lat_max, lat_increment), 2).tolist()
 
 RAMSIS_WORKER_SFM_DEFAULTS = {
+    # Number of processes evaluating the result grid in tiles, 1 evaluates
+    # it in the request thread, -1 uses a process per CPU.
+    "n_workers": 1,
+    # Map the forecast grid from a shared memory segment held by all
+    # worker processes of the host rather than loading it per process.
+    "shared_memory": False,
+    # Number of model runs executed concurrently per server process, and
+    # number of further runs queued before new scenarios are rejected.
+    # Both limits are per process: the production server with --workers N
+    # executes up to N * max_running runs at once.
+    "max_running": 2,
+    "max_queued": 16,
+    # Number of model outputs cached in memory per process, keyed by the
+    # reservoir geometry and the forecast file. 0 disables the cache.
+    "result_cache_size": 16,
+    # Directory outputs evicted from the cache are spilled to, if any.
+    "result_cache_dir": None,
+    # Directory the worker processes share their metrics through. The
+    # production server uses a temporary directory if not set.
+    "metrics_dir": None,
     "reservoir": {"geom": {"x": lon_list,
                            "y": lat_list,
                            "z": [z_min, z_max]}},
@@ -49,6 +82,12 @@ RAMSIS_WORKER_SFM_DEFAULTS = {
         # If epoch_duration is None, will make single forecast for the whole
         # time between dateime_start and datetime_end
         "epoch_duration": None,
+        # Write results straight to the worker DB instead of building
+        # an ORM object per magnitude bin.
+        "bulk_persistence": False,
+        # Number of result cell columns evaluated and written per tile,
+        # None evaluates the whole reservoir at once.
+        "tile_size": None,
         "model_min_mag": mag_start,
         "model_max_mag": mag_end,
         "mag_increment": mag_increment}}
@@ -49,7 +49,8 @@ _install_requires = [
 _extras_require = {'doc': [
     "sphinx==1.4.1",
     "sphinx-rtd-theme==0.1.9", ],
-    "postgres": ["psycopg2==2.8.3"]}
+    "postgres": ["psycopg2==2.8.3"],
+    "production": ["gunicorn==19.9.0"]}
 
 _tests_require = []
 
@@ -58,7 +59,9 @@ _data_files = [
 
 _entry_points = {
     'console_scripts': [
-        'ramsis-sfm-worker-wer-hires-smo_m1-italy-5y = ramsis.sfm.werhiressmom1italy5y.server.app:main', ]}
+        'ramsis-sfm-worker-wer-hires-smo_m1-italy-5y = ramsis.sfm.werhiressmom1italy5y.server.app:main',
+        ('ramsis-sfm-worker-wer-hires-smo_m1-italy-5y-compile = '
+         'ramsis.sfm.werhiressmom1italy5y.core.forecast_grid:main'), ]}
 
 _name = 'ramsis.sfm.werhiressmom1italy5y'
 _version = get_version(os.path.join('ramsis', 'sfm', 'werhiressmom1italy5y', '__init__.py'))